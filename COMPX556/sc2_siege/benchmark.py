@@ -0,0 +1,105 @@
+from copy import deepcopy
+import random
+import timeit
+import tracemalloc
+import typing as t
+import click
+import gp
+
+
+@click.group()
+def cli():
+    pass
+
+
+def _deepcopy_copy(self: gp.Gene) -> gp.Gene:
+    """The original deepcopy based `Gene.copy`"""
+    new_copy = deepcopy(self)
+
+    def _update_parent_references(gene: gp.Gene):
+        for child in getattr(gene, "_children", []):
+            child.set_parent(gene)
+            _update_parent_references(child)
+    _update_parent_references(new_copy)
+    return new_copy
+
+
+def _measure(func: t.Callable[[], None], number: int) -> t.Tuple[float, float]:
+    """Return the time (microseconds) and peak memory allocated (bytes) of a
+    call"""
+    seconds = timeit.timeit(func, number=number)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds / number * 1e6, peak
+
+
+@cli.command()
+@click.option('--samples', default=20, help='Number of random parent pairs per depth')
+@click.option('--max-depth', default=6, help='Largest tree depth to benchmark')
+def copy(samples: int, max_depth: int):
+    """Compare crossover using the structural Gene.copy with the original
+    deepcopy implementation"""
+    random.seed(42)
+    crossover = gp.SubtreeCrossover()
+    structural_copy = gp.Gene.copy, gp.Composite.copy
+
+    def _crossover(parents):
+        for parent_a, parent_b in parents:
+            try:
+                crossover.crossover(parent_a, parent_b)
+            except gp.BadGenotype:
+                pass
+
+    click.echo("depth, deepcopy us, structural us, speedup, deepcopy peak KiB, structural peak KiB")
+    for depth in range(1, max_depth + 1):
+        parents = [(gp.initialise_genotype(depth), gp.initialise_genotype(depth))
+                   for _ in range(samples)]
+        number = max(1, 64 // 2 ** depth)
+
+        gp.Gene.copy = gp.Composite.copy = _deepcopy_copy
+        try:
+            old_time, old_peak = _measure(lambda: _crossover(parents), number)
+        finally:
+            gp.Gene.copy, gp.Composite.copy = structural_copy
+        new_time, new_peak = _measure(lambda: _crossover(parents), number)
+
+        click.echo(
+            f"{depth}, {old_time / samples:.1f}, {new_time / samples:.1f}, "
+            f"{old_time / new_time:.1f}x, {old_peak / 1024:.1f}, {new_peak / 1024:.1f}")
+
+
+
+@cli.command()
+@click.option('--samples', default=10, help='Number of random genotypes to evaluate')
+@click.option('--depth', default=2, help='Depth of the random genotypes')
+def evaluations(samples: int, depth: int):
+    """Compare evaluations per hour of the original bot settings, one setup
+    command and 4 game loops per step, with the configured settings. Needs
+    StarCraft II."""
+    from config.config import Config
+    from sc2_evaluator.evaluate import WarmGameClient
+    cfg = Config()
+    random.seed(42)
+    genotypes = [gp.initialise_genotype(depth) for _ in range(samples)]
+    settings = {
+        'original': dict(batch_commands=False, setup_game_step=4, survival_game_step=4),
+        'configured': cfg.bot_options(),
+    }
+
+    click.echo("settings, evaluations per hour, mean setup game seconds, mean time survived")
+    for name, options in settings.items():
+        evaluator = WarmGameClient(cfg.win_timeout, cfg.ready_time_limit, **options)
+        try:
+            start = timeit.default_timer()
+            results = [evaluator.evaluate_profiled(genotype) for genotype in genotypes]
+            seconds = timeit.default_timer() - start
+        finally:
+            evaluator.close()
+        setup = sum(profile['setup_game_time'] for _, profile in results) / samples
+        survived = sum(fitness.time for fitness, _ in results) / samples
+        click.echo(f"{name}, {samples / seconds * 3600:.0f}, {setup:.1f}, {survived:.1f}")
+
+if __name__ == '__main__':
+    cli()
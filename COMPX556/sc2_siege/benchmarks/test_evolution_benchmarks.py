@@ -0,0 +1,84 @@
+"""Benchmarks of population operations and a whole generation at several
+population sizes. Evaluation uses a stub so only the evolution loop itself
+is measured."""
+import random
+import pytest
+import gp
+from config.config import Config
+from evolution.evolution import Population, PopulationEvaluator, next_generation
+from sc2_evaluator.evaluate import Evaluator
+
+pytest.importorskip("pytest_benchmark")
+
+SIZES = [100, 1000]
+ROUNDS = 10
+
+cfg = Config()
+
+
+class _StubEvaluator(Evaluator):
+    """Scores genotypes instantly by their size"""
+
+    remote = False
+
+    def evaluate(self, genotype: gp.Gene) -> gp.Fitness:
+        return gp.Fitness(genotype.size(), 50 * genotype.size(), 0)
+
+
+def _population(size: int, evaluated: bool = True) -> Population:
+    random.seed(42)
+    population = Population.initialize(size, 3, cfg.fitness_scorer())
+    if evaluated:
+        population = PopulationEvaluator(_StubEvaluator()).evaluate(population)
+    return population
+
+
+def _reseed():
+    """Setup for breeding benchmarks, so each round picks the same parents"""
+    random.seed(42)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_select(benchmark, size):
+    benchmark(_population(size).select, size // 2)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_sample(benchmark, size):
+    benchmark(_population(size).select(size // 2).sample, size)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_stochastic_mutate(benchmark, size):
+    population = _population(size)
+    mutator = gp.SubtreeMutator(cfg.mutant_tree_depth)
+    benchmark.pedantic(population.stochastic_mutate, args=(mutator.mutate, cfg.mutation_probability),
+                       setup=_reseed, rounds=ROUNDS)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_stochastic_sex(benchmark, size):
+    population = _population(size)
+    crossover = gp.SubtreeCrossover()
+    benchmark.pedantic(population.stochastic_sex, args=(crossover.crossover, cfg.sex_probability),
+                       setup=_reseed, rounds=ROUNDS)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_generation(benchmark, size):
+    """Evaluate a population then breed the next generation, with a fresh
+    fitness cache each round so every genotype is evaluated"""
+    generation_cfg = Config()
+    generation_cfg.population_size = size
+    generation_cfg.selection_size = size // 2
+    mutator = gp.SubtreeMutator(cfg.mutant_tree_depth)
+    crossover = gp.SubtreeCrossover()
+
+    def _setup():
+        return (_population(size, evaluated=False),), {}
+
+    def _generation(population: Population):
+        population = PopulationEvaluator(_StubEvaluator()).evaluate(population)
+        return next_generation(population, generation_cfg, mutator.mutate, crossover.crossover)
+
+    benchmark.pedantic(_generation, setup=_setup, rounds=5)
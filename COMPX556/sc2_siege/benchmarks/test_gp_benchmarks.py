@@ -0,0 +1,106 @@
+"""Benchmarks of the GP hot paths at several tree depths.
+
+Run with `python -m pytest benchmarks --benchmark-only`, see the README for
+comparing against the stored baseline."""
+import random
+import pytest
+import gp
+from gp.rectangle import Rectangle
+from sc2_evaluator.command import build_command_queue
+
+pytest.importorskip("pytest_benchmark")
+
+DEPTHS = [1, 2, 3, 4]
+ROUNDS = 50
+
+
+def _genotypes(depth: int, n: int = 32):
+    random.seed(42)
+    return [gp.initialise_genotype(depth) for _ in range(n)]
+
+
+def _each(func, genotypes):
+    """Call func on each genotype, so one round covers trees of many shapes"""
+    def _run():
+        for genotype in genotypes:
+            func(genotype)
+    return _run
+
+
+def _reseed():
+    """Reseed before each round, so every round makes the same random
+    choices and the timings can be compared against the baseline"""
+    random.seed(42)
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_initialise_genotype(benchmark, depth):
+    benchmark.pedantic(gp.initialise_genotype, args=(depth,), setup=_reseed, rounds=ROUNDS)
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_from_str(benchmark, depth):
+    strings = [str(genotype) for genotype in _genotypes(depth)]
+    benchmark(_each(gp.from_str, strings))
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_to_str(benchmark, depth):
+    benchmark(_each(str, _genotypes(depth)))
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_copy(benchmark, depth):
+    benchmark(_each(lambda genotype: genotype.copy(), _genotypes(depth)))
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_iterate(benchmark, depth):
+    benchmark(_each(lambda genotype: sum(1 for _ in genotype.iterate()), _genotypes(depth)))
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_crossover(benchmark, depth):
+    genotypes = _genotypes(depth)
+    crossover = gp.SubtreeCrossover()
+
+    def _crossover(genotype):
+        try:
+            crossover.crossover(genotype, genotypes[0])
+        except gp.BadGenotype:
+            pass
+    benchmark.pedantic(_each(_crossover, genotypes), setup=_reseed, rounds=ROUNDS)
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_mutate(benchmark, depth):
+    mutator = gp.SubtreeMutator(2)
+
+    def _mutate(genotype):
+        try:
+            mutator.mutate(genotype)
+        except gp.BadGenotype:
+            pass
+    genotypes = _genotypes(depth)
+    benchmark.pedantic(_each(_mutate, genotypes), setup=_reseed, rounds=ROUNDS)
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_build_command_queue(benchmark, depth):
+    benchmark(_each(lambda genotype: build_command_queue(
+        genotype, Rectangle(40, 40, 16, 16)), _genotypes(depth)))
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_encode_population(benchmark, depth):
+    benchmark(gp.encode_population, _genotypes(depth))
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_decode_population(benchmark, depth):
+    benchmark(gp.decode_population, *gp.encode_population(_genotypes(depth)))
+
+
+@pytest.mark.parametrize("depth", DEPTHS)
+def test_phenotype_grids(benchmark, depth):
+    benchmark(gp.phenotype_grids, _genotypes(depth))
@@ -13,6 +13,12 @@ class Config():
 
     selection_size: int
     """The number of individuals to select for reproduction"""
+    selection: str
+    """How parents are selected: "truncation", "tournament", "roulette" or
+    "nsga2". NSGA-II treats time, minerals and gas as separate objectives and
+    only uses the sign of their weights"""
+    tournament_size: int
+    """The number of individuals competing in each tournament"""
     population_size: int
     """The number of individuals in the population"""
     init_depth: int
@@ -27,10 +33,78 @@ class Config():
     generations: int
     """The number of generations to run the simulation for"""
 
+    unique_offspring: bool
+    """Breed offspring until no two individuals build the same layout,
+    instead of sampling parents with replacement"""
+    breed_attempts: int
+    """The offspring bred per slot before unique breeding gives up and fills
+    the slot with a random genotype"""
+    min_diversity: float
+    """The fraction of distinct layouts in a population below which unique
+    breeding adds immigrants"""
+    immigrants: int
+    """The number of random genotypes added when diversity is low"""
+
+    migration_interval: int
+    """The number of generations between migrations in island mode"""
+    migration_size: int
+    """The number of fittest individuals each island sends to its neighbours"""
+    migration_topology: str
+    """Which islands exchange individuals: "ring", "fully_connected" or
+    "isolated"
+    """
+
     generation_log: str
-    """Where to log pickle files of each generation"""
+    """Where to log the Pareto front of each generation"""
+    checkpoint: str
+    """The append-only record of every generation, used to resume a run"""
     tensorboard_log: str
     """Where to log time series tensorboard data"""
+    fitness_cache: str
+    """Where to store the fitness of previously evaluated genotypes"""
+    fitness_cache_size: int
+    """The number of cached genotypes to keep in memory"""
+    fitness_samples: int
+    """The number of evaluations averaged before a cached fitness is trusted"""
+
+    racing_budget: int
+    """The most extra evaluations per generation spent re-evaluating
+    individuals near the selection cutoff, 0 to disable racing. Racing
+    only supports truncation selection."""
+    racing_max_samples: int
+    """Racing stops re-evaluating a genotype once it has this many samples"""
+    racing_confidence: float
+    """How many standard errors from the selection cutoff a genotype's mean
+    score must be before racing trusts it"""
+
+    prescreen_fraction: float
+    """The fraction of bred offspring the fitness predictor lets through to
+    be evaluated, 1 to evaluate every offspring"""
+    prescreen_min_samples: int
+    """The number of evaluated genotypes the fitness predictor needs before
+    it screens offspring"""
+
+    evaluation_batch_size: int
+    """The most genotypes sent to a ray worker at once"""
+    evaluation_timeout: float
+    """Wall clock seconds a remote evaluation may take per genotype before it
+    is cancelled and retried, or None to wait forever"""
+    evaluation_retries: int
+    """How many times a genotype whose evaluation crashed or timed out is
+    evaluated again before it is dropped from the population"""
+    quarantine_failures: int
+    """The number of batches in a row a worker may fail before it is replaced"""
+    early_stop: bool
+    """Stop evaluations once the genotype cannot be selected, even if it
+    survives until the timeout. Its time survived is then a lower bound"""
+
+    setup_game_step: int
+    """Game loops between bot steps while issuing commands"""
+    survival_game_step: int
+    """Game loops between bot steps once the waves attack. The bot only
+    checks whether it survived, so larger steps make evaluations faster at
+    the cost of measuring the time survived less precisely (22.4 loops are
+    one game second)"""
 
     win_timeout: float
     """How long until the game is considered a win"""
@@ -44,6 +118,8 @@ class Config():
         self.time_weight = 100.
 
         self.selection_size = 50
+        self.selection = "truncation"
+        self.tournament_size = 3
         self.population_size = 100
         self.init_depth = 1
 
@@ -51,13 +127,49 @@ class Config():
         self.mutation_probability = 0.1
         self.generations = 1_000
 
+        self.unique_offspring = False
+        self.breed_attempts = 10
+        self.min_diversity = 0.5
+        self.immigrants = 10
+
+        self.migration_interval = 5
+        self.migration_size = 2
+        self.migration_topology = "ring"
+
         self.generation_log = "logs/generation"
+        self.checkpoint = "logs/generation/checkpoint.jsonl"
         self.tensorboard_log = "logs/tensorboard"
+        self.fitness_cache = "logs/fitness_cache"
+        self.fitness_cache_size = 10_000
+        self.fitness_samples = 1
+
+        self.racing_budget = 0
+        self.racing_max_samples = 5
+        self.racing_confidence = 2.0
+
+        self.prescreen_fraction = 1.0
+        self.prescreen_min_samples = 100
+
+        self.evaluation_batch_size = 1
+        self.evaluation_timeout = 600
+        self.evaluation_retries = 2
+        self.quarantine_failures = 3
+        self.early_stop = False
+
+        self.setup_game_step = 4
+        self.survival_game_step = 16
 
         self.win_timeout = 200
         self.ready_time_limit = 200
         self.mutant_tree_depth = 2
 
+    def bot_options(self):
+        """Keyword arguments for the SC2 evaluators' bot"""
+        return dict(
+            setup_game_step=self.setup_game_step,
+            survival_game_step=self.survival_game_step
+        )
+
     def fitness_scorer(self):
         return SquashFitness(
             self.time_weight,
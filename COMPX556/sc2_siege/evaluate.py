@@ -1,10 +1,13 @@
 import pickle
+import typing as t
 import click
 from config.config import Config
+from evolution.checkpoint import load_generation
 from evolution.evolution import Population
 
 import gp
-from sc2_evaluator.evaluate import evaluate, run_human_playable
+from sc2_evaluator.evaluate import evaluate, evaluate_profiled, run_human_playable
+from sc2_evaluator.surrogate import SurrogateEvaluator
 from loguru import logger as log
 
 
@@ -34,18 +37,27 @@ def random(realtime: bool, depth: int, no_eval: bool):
 @click.argument("genotype")
 @click.option('--no-eval', default=False, is_flag=True, help='Skip evaluation')
 @click.option('--realtime/--fast', default=True, help='Run in realtime or as fast as possible')
-def load(genotype: str, no_eval: bool, realtime: bool):
+@click.option('--surrogate', default=False, is_flag=True, help='Estimate the fitness without SC2')
+@click.option('--batch/--single', default=True, help='Issue every possible setup command each step or one per step')
+def load(genotype: str, no_eval: bool, realtime: bool, surrogate: bool, batch: bool):
     cfg = Config()
     gene = gp.from_str(genotype)
     log.info(f'Evaluating Gene: {gene}')
-    if not no_eval:
-        fitness = evaluate(
+    if surrogate:
+        fitness = SurrogateEvaluator(cfg.win_timeout).evaluate(gene)
+        log.info(f'Fitness: {fitness}')
+    elif not no_eval:
+        fitness, profile = evaluate_profiled(
             gene,
             realtime,
             win_timeout=cfg.win_timeout,
-            ready_time_limit=cfg.ready_time_limit
+            ready_time_limit=cfg.ready_time_limit,
+            batch_commands=batch,
+            **cfg.bot_options()
         )
         log.info(f'Fitness: {fitness}')
+        log.info(f'Setup took {profile["setup_game_time"]:.1f} game seconds '
+                 f'and {profile["setup_steps"]} steps')
 
 
 @cli.command()
@@ -63,14 +75,19 @@ def plot(genotype: str, filename: str):
 
 
 @cli.command()
-@click.argument("population_pickle")
-def population(population_pickle: str):
+@click.argument("checkpoint")
+@click.option('--generation', default=None, type=int, help='Generation to show, the last one by default')
+def population(checkpoint: str, generation: t.Optional[int]):
+    """Show a generation from a checkpoint, or from a legacy pickle file"""
     cfg = Config()
+    to_fitness_score = cfg.fitness_scorer()
 
-    with open(population_pickle, 'rb') as f:
-        population: Population = pickle.load(f)
+    if checkpoint.endswith('.pkl'):
+        with open(checkpoint, 'rb') as f:
+            population: Population = pickle.load(f)
+    else:
+        _, population, _ = load_generation(checkpoint, to_fitness_score, generation)
 
-    to_fitness_score = cfg.fitness_scorer()
     for individual in population.select(len(population)):
 
         log.info(
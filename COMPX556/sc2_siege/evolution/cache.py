@@ -0,0 +1,132 @@
+from collections import OrderedDict
+from functools import lru_cache
+import json
+import os
+import shelve
+import typing as t
+from loguru import logger as log
+import gp
+from gp.fitness import Fitness, mean_fitness
+from sc2_evaluator.command import BUILD_AREA, build_command_queue, phenotype_key
+
+
+@lru_cache(maxsize=100_000)
+def _phenotype_key(genotype: str) -> str:
+    # Building the command queue is slower than printing the genotype
+    return phenotype_key(build_command_queue(gp.from_str(genotype), BUILD_AREA))
+
+
+class FitnessCache():
+    """Remembers the fitness of genotypes that have already been evaluated.
+
+    Genotypes are keyed by the layout they build, see `phenotype_key`, so
+    genotypes that only differ in ways the game can't see share their
+    evaluations e.g. `Q(MEEE)` and `Q(MQ(EEEE)EE)`. Recently
+    used entries are kept in an in-memory LRU, every entry is also written to
+    an optional on-disk store so the cache survives `--resume`.
+
+    The store's index is only written when it is closed, so each evaluation
+    is also appended to a journal as it completes. A run that dies without
+    closing the cache replays the journal when it is reopened and does not
+    repeat evaluations that had already finished.
+    """
+
+    def __init__(self,
+                 path: t.Optional[str] = None,
+                 max_size: int = 10_000,
+                 samples: int = 1):
+        """
+        :param path: Where to keep the on-disk store. If None the cache only
+            lives in memory.
+        :param max_size: The number of genotypes kept in memory
+        :param samples: The number of evaluations a genotype needs before its
+            cached fitness is trusted. The cached fitness is their mean.
+        """
+        self.max_size = max_size
+        self.samples = samples
+        self._lru: t.OrderedDict[str, t.List[Fitness]] = OrderedDict()
+        self._store = shelve.open(path) if path else None
+        self._journal: t.Optional[t.TextIO] = None
+        if path:
+            self._journal_path = f"{path}.journal"
+            self._replay_journal()
+            self._journal = open(self._journal_path, 'a')
+
+    @staticmethod
+    def key(genotype: gp.Gene) -> str:
+        """Return the key used to cache a genotype"""
+        return _phenotype_key(str(genotype))
+
+    def samples_of(self, key: str) -> t.List[Fitness]:
+        """Return every fitness recorded for a genotype"""
+        if key in self._lru:
+            self._lru.move_to_end(key)
+            return self._lru[key]
+        if self._store is not None and key in self._store:
+            samples = self._store[key]
+            self._remember(key, samples)
+            return samples
+        return []
+
+    def missing_samples(self, key: str) -> int:
+        """Return how many more evaluations a genotype needs"""
+        return max(0, self.samples - len(self.samples_of(key)))
+
+    def get(self, key: str) -> t.Optional[Fitness]:
+        """Return the cached fitness, or None if the genotype has not been
+        evaluated enough times"""
+        samples = self.samples_of(key)
+        if len(samples) < self.samples or len(samples) == 0:
+            return None
+        return mean_fitness(samples)
+
+    def add(self, key: str, fitness: Fitness):
+        """Record a new evaluation of a genotype"""
+        samples = self.samples_of(key) + [fitness]
+        self._remember(key, samples)
+        if self._store is not None:
+            self._store[key] = samples
+            # Journal every sample so replaying is idempotent
+            self._journal.write(json.dumps(
+                [key, [[x.time, x.minerals, x.gas] for x in samples]]) + '\n')
+            self._journal.flush()
+
+    def close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+            # Everything in the journal is now in the store
+            self._journal.close()
+            os.remove(self._journal_path)
+
+    def _replay_journal(self):
+        """Add evaluations journaled by a run that was not closed cleanly"""
+        if not os.path.exists(self._journal_path):
+            return
+        replayed = 0
+        with open(self._journal_path) as f:
+            for line in f:
+                try:
+                    key, samples = json.loads(line)
+                except json.JSONDecodeError:
+                    # Truncated by the crash
+                    break
+                self._store[key] = [Fitness(*x) for x in samples]
+                replayed += 1
+        self._store.sync()
+        os.remove(self._journal_path)
+        log.info(f"Recovered {replayed} evaluations from {self._journal_path}")
+
+    def _remember(self, key: str, samples: t.List[Fitness]):
+        self._lru[key] = samples
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.max_size:
+            self._lru.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        if self._store is not None:
+            return len(self._store)
+        return len(self._lru)
@@ -0,0 +1,139 @@
+from itertools import count
+import json
+import os
+import random
+import typing as t
+from loguru import logger as log
+import gp
+from evolution.evolution import Individual, Population
+from evolution.loggers import LogCallback
+from gp.fitness import SquashFitness
+
+
+class Checkpoint(LogCallback):
+    """Appends each generation to a JSON lines file.
+
+    An individual is written once, when it first appears, as
+    `{"id", "generation", "genotype", "fitness": [time, minerals, gas],
+    "parents", "early_stopped"}`. Each generation then ends with a record listing the ids of
+    its members and the state of `random`, so a run can be resumed exactly
+    and analysis tools can stream the file without unpickling anything.
+    """
+
+    def __init__(self, path: str, resume: bool = False):
+        """
+        :param resume: Continue the existing checkpoint. Otherwise an
+            existing checkpoint belongs to an earlier run, whose ids clash
+            with this one, and is moved aside to `path.1`, `path.2`, ...
+        """
+        self.path = path
+        self._written: t.Set[int] = set()
+        self._last_generation = -1
+        if os.path.exists(path) and not resume:
+            rotated = next(f"{path}.{i}" for i in count(1) if not os.path.exists(f"{path}.{i}"))
+            os.rename(path, rotated)
+            log.info(f"Moved the checkpoint of a previous run to {rotated}")
+        elif os.path.exists(path):
+            for record in read_records(path):
+                if 'members' in record:
+                    self._last_generation = record['generation']
+                else:
+                    self._written.add(record['id'])
+
+    def after_pop_eval(self, generation: int, population: Population):
+        if generation <= self._last_generation:
+            # Already recorded before the run was resumed
+            return
+        with open(self.path, 'a') as f:
+            for individual in population:
+                if individual.id in self._written:
+                    continue
+                self._written.add(individual.id)
+                f.write(json.dumps({
+                    'id': individual.id,
+                    'generation': generation,
+                    'genotype': str(individual.genotype),
+                    'fitness': None if individual.fitness is None else [
+                        individual.fitness.time,
+                        individual.fitness.minerals,
+                        individual.fitness.gas],
+                    'parents': list(individual.parents),
+                    'early_stopped': individual.early_stopped,
+                }) + '\n')
+            f.write(json.dumps({
+                'generation': generation,
+                'members': [individual.id for individual in population],
+                'random_state': random.getstate(),
+            }) + '\n')
+        self._last_generation = generation
+
+
+def read_records(path: str) -> t.Iterator[dict]:
+    """Stream the records of a checkpoint, ignoring a truncated last line
+    left by an interrupted run"""
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                return
+
+
+def evaluated_individuals(path: str) -> t.Iterator[Individual]:
+    """Stream every individual with a known fitness from a checkpoint.
+    Fitness that is only a lower bound from an early stopped evaluation is
+    skipped."""
+    for record in read_records(path):
+        if 'members' in record or record['fitness'] is None or record.get('early_stopped'):
+            continue
+        yield Individual(gp.from_str(record['genotype']),
+                         gp.Fitness(*record['fitness']),
+                         parents=tuple(record['parents']),
+                         id=record['id'])
+
+
+def load_generation(path: str,
+                    to_fitness_score: SquashFitness,
+                    generation: t.Optional[int] = None
+                    ) -> t.Tuple[int, Population, t.Any]:
+    """Rebuild a generation from a checkpoint.
+
+    :param generation: The generation to load, the last complete one if None
+    :return: The generation, its population and the state of `random` after
+        it was recorded
+    """
+    individuals: t.Dict[int, dict] = {}
+    found = None
+    max_id = -1
+    for record in read_records(path):
+        if 'members' not in record:
+            individuals[record['id']] = record
+            max_id = max(max_id, record['id'])
+            continue
+        if generation is None or record['generation'] == generation:
+            found = record
+        if generation is None:
+            # Only keep what the latest generation could refer to
+            members = set(record['members'])
+            individuals = {k: v for k, v in individuals.items() if k in members}
+        elif found is not None:
+            break
+    if found is None:
+        raise ValueError(f"No complete generation {generation} in {path}")
+
+    population = []
+    for member in found['members']:
+        record = individuals[member]
+        fitness = record['fitness']
+        population.append(Individual(
+            gp.from_str(record['genotype']),
+            None if fitness is None else gp.Fitness(*fitness),
+            parents=tuple(record['parents']),
+            id=record['id'],
+            early_stopped=record.get('early_stopped', False)))
+
+    # Don't reuse ids when the run continues
+    Individual._ids = count(max(max_id + 1, next(Individual._ids)))
+    version, state, gauss_next = found['random_state']
+    random_state = (version, tuple(state), gauss_next)
+    return found['generation'], Population(population, to_fitness_score), random_state
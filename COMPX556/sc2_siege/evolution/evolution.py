@@ -1,32 +1,98 @@
-from dataclasses import dataclass
+from collections import deque
+from dataclasses import dataclass, field
+from itertools import count
 import random
+import pickle
+from time import time
 from loguru import logger as log
 import typing as t
+import numpy as np
 import ray
 import gp
-from gp.fitness import Fitness, SquashFitness
-from sc2_evaluator.evaluate import evaluate as sc2_evaluate
+from config.config import Config
+from evolution.nsga import non_dominated_sort, nsga2_rank, pareto_front
+from gp.fitness import EarlyStop, SquashFitness, fitness_array, mean_fitness
+from evolution.cache import FitnessCache
+from sc2_evaluator.evaluate import Evaluator, Profile
 
 
 @dataclass
 class Individual():
     genotype: gp.Gene
     fitness: t.Optional[gp.Fitness] = None
+    parents: t.Tuple[int, ...] = field(default=(), compare=False)
+    """The ids of the individuals this one was bred from"""
+    id: int = field(default_factory=lambda: next(Individual._ids), compare=False)
+    """Unique within a run, used to record lineage in checkpoints"""
+    early_stopped: bool = field(default=False, compare=False)
+    """The fitness is only a lower bound from an evaluation that was stopped
+    early. It is never cached, so the genotype is evaluated again if it is
+    bred again."""
+
+    _ids: t.ClassVar[t.Iterator[int]] = count()
 
     def __str__(self):
         return f'Individual(genotype={self.genotype}, fitness={self.fitness})'
 
 
 class Population():
-    """The population is a set of individual genotypes"""
+    """The population is a set of individual genotypes.
+
+    Once every individual has a fitness the fitness components are kept in a
+    structured array and squashed into scores in one vector operation, so
+    selection and statistics do not re-score each individual.
+    """
 
     _population: t.List[Individual]
+    _fitness: t.Optional[np.ndarray] = None
+    _scores: t.Optional[np.ndarray] = None
+    _nsga2_rank: t.Optional[t.Tuple[np.ndarray, np.ndarray]] = None
 
     def __init__(self,
                  population: t.List[Individual],
-                 to_fitness_score: SquashFitness):
+                 to_fitness_score: SquashFitness,
+                 fitness: t.Optional[np.ndarray] = None):
+        """
+        :param fitness: The fitness of each individual as an array of
+            FITNESS_DTYPE, if already known
+        """
         self._population = population
         self.to_fitness_score = to_fitness_score
+        self._fitness = fitness
+        self._scores = None
+        self._nsga2_rank = None
+
+    def fitness(self) -> np.ndarray:
+        """Return the fitness components of every individual as a structured
+        array of FITNESS_DTYPE"""
+        if self._fitness is None:
+            self._fitness = fitness_array([x.fitness for x in self._population])
+        return self._fitness
+
+    def scores(self) -> np.ndarray:
+        """Return the squashed fitness score of every individual"""
+        if self._scores is None:
+            self._scores = self.to_fitness_score.scores(self.fitness())
+        return self._scores
+
+    def fitness_changed(self):
+        """Must be called after the fitness of an individual is changed in
+        place"""
+        self._fitness = None
+        self._scores = None
+        self._nsga2_rank = None
+
+    def _subset(self, indices: t.Sequence[int]) -> 'Population':
+        """Return a new population of the given individuals"""
+        return Population(
+            [self._population[i] for i in indices],
+            self.to_fitness_score,
+            None if self._fitness is None else self._fitness[np.asarray(indices, dtype=int)])
+
+    @staticmethod
+    def _rng() -> np.random.Generator:
+        # Seeded from `random` so seeding `random` makes runs reproducible
+        return np.random.default_rng(random.getrandbits(64))
 
     @staticmethod
     def initialize(
@@ -40,14 +106,76 @@ class Population():
 
     def select(self, selection_size: int) -> 'Population':
         """Select a subset of the population based on fitness"""
-        sorted_population = sorted(
-            self._population,
-            key=lambda x: self.to_fitness_score(x.fitness), reverse=True)
-        return Population(sorted_population[:selection_size], self.to_fitness_score)
+        scores = -self.scores()
+        if selection_size < len(self):
+            top = np.argpartition(scores, selection_size - 1)[:selection_size]
+            top = top[np.argsort(scores[top], kind='stable')]
+        else:
+            top = np.argsort(scores, kind='stable')
+        return self._subset(top)
+
+    def selection_threshold(self, selection_size: int) -> float:
+        """Return the fitness score an individual needs to be among the
+        `selection_size` fittest"""
+        scores = self.scores()
+        k = min(selection_size, len(scores))
+        return float(np.partition(scores, len(scores) - k)[len(scores) - k])
+
+    def tournament(self, selection_size: int, tournament_size: int) -> 'Population':
+        """Select individuals with replacement, each the fittest of
+        `tournament_size` randomly chosen individuals"""
+        contestants = self._rng().integers(
+            len(self), size=(selection_size, tournament_size))
+        winners = self.scores()[contestants].argmax(axis=1)
+        return self._subset(contestants[np.arange(selection_size), winners])
+
+    def roulette(self, selection_size: int) -> 'Population':
+        """Select individuals with replacement, with a probability
+        proportional to their fitness score above the least fit individual"""
+        scores = self.scores()
+        weights = scores - scores.min()
+        if weights.sum() <= 0:
+            weights = np.ones(len(self))
+        return self._subset(self._rng().choice(
+            len(self), size=selection_size, p=weights / weights.sum()))
+
+    def pareto_fronts(self) -> t.List['Population']:
+        """Split the population into its Pareto fronts, best front first"""
+        return [self._subset(front) for front in
+                non_dominated_sort(self.to_fitness_score.objectives(self.fitness()))]
+
+    def pareto_front(self) -> 'Population':
+        """Return the non-dominated individuals. Reuses the NSGA-II ranks if
+        they have been computed, otherwise only the first front is found."""
+        if self._nsga2_rank is not None:
+            return self._subset(np.flatnonzero(self._nsga2_rank[0] == 0))
+        return self._subset(pareto_front(self.to_fitness_score.objectives(self.fitness())))
+
+    def nsga2_rank(self) -> t.Tuple[np.ndarray, np.ndarray]:
+        """Return the Pareto front index and crowding distance of every
+        individual, computed once per population"""
+        if self._nsga2_rank is None:
+            self._nsga2_rank = nsga2_rank(self.to_fitness_score.objectives(self.fitness()))
+        return self._nsga2_rank
+
+    def nsga2(self, selection_size: int) -> 'Population':
+        """Select the best individuals by Pareto front and then crowding
+        distance, using the fitness components as separate objectives"""
+        rank, distance = self.nsga2_rank()
+        order = np.lexsort((-distance, rank))
+        return self._subset(order[:selection_size])
+
+    def crowded_tournament(self, selection_size: int) -> 'Population':
+        """NSGA-II binary tournament: the winner has the better front, ties
+        are broken by the larger crowding distance"""
+        rank, distance = self.nsga2_rank()
+        a, b = self._rng().integers(len(self), size=(2, selection_size))
+        a_wins = (rank[a] < rank[b]) | ((rank[a] == rank[b]) & (distance[a] >= distance[b]))
+        return self._subset(np.where(a_wins, a, b))
 
     def sample(self, sample_size: int) -> 'Population':
         """Sample a subset of the population with replacement"""
-        return Population(random.choices(self._population, k=sample_size), self.to_fitness_score)
+        return self._subset(random.choices(range(len(self)), k=sample_size))
 
     def stochastic_mutate(self, func: t.Callable[[gp.Gene], gp.Gene], probability: float) -> 'Population':
         """Apply a function to a random subset of the population"""
@@ -55,7 +183,8 @@ class Population():
         for individual in self._population:
             if random.random() < probability:
                 try:
-                    individual = Individual(func(individual.genotype))
+                    individual = Individual(
+                        func(individual.genotype), parents=(individual.id,))
                 except gp.BadGenotype:
                     # Skip failed cross over attempts
                     pass
@@ -67,10 +196,12 @@ class Population():
         new_population = []
         for individual in self._population:
             if random.random() < probability:
-                parent_a = individual.genotype
-                parent_b = random.choice(self._population).genotype
+                parent_a = individual
+                parent_b = random.choice(self._population)
                 try:
-                    individual = Individual(func(parent_a, parent_b))
+                    individual = Individual(
+                        func(parent_a.genotype, parent_b.genotype),
+                        parents=(parent_a.id, parent_b.id))
                 except gp.BadGenotype:
                     # Skip failed cross over attempts
                     pass
@@ -78,6 +209,84 @@ class Population():
             new_population.append(individual)
         return Population(new_population, self.to_fitness_score)
 
+    def offspring(self,
+                  mutate: t.Callable[[gp.Gene], gp.Gene],
+                  mutation_probability: float,
+                  sex: t.Callable[[gp.Gene, gp.Gene], gp.Gene],
+                  sex_probability: float) -> Individual:
+        """Breed a single offspring the same way `sample`, `stochastic_mutate`
+        and `stochastic_sex` breed a whole generation"""
+        parent = individual = random.choice(self._population)
+        if random.random() < mutation_probability:
+            try:
+                individual = Individual(
+                    mutate(individual.genotype), parents=(parent.id,))
+            except gp.BadGenotype:
+                pass
+        if random.random() < sex_probability:
+            parent_b = random.choice(self._population)
+            try:
+                individual = Individual(
+                    sex(individual.genotype, parent_b.genotype),
+                    parents=(parent.id, parent_b.id))
+            except gp.BadGenotype:
+                pass
+        return individual
+
+    def unique_offspring(self,
+                         size: int,
+                         mutate: t.Callable[[gp.Gene], gp.Gene],
+                         mutation_probability: float,
+                         sex: t.Callable[[gp.Gene, gp.Gene], gp.Gene],
+                         sex_probability: float,
+                         key: t.Callable[[gp.Gene], str],
+                         attempts: int) -> 'Population':
+        """Breed up to `size` offspring that all have different keys,
+        giving up after `attempts` offspring have been bred"""
+        children: t.List[Individual] = []
+        seen: t.Set[str] = set()
+        for _ in range(attempts):
+            if len(children) == size:
+                break
+            child = self.offspring(mutate, mutation_probability, sex, sex_probability)
+            child_key = key(child.genotype)
+            if child_key not in seen:
+                seen.add(child_key)
+                children.append(child)
+        return Population(children, self.to_fitness_score)
+
+    def diversity(self,
+                  key: t.Callable[[gp.Gene], str],
+                  max_pairs: int = 500) -> t.Dict[str, float]:
+        """Return the number of distinct keys and the mean `tree_distance`
+        between individuals, estimated from at most `max_pairs` pairs"""
+        n = len(self)
+        if n > 1 and n * (n - 1) // 2 > max_pairs:
+            # A fixed seed so logging doesn't change the course of a run
+            pairs = np.random.default_rng(0).integers(n, size=(max_pairs, 2))
+            pairs = pairs[pairs[:, 0] != pairs[:, 1]]
+        else:
+            pairs = np.array([(i, j) for i in range(n) for j in range(i + 1, n)]).reshape(-1, 2)
+        distances = [gp.tree_distance(self._population[i].genotype, self._population[j].genotype)
+                     for i, j in pairs]
+        unique = len({key(x.genotype) for x in self._population})
+        return {
+            'diversity/unique': unique,
+            'diversity/unique_fraction': unique / n if n else 0,
+            'diversity/tree_distance': float(np.mean(distances)) if distances else 0,
+        }
+
+    def replace_worst(self, individual: Individual) -> 'Population':
+        """Add an evaluated individual in place of the least fit individual"""
+        worst = int(self.scores().argmin())
+        if self.to_fitness_score(individual.fitness) < self.scores()[worst]:
+            return self
+        new_population = list(self._population)
+        new_population[worst] = individual
+        fitness = self.fitness().copy()
+        fitness[worst] = fitness_array([individual.fitness])[0]
+        return Population(new_population, self.to_fitness_score, fitness)
+
     def __iter__(self) -> t.Iterator[Individual]:
         return self._population.__iter__()
 
@@ -85,66 +294,564 @@ class Population():
         return len(self._population)
 
     def sum_fitness(self) -> float:
-        return sum([self.to_fitness_score(x.fitness) for x in self._population])
+        return float(self.scores().sum())
 
     def average_fitness_score(self) -> float:
-        return self.sum_fitness() / len(self)
+        return float(self.scores().mean())
 
     def best_fitness_score(self) -> float:
-        return max([self.to_fitness_score(x.fitness) for x in self._population])
+        return float(self.scores().max())
 
     def average_minerals(self) -> float:
-        return sum([x.fitness.minerals for x in self._population])/len(self)
+        return float(self.fitness()['minerals'].mean())
 
     def average_gas(self) -> float:
-        return sum([x.fitness.gas for x in self._population])/len(self)
+        return float(self.fitness()['gas'].mean())
 
     def average_time(self) -> float:
-        return sum([x.fitness.time for x in self._population])/len(self)
+        return float(self.fitness()['time'].mean())
 
     def best_individual(self) -> Individual:
-        best_fitness: float = None
-        best: Individual = None
-        for individual in self._population:
-            fitness = self.to_fitness_score(individual.fitness)
-            if best_fitness == None or fitness > best_fitness:
-                best_fitness = fitness
-                best = individual
-        return best
+        return self._population[int(self.scores().argmax())]
+
+
+SELECTIONS = ["truncation", "tournament", "roulette", "nsga2"]
+
+
+def next_generation(population: Population,
+                    cfg: Config,
+                    mutate: t.Callable[[gp.Gene], gp.Gene],
+                    sex: t.Callable[[gp.Gene, gp.Gene], gp.Gene]) -> Population:
+    """Select parents with `cfg.selection` and breed the next generation"""
+    if cfg.selection == "tournament":
+        parents = population.tournament(cfg.population_size, cfg.tournament_size)
+    elif cfg.selection == "nsga2":
+        parents = population.nsga2(cfg.selection_size)
+        parents = parents.crowded_tournament(cfg.population_size)
+    elif cfg.selection == "roulette":
+        parents = population.roulette(cfg.population_size)
+    else:
+        parents = population.select(cfg.selection_size)
+        if not cfg.unique_offspring:
+            parents = parents.sample(cfg.population_size)
+    if cfg.unique_offspring:
+        return unique_generation(population, parents, cfg, mutate, sex)
+    parents = parents.stochastic_mutate(mutate, cfg.mutation_probability)
+    return parents.stochastic_sex(sex, cfg.sex_probability)
+
+
+def unique_generation(population: Population,
+                      parents: Population,
+                      cfg: Config,
+                      mutate: t.Callable[[gp.Gene], gp.Gene],
+                      sex: t.Callable[[gp.Gene, gp.Gene], gp.Gene]) -> Population:
+    """Breed a generation where no two individuals build the same layout.
+
+    When fewer than `cfg.min_diversity` of the evaluated population are
+    distinct, `cfg.immigrants` slots go to new random genotypes. So do any
+    slots the breeding budget could not fill with distinct offspring.
+    """
+    key = FitnessCache.key
+    attempts = cfg.breed_attempts * cfg.population_size
+    unique = len({key(x.genotype) for x in population})
+    immigrants = cfg.immigrants if unique < cfg.min_diversity * len(population) else 0
+    offspring = parents.unique_offspring(
+        cfg.population_size - immigrants, mutate, cfg.mutation_probability,
+        sex, cfg.sex_probability, key, attempts)
+
+    seen = {key(x.genotype) for x in offspring}
+    newcomers: t.List[Individual] = []
+    for _ in range(attempts):
+        if len(offspring) + len(newcomers) >= cfg.population_size:
+            break
+        immigrant = Individual(gp.initialise_genotype(cfg.init_depth))
+        immigrant_key = key(immigrant.genotype)
+        if immigrant_key not in seen:
+            seen.add(immigrant_key)
+            newcomers.append(immigrant)
+    if newcomers:
+        log.info(f"Added {len(newcomers)} immigrants, {unique} of "
+                 f"{len(population)} evaluated individuals were distinct")
+    return Population(offspring._population + newcomers, population.to_fitness_score)
+
+
+def early_stop_for(population: Population, cfg: Config) -> t.Optional[EarlyStop]:
+    """Return the early stop policy for the offspring of an evaluated
+    population: stop once they cannot be selected from it. Only truncation
+    selection has a hard threshold."""
+    if not cfg.early_stop or cfg.selection != "truncation":
+        return None
+    return EarlyStop(population.to_fitness_score,
+                     population.selection_threshold(cfg.selection_size))
+
+
+Job = t.Tuple[str, gp.Gene]
+"""A genotype to evaluate and the key its fitness is cached under"""
+FAILURES = ('attempts', 'errors', 'timeouts', 'retries', 'given_up', 'quarantined',
+            'replaced_hung')
+"""The kinds of failed evaluation counted by `PopulationEvaluator`"""
+
+
+def _try_evaluate(evaluator: Evaluator,
+                  genotype: gp.Gene,
+                  early_stop: t.Optional[EarlyStop] = None
+                  ) -> t.Tuple[t.Optional[gp.Fitness], Profile]:
+    started = time()
+    try:
+        fitness, profile = evaluator.evaluate_profiled(genotype, early_stop)
+    except Exception as e:
+        log.error(f"Failed to evaluate genotype: {e}")
+        fitness, profile = None, {}
+    profile['evaluate'] = time() - started
+    return fitness, profile
+
+
+def _try_evaluate_batch(evaluator: Evaluator,
+                        genotypes: t.List[gp.Gene],
+                        early_stop: t.Optional[EarlyStop] = None
+                        ) -> t.List[t.Tuple[t.Optional[gp.Fitness], Profile]]:
+    """Evaluate the genotypes together if the evaluator is batched, otherwise
+    one at a time. A failed batch is retried one at a time to find the
+    genotypes that fail."""
+    if not evaluator.batched:
+        return [_try_evaluate(evaluator, genotype, early_stop) for genotype in genotypes]
+    started = time()
+    try:
+        results = evaluator.evaluate_batch(genotypes, early_stop)
+    except Exception as e:
+        log.error(f"Failed to evaluate a batch of {len(genotypes)} genotypes: {e}")
+        return [_try_evaluate(evaluator, genotype, early_stop) for genotype in genotypes]
+    for _, profile in results:
+        profile['evaluate'] = (time() - started) / len(results)
+    return results
+
+
+def _evaluate_batch(evaluator: Evaluator,
+                    genotypes: t.List[str],
+                    early_stop: t.Optional[EarlyStop] = None
+                    ) -> t.List[t.Tuple[t.Optional[gp.Fitness], Profile]]:
+    """Evaluate genotypes sent as strings, which are far smaller to
+    serialise than `Gene` trees"""
+    return _try_evaluate_batch(
+        evaluator, [gp.from_str(genotype) for genotype in genotypes], early_stop)
+
+
+@ray.remote
+def evaluate_genotypes(evaluator: Evaluator,
+                       genotypes: t.List[str],
+                       early_stop: t.Optional[EarlyStop] = None
+                       ) -> t.List[t.Tuple[t.Optional[gp.Fitness], Profile]]:
+    return _evaluate_batch(evaluator, genotypes, early_stop)
+
+
+@ray.remote(max_restarts=-1)
+class EvaluatorWorker():
+    """A long lived ray actor that owns its own copy of an evaluator, e.g. a
+    running SC2 process. If the actor crashes ray restarts it.
+    """
+
+    def __init__(self, evaluator: Evaluator) -> None:
+        self.evaluator = evaluator
+
+    def evaluate_genotypes(self,
+                           genotypes: t.List[str],
+                           early_stop: t.Optional[EarlyStop] = None
+                           ) -> t.List[t.Tuple[t.Optional[gp.Fitness], Profile]]:
+        return _evaluate_batch(self.evaluator, genotypes, early_stop)
+
+    def healthy(self) -> bool:
+        return self.evaluator.healthy()
 
 
 class PopulationEvaluator():
 
     def __init__(self,
-                 win_timeout: float,
-                 ready_time_limit: float
+                 evaluator: Evaluator,
+                 cache: t.Optional[FitnessCache] = None,
+                 num_workers: int = 0,
+                 health_check_timeout: float = 60,
+                 batch_size: int = 1,
+                 timeout: t.Optional[float] = None,
+                 retries: int = 0,
+                 quarantine_after: int = 3
                  ) -> None:
-        self.win_timeout = win_timeout
-        self.ready_time_limit = ready_time_limit
+        """
+        :param evaluator: Scores each genotype
+        :param num_workers: The number of long lived workers that each keep
+            a copy of the evaluator. If 0 every evaluation is a separate ray
+            task.
+        :param health_check_timeout: How long a worker has to respond to a
+            health check before it is replaced
+        :param batch_size: The most genotypes sent to a worker or task at
+            once, to amortise the scheduling overhead of quick evaluations
+        :param timeout: The wall clock seconds a remote evaluation may take
+            before it is cancelled, or None to wait forever
+        :param retries: How many times a failed evaluation of a genotype is
+            retried before it is given up on
+        :param quarantine_after: The number of batches in a row a worker may
+            fail before it is killed and replaced
+        """
+        self.evaluator = evaluator
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.retries = retries
+        self.quarantine_after = quarantine_after
+        self.failures: t.Dict[str, int] = dict.fromkeys(FAILURES, 0)
+        """Counts of failed evaluations since `failure_stats` was called"""
+        self._evaluator_ref: t.Optional[ray.ObjectRef] = None
+        self.serialised_bytes: t.Dict[str, int] = {
+            'evaluator': 0, 'genotypes': 0, 'results': 0}
+        """Bytes serialised for remote evaluations since `evaluate` was
+        last called"""
+        self.cache = cache if cache is not None else FitnessCache()
+        self.health_check_timeout = health_check_timeout
+        self.workers = [self._spawn_worker() for _ in range(num_workers)]
+        self._strikes = [0] * num_workers
+        """The number of batches in a row each worker has failed"""
+        self.stats: t.Dict[str, float] = {}
+        """Statistics about the last call to evaluate"""
+        self.busy_time: float = 0
+        """The total time spent evaluating genotypes"""
+        self.profiles: t.List[Profile] = []
+        """The profiles of evaluations since `profile_stats` was called"""
+        self.early_stop: t.Optional[EarlyStop] = None
+        """Passed to evaluations as they are submitted, so they can stop
+        once they cannot reach the selection threshold"""
+
+    def _spawn_worker(self) -> EvaluatorWorker:
+        return EvaluatorWorker.remote(self.evaluator)
+
+    def _replace_worker(self, i: int):
+        ray.kill(self.workers[i], no_restart=True)
+        self.workers[i] = self._spawn_worker()
+        self._strikes[i] = 0
+
+    def check_workers(self) -> int:
+        """Replace workers that do not respond to a health check. Returns the
+        number of replaced workers."""
+        replaced = 0
+        checks = [worker.healthy.remote() for worker in self.workers]
+        for i, check in enumerate(checks):
+            try:
+                healthy = ray.get(check, timeout=self.health_check_timeout)
+            except ray.exceptions.RayError as e:
+                log.warning(f"Worker {i} failed health check: {e}")
+                healthy = False
+            if not healthy:
+                self._replace_worker(i)
+                replaced += 1
+        return replaced
+
+    @property
+    def num_slots(self) -> int:
+        """The number of evaluations that can run at the same time"""
+        if not self.evaluator.remote:
+            return 1
+        if self.workers:
+            return len(self.workers)
+        return max(1, int(ray.cluster_resources().get("CPU", 1)))
+
+    def utilisation(self, busy_time: float, wall_time: float) -> float:
+        """The fraction of the available evaluation slots that were busy"""
+        if wall_time <= 0:
+            return 0
+        return busy_time / (self.num_slots * wall_time)
+
+    def serialisation_stats(self) -> t.Dict[str, float]:
+        """Return the bytes serialised for remote evaluations, then reset
+        the counts"""
+        stats = {f'serialisation/{name}_bytes': value
+                 for name, value in self.serialised_bytes.items()}
+        self.serialised_bytes = dict.fromkeys(self.serialised_bytes, 0)
+        return stats
+
+    def failure_stats(self) -> t.Dict[str, float]:
+        """Return the counts of failed evaluations and the fraction of
+        attempts that failed, then reset the counts"""
+        failures = self.failures
+        stats: t.Dict[str, float] = {
+            f'failures/{name}': value for name, value in failures.items()
+            if name not in ('attempts', 'quarantined', 'replaced_hung')}
+        stats['failures/rate'] = (failures['errors'] + failures['timeouts']) / \
+            failures['attempts'] if failures['attempts'] else 0
+        stats['workers/quarantined'] = failures['quarantined']
+        stats['workers/replaced_hung'] = failures['replaced_hung']
+        self.failures = dict.fromkeys(FAILURES, 0)
+        return stats
+
+    def profile_stats(self) -> t.Dict[str, float]:
+        """Summarise the recorded evaluation profiles as the mean, 90th
+        percentile and maximum of each timing, then forget them"""
+        stats = {}
+        for name in sorted(set().union(*self.profiles)):
+            values = np.array([x[name] for x in self.profiles if name in x], dtype=float)
+            stats[f'profile/{name}/mean'] = float(values.mean())
+            stats[f'profile/{name}/p90'] = float(np.percentile(values, 90))
+            stats[f'profile/{name}/max'] = float(values.max())
+        self.profiles = []
+        return stats
+
+    def _run(self, jobs: t.Deque[Job]
+             ) -> t.Iterator[t.Tuple[str, t.Optional[gp.Fitness], bool]]:
+        """Evaluate each (key, genotype) job yielding the key, fitness and
+        whether the evaluation was stopped early, in the order they
+        complete. Jobs appended to the queue while iterating are evaluated
+        as soon as an evaluation slot is free. A fitness from an evaluation
+        stopped early is only a lower bound and must not be cached.
+
+        An evaluation that raises, times out or loses its worker is an
+        infrastructure failure rather than a score. It is retried up to
+        `retries` times and then yielded with a fitness of None.
+        """
+        attempts: t.Dict[str, int] = {}
+
+        def _failed(key: str, genotype: gp.Gene) -> bool:
+            """Queue the job again if it has retries left"""
+            attempts[key] = attempts.get(key, 0) + 1
+            if attempts[key] <= self.retries:
+                self.failures['retries'] += 1
+                jobs.append((key, genotype))
+                return True
+            self.failures['given_up'] += 1
+            log.error(f"Giving up on {genotype} after {attempts[key]} failed evaluations")
+            return False
 
-    @ray.remote
-    def evaluate_genotype(self, genotype: gp.Gene) -> gp.Fitness:
+        if not self.evaluator.remote:
+            # Evaluations in this process can't be interrupted, so there is
+            # no timeout. A batched evaluator gets every queued job at once
+            while jobs:
+                batch = [jobs.popleft() for _ in range(len(jobs) if self.evaluator.batched else 1)]
+                started = time()
+                results = _try_evaluate_batch(
+                    self.evaluator, [genotype for _, genotype in batch], self.early_stop)
+                self.busy_time += time() - started
+                for (key, genotype), (fitness, profile) in zip(batch, results):
+                    self.profiles.append(profile)
+                    self.failures['attempts'] += 1
+                    if fitness is None:
+                        self.failures['errors'] += 1
+                        if _failed(key, genotype):
+                            continue
+                    yield key, fitness, bool(profile.get('early_stopped'))
+            return
+
+        if self._evaluator_ref is None and not self.workers:
+            # Put the evaluator in the object store once, rather than
+            # serialising it with every task
+            self._evaluator_ref = ray.put(self.evaluator)
+            self.serialised_bytes['evaluator'] += len(pickle.dumps(self.evaluator))
+
+        # Without workers each batch is a ray task, at most one per CPU so
+        # that the time between submission and completion is busy time.
+        # With workers a slot is the index of a worker.
+        idle: t.List[t.Optional[int]] = list(range(len(self.workers))) \
+            if self.workers else [None] * self.num_slots
+        running: t.Dict[ray.ObjectRef,
+                        t.Tuple[t.Optional[int], t.List[Job], float]] = {}
+        while jobs or running:
+            while idle and jobs:
+                slot = idle.pop()
+                batch = [jobs.popleft() for _ in range(min(self.batch_size, len(jobs)))]
+                genotypes = [str(genotype) for _, genotype in batch]
+                self.serialised_bytes['genotypes'] += len(pickle.dumps(genotypes))
+                if slot is None:
+                    ref = evaluate_genotypes.remote(
+                        self._evaluator_ref, genotypes, self.early_stop)
+                else:
+                    ref = self.workers[slot].evaluate_genotypes.remote(
+                        genotypes, self.early_stop)
+                running[ref] = (slot, batch, time())
+                self.failures['attempts'] += len(batch)
+
+            wait_for = None
+            if self.timeout is not None:
+                deadline = min(started + self.timeout * len(batch)
+                               for _, batch, started in running.values())
+                wait_for = max(0, deadline - time())
+            ready, _ = ray.wait(list(running), num_returns=1, timeout=wait_for)
+            if not ready:
+                for ref in self._cancel_overdue(running):
+                    slot, batch, started = running.pop(ref)
+                    self.busy_time += time() - started
+                    idle.append(slot)
+                    for key, genotype in batch:
+                        if not _failed(key, genotype):
+                            yield key, None, False
+                continue
+
+            [ref] = ready
+            slot, batch, started = running.pop(ref)
+            elapsed = time() - started
+            self.busy_time += elapsed
+            idle.append(slot)
+            try:
+                results = ray.get(ref)
+            except ray.exceptions.RayError as e:
+                # The worker crashed, ray restarts it but the evaluations
+                # are lost
+                log.error(f"Evaluation task failed: {e}")
+                results = [(None, None)] * len(batch)
+            else:
+                self.serialised_bytes['results'] += len(pickle.dumps(results))
+                # Time spent scheduling the task and moving its arguments
+                scheduling = elapsed - sum(profile['evaluate'] for _, profile in results)
+                for _, profile in results:
+                    profile['scheduling'] = scheduling / len(results)
+                    self.profiles.append(profile)
+
+            failed = False
+            for (key, genotype), (fitness, profile) in zip(batch, results):
+                if fitness is None:
+                    failed = True
+                    self.failures['errors'] += 1
+                    if _failed(key, genotype):
+                        continue
+                yield key, fitness, bool(profile and profile.get('early_stopped'))
+            if slot is not None:
+                self._strike(slot, failed)
+
+    def _cancel_overdue(self,
+                        running: t.Dict[ray.ObjectRef,
+                                        t.Tuple[t.Optional[int], t.List[Job], float]]
+                        ) -> t.List[ray.ObjectRef]:
+        """Cancel the evaluations that have run past their timeout, killing
+        the processes running them. Returns the cancelled references."""
+        overdue = []
+        now = time()
+        for ref, (slot, batch, started) in running.items():
+            if now - started < self.timeout * len(batch):
+                continue
+            log.error(f"Evaluation of {len(batch)} genotypes timed out after "
+                      f"{now - started:.0f}s")
+            self.failures['timeouts'] += len(batch)
+            overdue.append(ref)
+            if slot is None:
+                ray.cancel(ref, force=True)
+            else:
+                # A hung actor can't run anything else, so start a new one
+                self._replace_worker(slot)
+                self.failures['replaced_hung'] += 1
+        return overdue
+
+    def _strike(self, slot: int, failed: bool):
+        """Quarantine a worker that keeps failing by replacing it"""
+        self._strikes[slot] = self._strikes[slot] + 1 if failed else 0
+        if self._strikes[slot] >= self.quarantine_after:
+            log.warning(f"Quarantining worker {slot} after "
+                        f"{self._strikes[slot]} failed batches in a row")
+            self._replace_worker(slot)
+            self.failures['quarantined'] += 1
+
+    def jobs_for(self, individual: Individual) -> t.List[Job]:
+        """Return the evaluations needed before the individual's fitness is
+        known"""
+        key = self.cache.key(individual.genotype)
+        return [(key, individual.genotype)
+                for _ in range(self.cache.missing_samples(key))]
+
+    def resolve(self, individual: Individual) -> bool:
+        """Set the individual's fitness from the cache. Returns False if
+        every evaluation of its genotype failed, leaving the fitness None."""
+        samples = self.cache.samples_of(self.cache.key(individual.genotype))
+        if not samples:
+            return False
+        individual.fitness = mean_fitness(samples)
+        individual.early_stopped = False
+        return True
+
+    def reevaluate(self, individuals: t.Sequence[Individual]) -> int:
+        """Evaluate each distinct genotype once more, then update the fitness
+        of the individuals to the mean of every sample. Returns the number
+        of successful evaluations. These evaluations are never stopped
+        early, a genotype whose first evaluation was gets an exact fitness."""
+        jobs: t.Deque[Job] = deque()
+        queued: t.Set[str] = set()
+        for individual in individuals:
+            key = self.cache.key(individual.genotype)
+            if key not in queued:
+                queued.add(key)
+                jobs.append((key, individual.genotype))
+        completed = 0
+        early_stop, self.early_stop = self.early_stop, None
         try:
-            return sc2_evaluate(genotype, realtime=False, win_timeout=self.win_timeout, ready_time_limit=self.ready_time_limit)
-        except Exception as e:
-            log.error(f"Failed to evaluate genotype: {e}")
-            return Fitness(0, 0, 0)
+            for key, fitness, early_stopped in self._run(jobs):
+                if fitness is not None and not early_stopped:
+                    self.cache.add(key, fitness)
+                    completed += 1
+        finally:
+            self.early_stop = early_stop
+        for individual in individuals:
+            self.resolve(individual)
+        return completed
 
     def evaluate(self, population: Population) -> Population:
-        """Evaluate the fitness of all genotypes in the population"""
-        fitness_ref = []
+        """Evaluate the fitness of all genotypes in the population. Genotypes
+        that are already in the cache are not evaluated again.
+        """
+        jobs: t.Deque[Job] = deque()
+        queued: t.Set[str] = set()
+        hits, misses = 0, 0
+
+        replaced = self.check_workers()
+        start, busy_time = time(), self.busy_time
 
         log.info("Launching evaluation of population")
         for individual in population._population:
-            if individual.fitness is None:
-                fitness_ref.append(
-                    self.evaluate_genotype.remote(self, individual.genotype))
-            else:
-                fitness_ref.append(ray.put(individual.fitness))
+            # A lower bound from an early stopped evaluation isn't reused
+            if individual.fitness is not None and not individual.early_stopped:
+                continue
+            key = self.cache.key(individual.genotype)
+            if key in queued or key in self.cache:
+                hits += 1
+                continue
+            misses += 1
+            queued.add(key)
+            jobs.extend(self.jobs_for(individual))
 
         log.info("Waiting for evaluation to complete")
-        for i, ref in enumerate(fitness_ref):
-            population._population[i].fitness = ray.get(ref)
+        bounds: t.Dict[str, gp.Fitness] = {}
+        """The lower bounds of genotypes that were stopped early"""
+        for key, fitness, early_stopped in self._run(jobs):
+            # Failed evaluations are not cached so they can be retried
+            if fitness is None:
+                continue
+            if early_stopped:
+                bounds[key] = fitness
+            else:
+                self.cache.add(key, fitness)
+
+        failed = []
+        for individual in population._population:
+            if (individual.fitness is not None and not individual.early_stopped) or \
+                    self.resolve(individual):
+                continue
+            key = self.cache.key(individual.genotype)
+            if key in bounds:
+                individual.fitness = bounds[key]
+                individual.early_stopped = True
+            else:
+                failed.append(individual)
+        if failed:
+            # Dropping them is fairer than scoring a crashed game as zero,
+            # the next generation is bred back to full size
+            log.warning(f"Dropping {len(failed)} individuals that could not be evaluated")
+            failed_ids = {id(x) for x in failed}
+            survivors = [x for x in population._population if id(x) not in failed_ids]
+            if not survivors:
+                raise RuntimeError("Every evaluation in the population failed")
+            population = Population(survivors, population.to_fitness_score)
+        population.fitness_changed()
 
-        log.info("Evaluation complete")
+        self.stats = {
+            'cache/hits': hits,
+            'cache/misses': misses,
+            'cache/size': len(self.cache),
+            'early_stop/stopped': len(bounds),
+            'workers/replaced': replaced,
+            'workers/utilisation': self.utilisation(self.busy_time - busy_time, time() - start),
+            **self.failure_stats(),
+            **self.profile_stats(),
+            **self.serialisation_stats(),
+        }
+        log.info(f"Evaluation complete (cache hits: {hits}, misses: {misses})")
         return population
@@ -0,0 +1,189 @@
+from copy import copy
+from itertools import chain, count
+import random
+import typing as t
+from loguru import logger as log
+import ray
+import gp
+from config.config import Config
+from evolution.cache import FitnessCache
+from evolution.evolution import Individual, Population, PopulationEvaluator, early_stop_for, next_generation
+from evolution.racing import Racing
+from sc2_evaluator.evaluate import Evaluator
+
+TOPOLOGIES = ["ring", "fully_connected", "isolated"]
+
+
+def migration_sources(topology: str, num_islands: int) -> t.List[t.List[int]]:
+    """Return the islands that send emigrants to each island"""
+    if topology == "ring":
+        return [[(i - 1) % num_islands] if num_islands > 1 else []
+                for i in range(num_islands)]
+    elif topology == "fully_connected":
+        return [[j for j in range(num_islands) if j != i]
+                for i in range(num_islands)]
+    elif topology == "isolated":
+        return [[] for _ in range(num_islands)]
+    raise ValueError(f"Unknown migration topology {topology}")
+
+
+def split(total: int, parts: int) -> t.List[int]:
+    """Split a total into near equal parts, the first parts get the
+    remainder"""
+    return [total // parts + (i < total % parts) for i in range(parts)]
+
+
+@ray.remote
+class Island():
+    """A sub-population evolving independently with its own
+    `PopulationEvaluator`"""
+
+    def __init__(self,
+                 index: int,
+                 num_islands: int,
+                 individuals: t.List[Individual],
+                 cfg: Config,
+                 evaluator: Evaluator,
+                 cache_path: t.Optional[str],
+                 num_workers: int,
+                 seed: int,
+                 first_id: int):
+        random.seed(seed)
+        # Interleave ids so individuals from different islands never clash
+        Individual._ids = count(first_id + index, num_islands)
+        self.cfg = cfg
+        self.population = Population(individuals, cfg.fitness_scorer())
+        self.pop_eval = PopulationEvaluator(
+            evaluator,
+            FitnessCache(cache_path, cfg.fitness_cache_size, cfg.fitness_samples),
+            num_workers=num_workers,
+            batch_size=cfg.evaluation_batch_size,
+            timeout=cfg.evaluation_timeout,
+            retries=cfg.evaluation_retries,
+            quarantine_after=cfg.quarantine_failures)
+        self.racing = Racing(self.pop_eval, cfg.selection_size, cfg.racing_budget,
+                             cfg.racing_max_samples, cfg.racing_confidence)
+        self.mutator = gp.SubtreeMutator(cfg.mutant_tree_depth)
+        self.crossover = gp.SubtreeCrossover()
+
+    @ray.method(num_returns=2)
+    def epoch(self,
+              generations: int,
+              *immigrants: t.List[Individual]
+              ) -> t.Tuple[t.List[Individual], t.List[t.List[Individual]]]:
+        """Evolve for a number of generations.
+
+        :param immigrants: The emigrants of each source island, they replace
+            the least fit individuals of the first generation
+        :return: The emigrants of this island and the individuals of each
+            evaluated generation
+        """
+        generations_seen = []
+        for generation in range(generations):
+            self.population = self.pop_eval.evaluate(self.population)
+            if self.cfg.racing_budget > 0:
+                self.population = self.racing.race(self.population)
+            if generation == 0:
+                for individual in chain(*immigrants):
+                    self.population = self.population.replace_worst(individual)
+            generations_seen.append(list(self.population))
+            self.pop_eval.early_stop = early_stop_for(self.population, self.cfg)
+            if generation < generations - 1:
+                self.population = next_generation(
+                    self.population, self.cfg, self.mutator.mutate, self.crossover.crossover)
+
+        emigrants = list(self.population.select(self.cfg.migration_size))
+        self.population = next_generation(
+            self.population, self.cfg, self.mutator.mutate, self.crossover.crossover)
+        return emigrants, generations_seen
+
+    def close(self):
+        self.pop_eval.cache.close()
+
+
+class IslandModel():
+    """Evolves several sub-populations in parallel as Ray actors.
+
+    Every `migration_interval` generations each island sends its fittest
+    individuals to its neighbours in the migration topology. The epochs are
+    chained through Ray object references, so an island only waits for the
+    islands it receives emigrants from rather than for every island.
+    """
+
+    def __init__(self,
+                 cfg: Config,
+                 evaluator: Evaluator,
+                 num_islands: int,
+                 num_workers: int = 0):
+        """
+        :param cfg: The configuration of the whole run. The population size,
+            selection size and immigrants are shared between the islands.
+        :param num_workers: The number of evaluator workers of each island
+        """
+        if cfg.racing_budget > 0 and cfg.selection != "truncation":
+            raise ValueError(
+                f"Racing only supports truncation selection, not {cfg.selection}")
+        self.cfg = cfg
+        self.evaluator = evaluator
+        self.num_islands = num_islands
+        self.num_workers = num_workers
+        self.island_cfgs = []
+        for population_size, selection_size, immigrants in zip(
+                split(cfg.population_size, num_islands), split(cfg.selection_size, num_islands),
+                split(cfg.immigrants, num_islands)):
+            island_cfg = copy(cfg)
+            island_cfg.population_size = max(1, population_size)
+            island_cfg.selection_size = max(1, selection_size)
+            island_cfg.immigrants = immigrants
+            self.island_cfgs.append(island_cfg)
+
+    def run(self,
+            population: Population,
+            start_generation: int,
+            generations: int,
+            after_generation: t.Callable[[int, Population], None]) -> Population:
+        """Split the population between the islands and evolve them until
+        `generations`. `after_generation` sees every island combined."""
+        cfg = self.cfg
+        sizes = [island_cfg.population_size for island_cfg in self.island_cfgs]
+        starts = [sum(sizes[:i]) for i in range(self.num_islands)]
+        first_id = next(Individual._ids)
+        islands = [
+            Island.options(
+                num_cpus=0 if self.evaluator.remote else 1,
+                scheduling_strategy="SPREAD"
+            ).remote(
+                i, self.num_islands,
+                population._population[starts[i]:starts[i] + sizes[i]],
+                self.island_cfgs[i], self.evaluator,
+                f"{cfg.fitness_cache}.island{i}" if cfg.fitness_cache else None,
+                self.num_workers, random.getrandbits(64), first_id)
+            for i in range(self.num_islands)]
+        sources = migration_sources(cfg.migration_topology, self.num_islands)
+        log.info(f"Evolving {self.num_islands} islands of {sizes} individuals")
+
+        # Submit every epoch up front, each waits only on its sources
+        emigrants: t.List[t.Any] = [[] for _ in islands]
+        epochs = []
+        generation = start_generation
+        while generation < generations:
+            length = min(cfg.migration_interval, generations - generation)
+            results = [island.epoch.remote(length, *[emigrants[j] for j in sources[i]])
+                       for i, island in enumerate(islands)]
+            emigrants = [result[0] for result in results]
+            epochs.append((generation, [result[1] for result in results]))
+            generation += length
+
+        to_fitness_score = cfg.fitness_scorer()
+        for first_generation, snapshots in epochs:
+            per_island = ray.get(snapshots)
+            for offset, generation_individuals in enumerate(zip(*per_island)):
+                population = Population(
+                    list(chain(*generation_individuals)), to_fitness_score)
+                after_generation(first_generation + offset, population)
+
+        ray.get([island.close.remote() for island in islands])
+        # Continue the id sequence past anything the islands created
+        Individual._ids = count(max(
+            [next(Individual._ids)] + [x.id + 1 for x in population]))
+        return population
@@ -1,7 +1,24 @@
 
-from evolution.evolution import Population
+import typing as t
+import gp
+from gp.phenotype import CHANNELS
+from evolution.cache import FitnessCache
+from evolution.evolution import Population, PopulationEvaluator
 from tensorboard.summary import Writer
-import pickle
+import csv
+
+
+def layout_stats(population: Population) -> t.Dict[str, float]:
+    """The mean number of each unit type per individual, the mean number of
+    occupied cells per individual and the fraction of cells occupied by
+    any individual"""
+    grids = gp.phenotype_grids([x.genotype for x in population])
+    occupied = grids.sum(axis=3) > 0
+    stats = {f'layout/{name}': float(grids[..., i].sum(axis=(1, 2)).mean())
+             for i, name in enumerate(CHANNELS)}
+    stats['layout/occupied_cells'] = float(occupied.sum(axis=(1, 2)).mean())
+    stats['layout/coverage'] = float(occupied.any(axis=0).mean())
+    return stats
 
 
 class LogCallback():
@@ -12,10 +29,15 @@ class LogCallback():
 
 class Tensorboard(LogCallback):
 
-    def __init__(self, log_dir: str):
+    def __init__(self, log_dir: str, pop_eval: t.Optional[PopulationEvaluator] = None):
         self.writer = Writer(log_dir)
+        self.pop_eval = pop_eval
 
     def after_pop_eval(self, generation: int, population: Population):
+        if self.pop_eval is not None:
+            for name, value in self.pop_eval.stats.items():
+                self.writer.add_scalar(name, value, generation)
+
         best = population.best_individual()
         self.writer.add_scalar(
             'fitness/average', population.average_fitness_score(), generation)
@@ -35,17 +57,32 @@ class Tensorboard(LogCallback):
         self.writer.add_scalar(
             'minerals/best', best.fitness.minerals, generation)
 
+        self.writer.add_scalar(
+            'pareto/size', len(population.pareto_front()), generation)
+
+        for name, value in population.diversity(FitnessCache.key).items():
+            self.writer.add_scalar(name, value, generation)
+        for name, value in layout_stats(population).items():
+            self.writer.add_scalar(name, value, generation)
+
         self.writer.add_scalar(
             'structure/depth', best.genotype.depth(), generation)
         self.writer.add_scalar(
             'structure/size', best.genotype.size(), generation)
 
 
-class SaveGeneration(LogCallback):
+class ParetoFront(LogCallback):
+    """Writes the non-dominated individuals of each generation to a CSV file
+    so the whole survival/cost trade-off of a run can be plotted"""
 
     def __init__(self, save_dir: str):
         self.save_dir = save_dir
 
     def after_pop_eval(self, generation: int, population: Population):
-        with open(f'{self.save_dir}/generation_{generation:04d}.pkl', 'wb') as f:
-            pickle.dump(population, f)
+        front = population.pareto_front()
+        with open(f'{self.save_dir}/pareto_{generation:04d}.csv', 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time', 'minerals', 'gas', 'genotype'])
+            for individual in sorted(front, key=lambda x: x.fitness.time):
+                fitness = individual.fitness
+                writer.writerow([fitness.time, fitness.minerals, fitness.gas, str(individual.genotype)])
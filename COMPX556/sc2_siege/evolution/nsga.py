@@ -0,0 +1,80 @@
+import typing as t
+import numpy as np
+
+
+def dominates(objectives: np.ndarray) -> np.ndarray:
+    """Return a matrix where `[i, j]` is True if individual i dominates
+    individual j. Every objective is maximised."""
+    better_eq = (objectives[:, None, :] >= objectives[None, :, :]).all(axis=2)
+    better = (objectives[:, None, :] > objectives[None, :, :]).any(axis=2)
+    return better_eq & better
+
+
+def non_dominated_sort(objectives: np.ndarray) -> t.List[np.ndarray]:
+    """Sort individuals into Pareto fronts, best front first.
+
+    The fast non-dominated sort of NSGA-II. The domination matrix is built
+    in one O(MN^2) vector operation, then each front is peeled off by
+    subtracting its domination counts.
+
+    :param objectives: An (N, M) array of objectives to maximise
+    :return: The indices of the individuals in each front
+    """
+    dominated_by = dominates(objectives)
+    count = dominated_by.sum(axis=0)
+    remaining = np.ones(len(objectives), dtype=bool)
+    fronts = []
+    while remaining.any():
+        front = np.flatnonzero(remaining & (count == 0))
+        fronts.append(front)
+        remaining[front] = False
+        count -= dominated_by[front].sum(axis=0)
+    return fronts
+
+
+def pareto_front(objectives: np.ndarray) -> np.ndarray:
+    """Return the indices of the non-dominated individuals.
+
+    Only the first front is found, without the O(N^2) domination matrix.
+    In descending lexicographic order anything that dominates an individual
+    comes before it, so each individual is only compared with the front
+    found so far: O(NF) time for a front of F individuals.
+    """
+    order = np.lexsort(objectives.T[::-1])[::-1]
+    front: t.List[int] = []
+    front_objectives = np.empty((0, objectives.shape[1]))
+    for i in order:
+        candidate = objectives[i]
+        if ((front_objectives >= candidate).all(axis=1) &
+                (front_objectives > candidate).any(axis=1)).any():
+            continue
+        front.append(i)
+        front_objectives = np.vstack([front_objectives, candidate])
+    return np.sort(np.array(front, dtype=int))
+
+
+def crowding_distance(objectives: np.ndarray) -> np.ndarray:
+    """Return the crowding distance of each individual within a front.
+    Individuals at the extremes of any objective have infinite distance."""
+    n, m = objectives.shape
+    distance = np.zeros(n)
+    if n <= 2:
+        return np.full(n, np.inf)
+    for objective in range(m):
+        order = np.argsort(objectives[:, objective], kind='stable')
+        values = objectives[order, objective]
+        distance[order[[0, -1]]] = np.inf
+        spread = values[-1] - values[0]
+        if spread > 0:
+            distance[order[1:-1]] += (values[2:] - values[:-2]) / spread
+    return distance
+
+
+def nsga2_rank(objectives: np.ndarray) -> t.Tuple[np.ndarray, np.ndarray]:
+    """Return the front index and crowding distance of every individual"""
+    rank = np.zeros(len(objectives), dtype=int)
+    distance = np.zeros(len(objectives))
+    for i, front in enumerate(non_dominated_sort(objectives)):
+        rank[front] = i
+        distance[front] = crowding_distance(objectives[front])
+    return rank, distance
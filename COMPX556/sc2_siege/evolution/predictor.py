@@ -0,0 +1,188 @@
+import typing as t
+from loguru import logger as log
+import numpy as np
+import gp
+from gp.fitness import FITNESS_DTYPE, SquashFitness, fitness_array
+from gp.phenotype import CHANNELS, GRID_SIZE
+from evolution.evolution import Individual, Population
+
+UNIT_CHANNELS = 4
+"""The `CHANNELS` of units outside bunkers: marines, marauders, siege tanks
+and bunkers"""
+
+
+def population_features(genotypes: t.Sequence[gp.Gene]) -> np.ndarray:
+    """Describe each genotype as a fixed length vector: for each unit type
+    its count, mean position, position spread and count in each top level
+    quadrant, then the garrisoned marines, marauders and empty bunker
+    slots, the depth and the size. The units of every genotype are placed
+    at once with `gp.placements`."""
+    n = len(genotypes)
+    units = gp.placements(genotypes)
+    position = (np.stack([units.x, units.y], axis=1) - GRID_SIZE / 2) / GRID_SIZE
+
+    # Sum over the units of each (genotype, channel)
+    group = units.individual * len(CHANNELS) + units.channel
+    def _sum(weights=None):
+        return np.bincount(group, weights, minlength=n * len(CHANNELS)).reshape(n, -1)
+    count = _sum()
+    total = np.maximum(count, 1)[:, :, None]
+    mean = np.stack([_sum(position[:, 0]), _sum(position[:, 1])], axis=2) / total
+    square = np.stack([_sum(position[:, 0] ** 2), _sum(position[:, 1] ** 2)], axis=2) / total
+    spread = np.sqrt(np.maximum(square - mean ** 2, 0)).sum(axis=2)
+    per_quadrant = np.bincount(group * 4 + units.quadrant, minlength=n * len(CHANNELS) * 4)
+
+    per_unit = np.concatenate([
+        count[:, :UNIT_CHANNELS, None], mean[:, :UNIT_CHANNELS], spread[:, :UNIT_CHANNELS, None],
+        per_quadrant.reshape(n, len(CHANNELS), 4)[:, :UNIT_CHANNELS]], axis=2)
+    garrisoned = count[:, UNIT_CHANNELS:]
+    empty = count[:, CHANNELS.index("Bunker"), None] * 4 - garrisoned.sum(axis=1, keepdims=True)
+    shape = np.array([[genotype.depth(), genotype.size()] for genotype in genotypes]).reshape(n, 2)
+    return np.concatenate([per_unit.reshape(n, -1), garrisoned, empty, shape], axis=1)
+
+
+def genotype_features(genotype: gp.Gene) -> np.ndarray:
+    """The `population_features` of a single genotype"""
+    return population_features([genotype])[0]
+
+
+class FitnessPredictor():
+    """Predicts the fitness of genotypes from `population_features` with ridge
+    regression, one output per fitness component. It is refit on every
+    evaluated genotype seen so far whenever new ones are added."""
+
+    def __init__(self, regularisation: float = 1.0):
+        self.regularisation = regularisation
+        self._features: t.Dict[str, np.ndarray] = {}
+        self._fitness: t.Dict[str, t.Tuple[float, float, float]] = {}
+        self._weights: t.Optional[np.ndarray] = None
+        self._x_mean = self._x_std = self._y_mean = None
+        self._y_range: t.Optional[t.Tuple[np.ndarray, np.ndarray]] = None
+
+    def __len__(self) -> int:
+        return len(self._fitness)
+
+    def add(self, individuals: t.Iterable[Individual]):
+        """Learn from evaluated individuals. A genotype seen again replaces
+        its previous fitness, e.g. after it was re-evaluated. Fitness that
+        is only a lower bound from an early stopped evaluation is ignored."""
+        new: t.Dict[str, gp.Gene] = {}
+        for individual in individuals:
+            if individual.fitness is None or individual.early_stopped:
+                continue
+            key = str(individual.genotype)
+            if key not in self._features:
+                new[key] = individual.genotype
+            fitness = individual.fitness
+            self._fitness[key] = (fitness.time, fitness.minerals, fitness.gas)
+        if new:
+            self._features.update(zip(new, population_features(list(new.values()))))
+        self._weights = None
+
+    def fit(self):
+        keys = list(self._fitness)
+        x = np.stack([self._features[key] for key in keys])
+        y = np.array([self._fitness[key] for key in keys])
+        self._x_mean, self._y_mean = x.mean(axis=0), y.mean(axis=0)
+        self._y_range = y.min(axis=0), y.max(axis=0)
+        self._x_std = x.std(axis=0)
+        self._x_std[self._x_std == 0] = 1
+        x = (x - self._x_mean) / self._x_std
+        self._weights = np.linalg.solve(
+            x.T @ x + self.regularisation * np.eye(x.shape[1]),
+            x.T @ (y - self._y_mean))
+
+    def predict(self, genotypes: t.Sequence[gp.Gene]) -> np.ndarray:
+        """Return the predicted fitness of each genotype as an array of
+        FITNESS_DTYPE"""
+        if self._weights is None:
+            self.fit()
+        x = population_features(genotypes)
+        y = (x - self._x_mean) / self._x_std @ self._weights + self._y_mean
+        # Survival time saturates at the timeout, don't extrapolate past
+        # anything seen in training
+        y = np.clip(y, *self._y_range)
+        predicted = np.empty(len(genotypes), dtype=FITNESS_DTYPE)
+        for i, name in enumerate(FITNESS_DTYPE.names):
+            predicted[name] = y[:, i]
+        return predicted
+
+
+def _ranks(x: np.ndarray) -> np.ndarray:
+    """Rank the values, tied values share their average rank"""
+    ranks = np.empty(len(x))
+    ranks[np.argsort(x, kind='stable')] = np.arange(len(x))
+    _, inverse, counts = np.unique(x, return_inverse=True, return_counts=True)
+    return (np.bincount(inverse, weights=ranks) / counts)[inverse]
+
+
+def rank_correlation(a: np.ndarray, b: np.ndarray) -> float:
+    """Spearman's rank correlation"""
+    if len(a) < 2:
+        return 0.0
+    rank_a, rank_b = _ranks(a), _ranks(b)
+    if rank_a.std() == 0 or rank_b.std() == 0:
+        return 0.0
+    return float(np.corrcoef(rank_a, rank_b)[0, 1])
+
+
+class Prescreen():
+    """Only sends the offspring the predictor rates highest to be evaluated.
+
+    Breed `1 / fraction` times more candidates than the population needs,
+    predict the fitness score of each and keep the best `population_size`.
+    Until the predictor has seen `min_samples` genotypes a random subset of
+    the candidates is kept unscreened, so the random immigrants at the end
+    of the candidates are kept as often as the offspring. After each
+    generation is evaluated `learn` adds it to the training data and
+    records how well the predictions ranked the kept offspring.
+    """
+
+    def __init__(self,
+                 to_fitness_score: SquashFitness,
+                 fraction: float,
+                 min_samples: int = 100,
+                 predictor: t.Optional[FitnessPredictor] = None):
+        """
+        :param fraction: The fraction of candidate offspring that are kept
+        """
+        self.to_fitness_score = to_fitness_score
+        self.fraction = fraction
+        self.min_samples = min_samples
+        self.predictor = predictor if predictor is not None else FitnessPredictor()
+        self._predicted: t.Dict[int, float] = {}
+        """The predicted score of each kept individual by id"""
+        self._screened_out = 0
+        self.stats: t.Dict[str, float] = {}
+        """Statistics about the last screened generation"""
+
+    def num_candidates(self, population_size: int) -> int:
+        return int(np.ceil(population_size / self.fraction))
+
+    def screen(self, candidates: Population, population_size: int) -> Population:
+        """Keep the `population_size` candidates with the best predicted
+        fitness score"""
+        self._predicted, self._screened_out = {}, 0
+        if len(self.predictor) < self.min_samples:
+            return candidates._subset(np.sort(candidates._rng().choice(
+                len(candidates), min(population_size, len(candidates)), replace=False)))
+        scores = self.to_fitness_score.scores(
+            self.predictor.predict([x.genotype for x in candidates]))
+        keep = np.argsort(-scores, kind='stable')[:population_size]
+        self._predicted = {candidates._population[i].id: float(scores[i]) for i in keep}
+        self._screened_out = len(candidates) - len(keep)
+        return candidates._subset(keep)
+
+    def learn(self, population: Population):
+        """Train on an evaluated generation and log the rank correlation of
+        the predictions for it"""
+        kept = [x for x in population if x.id in self._predicted]
+        self.stats = {'predictor/screened_out': self._screened_out}
+        if kept:
+            actual = self.to_fitness_score.scores(fitness_array([x.fitness for x in kept]))
+            predicted = np.array([self._predicted[x.id] for x in kept])
+            self.stats['predictor/rank_correlation'] = rank_correlation(predicted, actual)
+            log.info(f"Predictor rank correlation: "
+                     f"{self.stats['predictor/rank_correlation']:.2f}")
+        self.predictor.add(population)
+        self.stats['predictor/training_size'] = len(self.predictor)
@@ -0,0 +1,133 @@
+import typing as t
+from loguru import logger as log
+import numpy as np
+from evolution.evolution import Individual, Population, PopulationEvaluator
+from gp.fitness import fitness_array
+
+
+class Racing():
+    """Spends extra evaluations only where noise could change the selection.
+
+    Each genotype's fitness score is the mean of its cached samples, with a
+    standard error from their variance. Genotypes evaluated only once use
+    the variance pooled over every genotype with several samples. Each
+    round re-evaluates the genotypes whose mean is within `confidence`
+    standard errors of the selection cutoff, closest first, until none
+    are uncertain or the budget is spent. Before any genotype has several
+    samples only the two either side of the cutoff are re-evaluated.
+    Genotypes that are clearly in or clearly out drop out of the race
+    early, as in successive halving.
+    """
+
+    def __init__(self,
+                 pop_eval: PopulationEvaluator,
+                 selection_size: int,
+                 budget: int,
+                 max_samples: int = 5,
+                 confidence: float = 2.0):
+        """
+        :param selection_size: The number of individuals selected, the
+            cutoff is between the `selection_size` fittest and the rest
+        :param budget: The most extra evaluations per generation
+        :param max_samples: A genotype is not re-evaluated once it has this
+            many samples
+        :param confidence: How many standard errors from the cutoff a mean
+            must be before it is trusted
+        """
+        self.pop_eval = pop_eval
+        self.selection_size = selection_size
+        self.budget = budget
+        self.max_samples = max_samples
+        self.confidence = confidence
+
+    def score_stats(self,
+                    population: Population
+                    ) -> t.Tuple[np.ndarray, np.ndarray, np.ndarray, t.Optional[float]]:
+        """Return the mean, variance and number of samples of each
+        individual's fitness score and the pooled variance, or None if no
+        genotype has been evaluated more than once"""
+        cache = self.pop_eval.cache
+        stats: t.Dict[str, t.Tuple[float, float, int]] = {}
+        for individual in population:
+            key = cache.key(individual.genotype)
+            if key in stats:
+                continue
+            samples = cache.samples_of(key) or [individual.fitness]
+            scores = population.to_fitness_score.scores(fitness_array(samples))
+            stats[key] = (float(scores.mean()),
+                          float(scores.var(ddof=1)) if len(scores) > 1 else np.nan,
+                          len(scores))
+        mean, var, n = (np.array(x) for x in zip(*(
+            stats[cache.key(individual.genotype)] for individual in population)))
+
+        repeated = [x for x in stats.values() if x[2] > 1]
+        pooled = None
+        if repeated:
+            pooled = sum(v * (n - 1) for _, v, n in repeated) / \
+                sum(n - 1 for _, _, n in repeated)
+        return mean, var, n, pooled
+
+    def uncertain(self, population: Population) -> t.List[Individual]:
+        """Return the individuals whose side of the selection cutoff is not
+        yet known, closest to the cutoff first"""
+        mean, var, n, pooled = self.score_stats(population)
+        k = self.selection_size
+        if k >= len(population):
+            return []
+        ranked = np.sort(mean)[::-1]
+        cutoff = (ranked[k - 1] + ranked[k]) / 2
+        distance = np.abs(mean - cutoff)
+        open_ = n < self.max_samples
+        if pooled is None:
+            # Nothing is known about the noise yet, re-evaluate the two
+            # individuals either side of the cutoff to estimate it
+            order = np.argsort(distance, kind='stable')[:2]
+        else:
+            var = np.where(np.isnan(var), pooled, var)
+            stderr = np.sqrt(var / n)
+            z = np.divide(distance, stderr, out=np.full_like(distance, np.inf),
+                          where=stderr > 0)
+            open_ &= z < self.confidence
+            order = np.argsort(z, kind='stable')
+        return [population._population[i] for i in order if open_[i]]
+
+    def race(self, population: Population) -> Population:
+        """Re-evaluate uncertain individuals until the selection is reliable
+        or the budget is spent. Individuals are also refreshed from the
+        cache, so elites don't keep a lucky score forever."""
+        for individual in population:
+            self.pop_eval.resolve(individual)
+        population.fitness_changed()
+
+        spent, rounds = 0, 0
+        while spent < self.budget:
+            candidates = self.uncertain(population)
+            keys = list(dict.fromkeys(
+                self.pop_eval.cache.key(x.genotype) for x in candidates))
+            keys = set(keys[:self.budget - spent])
+            candidates = [x for x in candidates
+                          if self.pop_eval.cache.key(x.genotype) in keys]
+            if not candidates:
+                break
+            # Individuals sharing a genotype share its samples
+            duplicates = [x for x in population
+                          if self.pop_eval.cache.key(x.genotype) in keys]
+            completed = self.pop_eval.reevaluate(duplicates)
+            population.fitness_changed()
+            spent += len(keys)
+            rounds += 1
+            if completed == 0:
+                break
+
+        _, _, n, pooled = self.score_stats(population)
+        remaining = len(self.uncertain(population))
+        self.pop_eval.stats.update({
+            'racing/evaluations': spent,
+            'racing/rounds': rounds,
+            'racing/uncertain': remaining,
+            'racing/mean_samples': float(n.mean()),
+            'racing/noise_std': float(np.sqrt(pooled)) if pooled is not None else 0,
+        })
+        log.info(f"Racing spent {spent} evaluations in {rounds} rounds, "
+                 f"{remaining} individuals are still uncertain")
+        return population
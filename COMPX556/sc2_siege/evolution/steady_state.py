@@ -0,0 +1,139 @@
+from collections import deque
+from time import time
+import typing as t
+import gp
+from gp.fitness import EarlyStop
+from evolution.evolution import Individual, Job, Population, PopulationEvaluator
+
+
+class SteadyStateEvolution():
+    """Breeds a new offspring as soon as any evaluation completes.
+
+    The generational loop waits for the slowest game of a generation before
+    breeding the next one, leaving workers idle. Here every completed
+    evaluation immediately frees a slot for a new offspring, which replaces
+    the least fit individual if it is fitter. Every `population_size`
+    completed offspring count as one generation for logging.
+    """
+
+    def __init__(self,
+                 pop_eval: PopulationEvaluator,
+                 selection_size: int,
+                 mutate: t.Callable[[gp.Gene], gp.Gene],
+                 mutation_probability: float,
+                 sex: t.Callable[[gp.Gene, gp.Gene], gp.Gene],
+                 sex_probability: float,
+                 init_depth: int,
+                 breed_attempts: int = 100,
+                 early_stop: bool = False):
+        """
+        :param init_depth: The depth of the random genotypes that fill a slot
+            when breeding fails, as for the initial population
+        :param breed_attempts: How many offspring may be bred in a row
+            without finding one that needs evaluating. After that the slot
+            is filled with new random genotypes.
+        :param early_stop: Stop evaluating offspring once they cannot replace
+            the least fit individual
+        """
+        self.pop_eval = pop_eval
+        self.selection_size = selection_size
+        self.mutate = mutate
+        self.mutation_probability = mutation_probability
+        self.sex = sex
+        self.sex_probability = sex_probability
+        self.breed_attempts = breed_attempts
+        self.early_stop = early_stop
+        self.init_depth = init_depth
+
+    def run(self,
+            population: Population,
+            start_generation: int,
+            generations: int,
+            after_generation: t.Callable[[int, Population], None]) -> Population:
+        """Evolve the population until `generations` generations worth of
+        offspring have been evaluated"""
+        population = self.pop_eval.evaluate(population)
+        after_generation(start_generation, population)
+        population_size = len(population)
+        budget = (generations - start_generation - 1) * population_size
+
+        cache = self.pop_eval.cache
+        jobs: t.Deque[Job] = deque()
+        waiting: t.Dict[str, t.List[Individual]] = {}
+        """Offspring waiting on the evaluations of their genotype"""
+        outstanding: t.Dict[str, int] = {}
+        """The number of evaluations still running for each genotype"""
+        submitted, completed = 0, 0
+
+        def _breed():
+            """Breed offspring until one needs evaluating, falling back to
+            random immigrants so no evaluation slot is lost"""
+            nonlocal population, submitted
+            parents = population.select(self.selection_size)
+            for attempt in range(2 * self.breed_attempts):
+                if attempt < self.breed_attempts:
+                    child = parents.offspring(
+                        self.mutate, self.mutation_probability,
+                        self.sex, self.sex_probability)
+                else:
+                    child = Individual(gp.initialise_genotype(self.init_depth))
+                if child.fitness is not None:
+                    # Unchanged parents are already in the population
+                    continue
+                key = cache.key(child.genotype)
+                if key in waiting:
+                    waiting[key].append(child)
+                    continue
+                if key in cache:
+                    self.pop_eval.resolve(child)
+                    population = population.replace_worst(child)
+                    continue
+                if self.early_stop:
+                    self.pop_eval.early_stop = EarlyStop(
+                        population.to_fitness_score, float(population.scores().min()))
+                child_jobs = self.pop_eval.jobs_for(child)
+                waiting[key] = [child]
+                outstanding[key] = len(child_jobs)
+                jobs.extend(child_jobs)
+                submitted += 1
+                return
+            raise RuntimeError("Failed to breed an offspring that needs evaluating")
+
+        for _ in range(min(self.pop_eval.num_slots, budget)):
+            _breed()
+
+        generation = start_generation
+        start, busy_time = time(), self.pop_eval.busy_time
+        for key, fitness, early_stopped in self.pop_eval._run(jobs):
+            # Offspring stopped early can't replace anything and their
+            # truncated fitness is not cached
+            if fitness is not None and not early_stopped:
+                cache.add(key, fitness)
+            outstanding[key] -= 1
+            if outstanding[key] > 0:
+                continue
+
+            del outstanding[key]
+            for child in waiting.pop(key):
+                # Offspring that could not be evaluated are discarded
+                if self.pop_eval.resolve(child):
+                    population = population.replace_worst(child)
+            completed += 1
+
+            if completed % population_size == 0:
+                generation += 1
+                self.pop_eval.stats = {
+                    'cache/size': len(cache),
+                    'workers/utilisation': self.pop_eval.utilisation(
+                        self.pop_eval.busy_time - busy_time, time() - start),
+                    **self.pop_eval.failure_stats(),
+                    **self.pop_eval.profile_stats(),
+                    **self.pop_eval.serialisation_stats(),
+                }
+                start, busy_time = time(), self.pop_eval.busy_time
+                after_generation(generation, population)
+
+            if submitted < budget:
+                _breed()
+
+        return population
@@ -1,21 +1,34 @@
+import os
 import random
+import shutil
+import time
+import numpy as np
 import pytest
+import ray
 from config.config import Config
-from evolution.evolution import Individual, Population
+from evolution.evolution import Individual, Population, PopulationEvaluator, early_stop_for, next_generation
+from evolution.cache import FitnessCache
+from evolution.checkpoint import Checkpoint, evaluated_individuals, load_generation
+from evolution.islands import IslandModel, migration_sources, split
+from evolution.nsga import crowding_distance, non_dominated_sort, pareto_front
+from evolution.predictor import FitnessPredictor, Prescreen, genotype_features, rank_correlation
+from evolution.racing import Racing
+from evolution.steady_state import SteadyStateEvolution
 import gp
-from gp.fitness import SquashFitness
+from gp.fitness import EarlyStop, SquashFitness
+from sc2_evaluator.surrogate import SurrogateEvaluator
 
 cfg = Config()
 
 
 @pytest.fixture
 def population():
-    return Population.initialize(10, 2)
+    return Population.initialize(10, 2, cfg.fitness_scorer())
 
 
 @pytest.fixture
 def simple_population() -> Population:
-    return Population([Individual(gp.Marine()) for _ in range(5)])
+    return Population([Individual(gp.Marine()) for _ in range(5)], cfg.fitness_scorer())
 
 
 def test_init(population):
@@ -23,17 +36,19 @@ def test_init(population):
 
 
 def test_evaluate(population):
-    population.evaluate()
+    population = PopulationEvaluator(SurrogateEvaluator(cfg.win_timeout)).evaluate(population)
+    assert all(individual.fitness is not None for individual in population)
 
 
 def test_select(population: Population):
-    cmp = SquashFitness(cfg.mineral_weight, cfg.gas_weight, cfg.time_weight)
+    cmp = SquashFitness(cfg.time_weight, cfg.mineral_weight, cfg.gas_weight)
 
     for p in population._population:
         p.fitness = gp.Fitness(
             random.random(), random.random(), random.random())
+    population.fitness_changed()
 
-    selected = population.remove_unfit(5, cmp)
+    selected = population.select(5)
     assert len(selected._population) == 5
 
     # Assert they are in order
@@ -64,9 +79,9 @@ def test_stochastic_sex(simple_population: Population):
     new_pop = simple_population.stochastic_sex(sex, 0.5)
     i = 0
     for individual in new_pop._population:
-        if str(individual.genotype) == "Q(MM)":
+        if str(individual.genotype) == "Q(MMEE)":
             i += 1
-    assert i == 2, "Expected 2 individuals with Q(MM) but got {}".format(i)
+    assert i == 2, "Expected 2 individuals with Q(MMEE) but got {}".format(i)
 
 
 def test_sample(population: Population):
@@ -74,3 +89,494 @@ def test_sample(population: Population):
     assert len(pop) == 5
     pop = pop.sample(10)
     assert len(pop) == 10
+
+
+def test_fitness_cache(tmp_path):
+    cache = FitnessCache(str(tmp_path / "cache"), max_size=1, samples=2)
+    key = cache.key(gp.from_str("Q(StMaMM)"))
+    assert key == "MARAUDER@52,36 MARINE@44,28 MARINE@52,28 SIEGETANK@44,36"
+    assert cache.get(key) is None
+    assert cache.missing_samples(key) == 2
+
+    cache.add(key, gp.Fitness(10, 100, 0))
+    assert key not in cache
+    cache.add(key, gp.Fitness(20, 100, 50))
+    assert cache.get(key) == gp.Fitness(15, 100, 25)
+
+    # Evict the genotype from memory, it should be reloaded from disk
+    cache.add("M", gp.Fitness(1, 50, 0))
+    cache.close()
+    cache = FitnessCache(str(tmp_path / "cache"), max_size=1, samples=2)
+    assert cache.get(key) == gp.Fitness(15, 100, 25)
+    assert cache.missing_samples("M") == 1
+
+
+def test_phenotype_dedup():
+    genotypes = ["Q(MEEE)", "Q(MQ(EEEE)EE)", "Q(B(MMaEE)EEE)", "Q(B(EMaEM)EEE)", "E", "Q(EEEE)"]
+    keys = [FitnessCache.key(gp.from_str(x)) for x in genotypes]
+    assert keys[0] == keys[1] and keys[2] == keys[3] and keys[4] == keys[5]
+    assert len(set(keys)) == 3
+
+    population = Population([Individual(gp.from_str(x)) for x in genotypes],
+                            cfg.fitness_scorer())
+    pop_eval = PopulationEvaluator(SurrogateEvaluator(cfg.win_timeout))
+    population = pop_eval.evaluate(population)
+    assert pop_eval.stats['cache/misses'] == 3
+    assert population._population[0].fitness == population._population[1].fitness
+    # Equivalent genotypes in later generations are not evaluated either
+    pop_eval.evaluate(Population([Individual(gp.from_str("Q(MQ(EEEE)Q(EEEE)E)"))],
+                                 cfg.fitness_scorer()))
+    assert pop_eval.stats['cache/hits'] == 1
+
+
+def test_population_evaluator():
+    random.seed(42)
+    population = Population.initialize(10, 2, cfg.fitness_scorer())
+    population._population.append(Individual(population._population[0].genotype.copy()))
+    pop_eval = PopulationEvaluator(SurrogateEvaluator(cfg.win_timeout))
+
+    population = pop_eval.evaluate(population)
+    assert all(individual.fitness is not None for individual in population)
+    assert pop_eval.stats['cache/hits'] >= 1
+    assert pop_eval.stats['profile/evaluate/mean'] > 0
+    assert pop_eval.stats['profile/evaluate/max'] >= pop_eval.stats['profile/evaluate/p90']
+    assert pop_eval.profiles == []
+
+
+def test_steady_state():
+    random.seed(42)
+    population = Population.initialize(10, 1, cfg.fitness_scorer())
+    pop_eval = PopulationEvaluator(SurrogateEvaluator(cfg.win_timeout))
+    generations = []
+
+    def after_generation(generation: int, population: Population):
+        assert len(population) == 10
+        assert all(individual.fitness is not None for individual in population)
+        generations.append(generation)
+
+    SteadyStateEvolution(
+        pop_eval, 5,
+        gp.SubtreeMutator(1).mutate, 0.5,
+        gp.SubtreeCrossover().crossover, 0.5, 1
+    ).run(population, 0, 3, after_generation)
+    assert generations == [0, 1, 2]
+    assert pop_eval.stats['workers/utilisation'] > 0
+
+    # Offspring that never change fall back to random immigrants, so every
+    # slot is still evaluated
+    generations.clear()
+    population = SteadyStateEvolution(
+        pop_eval, 5, gp.SubtreeMutator(1).mutate, 0.0,
+        gp.SubtreeCrossover().crossover, 0.0, 1, breed_attempts=5
+    ).run(population, 0, 3, after_generation)
+    assert generations == [0, 1, 2]
+
+
+@pytest.fixture
+def scored_population() -> Population:
+    random.seed(42)
+    population = Population.initialize(20, 1, cfg.fitness_scorer())
+    for individual in population:
+        individual.fitness = gp.Fitness(
+            random.uniform(0, 200), random.uniform(0, 1000), random.uniform(0, 500))
+    return population
+
+
+def test_vectorised_select(scored_population: Population):
+    to_fitness_score = scored_population.to_fitness_score
+    expected = sorted(scored_population, key=lambda x: to_fitness_score(x.fitness), reverse=True)
+    selected = scored_population.select(5)
+    assert list(selected) == expected[:5]
+    assert selected.best_fitness_score() == pytest.approx(to_fitness_score(expected[0].fitness))
+    assert selected.best_individual() is expected[0]
+    assert selected.average_time() == pytest.approx(
+        sum(x.fitness.time for x in expected[:5]) / 5)
+
+
+def test_tournament_and_roulette(scored_population: Population):
+    random.seed(42)
+    tournament = scored_population.tournament(50, 3)
+    roulette = scored_population.roulette(50)
+    assert len(tournament) == len(roulette) == 50
+    assert tournament.average_fitness_score() > scored_population.average_fitness_score()
+    assert roulette.average_fitness_score() > scored_population.average_fitness_score()
+
+    # Selection is reproducible when `random` is seeded
+    random.seed(42)
+    assert list(scored_population.tournament(50, 3)) == list(tournament)
+
+
+def test_non_dominated_sort():
+    objectives = np.array([[3, 1], [1, 3], [2, 2], [1, 1], [0, 0], [2, 2]], dtype=float)
+    fronts = non_dominated_sort(objectives)
+    assert [list(front) for front in fronts] == [[0, 1, 2, 5], [3], [4]]
+    distance = crowding_distance(objectives[fronts[0]])
+    assert np.isinf(distance[:2]).all() and np.isfinite(distance[2:]).all()
+
+    assert list(pareto_front(objectives)) == [0, 1, 2, 5]
+    rng = np.random.default_rng(0)
+    for _ in range(5):
+        random_objectives = rng.integers(0, 5, size=(50, 3)).astype(float)
+        assert list(pareto_front(random_objectives)) == \
+            list(non_dominated_sort(random_objectives)[0])
+
+
+def test_nsga2(scored_population: Population):
+    fronts = scored_population.pareto_fronts()
+    assert sum(len(front) for front in fronts) == len(scored_population)
+    selected = scored_population.nsga2(len(fronts[0]))
+    assert set(map(id, selected)) == set(map(id, fronts[0]))
+    assert set(map(id, scored_population.pareto_front())) == set(map(id, fronts[0]))
+
+    offspring = selected.crowded_tournament(20)
+    assert len(offspring) == 20
+
+
+def test_checkpoint(tmp_path, scored_population: Population):
+    path = str(tmp_path / "checkpoint.jsonl")
+    checkpoint = Checkpoint(path)
+    checkpoint.after_pop_eval(0, scored_population)
+    random.seed(1)
+    next_population = scored_population.select(10).stochastic_mutate(
+        gp.SubtreeMutator(1).mutate, 0.5)
+    for individual in next_population:
+        individual.fitness = individual.fitness or gp.Fitness(1, 2, 3)
+    checkpoint.after_pop_eval(1, next_population)
+
+    # Re-recording a generation after resuming is a no-op
+    Checkpoint(path, resume=True).after_pop_eval(1, next_population)
+    with open(path) as f:
+        assert sum('members' in line for line in f) == 2
+
+    generation, loaded, random_state = load_generation(path, cfg.fitness_scorer())
+    assert generation == 1
+    assert random_state == random.getstate()
+    assert [str(x.genotype) for x in loaded] == [str(x.genotype) for x in next_population]
+    assert [x.fitness for x in loaded] == [x.fitness for x in next_population]
+    assert [x.parents for x in loaded] == [x.parents for x in next_population]
+
+    _, first, _ = load_generation(path, cfg.fitness_scorer(), 0)
+    assert [x.id for x in first] == [x.id for x in scored_population]
+    assert Individual(gp.Marine()).id > max(x.id for x in next_population)
+
+    # A fresh run moves the previous run aside instead of appending to it
+    Checkpoint(path).after_pop_eval(0, next_population)
+    assert os.path.exists(path + ".1")
+    generation, loaded, _ = load_generation(path, cfg.fitness_scorer())
+    assert generation == 0
+    assert [x.id for x in loaded] == [x.id for x in next_population]
+
+
+def test_fitness_cache_journal(tmp_path):
+    path = str(tmp_path / "cache")
+    cache = FitnessCache(path, samples=2)
+    cache.add("M", gp.Fitness(1, 50, 0))
+    cache.add("M", gp.Fitness(3, 50, 0))
+    cache.add("Ma", gp.Fitness(2, 100, 25))
+    # Copy the files as a run that died without closing the cache left them
+    crashed = str(tmp_path / "crashed")
+    for name in os.listdir(tmp_path):
+        if name.startswith("cache"):
+            shutil.copy(tmp_path / name, crashed + name[len("cache"):])
+    cache.close()
+
+    path = crashed
+    cache = FitnessCache(path, samples=2)
+    assert cache.get("M") == gp.Fitness(2, 50, 0)
+    assert cache.samples_of("Ma") == [gp.Fitness(2, 100, 25)]
+    cache.close()
+    assert not os.path.exists(f"{path}.journal")
+
+
+def test_migration_sources():
+    assert migration_sources("ring", 3) == [[2], [0], [1]]
+    assert migration_sources("fully_connected", 3) == [[1, 2], [0, 2], [0, 1]]
+    assert migration_sources("isolated", 2) == [[], []]
+    with pytest.raises(ValueError):
+        migration_sources("star", 2)
+
+
+def test_island_split():
+    assert split(100, 7) == [15, 15, 14, 14, 14, 14, 14]
+    sizes = [island_cfg.population_size
+             for island_cfg in IslandModel(cfg, None, 7).island_cfgs]
+    assert sum(sizes) == cfg.population_size
+    immigrants_cfg = Config()
+    immigrants_cfg.immigrants = 3
+    assert [island_cfg.immigrants for island_cfg in IslandModel(immigrants_cfg, None, 4).island_cfgs] == \
+        [1, 1, 1, 0]
+
+    racing_cfg = Config()
+    racing_cfg.racing_budget = 4
+    racing_cfg.selection = "tournament"
+    with pytest.raises(ValueError):
+        IslandModel(racing_cfg, None, 2)
+
+
+def test_island_model():
+    ray.init(num_cpus=2, include_dashboard=False)
+    try:
+        random.seed(42)
+        island_cfg = Config()
+        island_cfg.population_size = 8
+        island_cfg.selection_size = 4
+        island_cfg.migration_interval = 2
+        island_cfg.fitness_cache = None
+        population = Population.initialize(8, 1, island_cfg.fitness_scorer())
+        generations = []
+
+        def after_generation(generation: int, population: Population):
+            assert len(population) == 8
+            assert all(individual.fitness is not None for individual in population)
+            generations.append(generation)
+
+        population = IslandModel(island_cfg, SurrogateEvaluator(cfg.win_timeout), 2).run(
+            population, 0, 5, after_generation)
+        assert generations == [0, 1, 2, 3, 4]
+        assert Individual(gp.Marine()).id > max(individual.id for individual in population)
+    finally:
+        ray.shutdown()
+
+
+def test_early_stop(scored_population: Population):
+    early_cfg = Config()
+    early_cfg.early_stop = True
+    early_cfg.selection_size = 5
+    early_stop = early_stop_for(scored_population, early_cfg)
+    assert early_stop.threshold == pytest.approx(
+        scored_population.select(5).scores().min())
+    best = scored_population.best_individual().fitness
+    assert not early_stop.hopeless(best)
+    assert early_stop.hopeless(gp.Fitness(0, best.minerals, best.gas))
+
+    early_cfg.selection = "tournament"
+    assert early_stop_for(scored_population, early_cfg) is None
+
+    class _Recorder(SurrogateEvaluator):
+        batched = False
+
+        def evaluate_profiled(self, genotype, early_stop=None):
+            thresholds.append(early_stop.threshold)
+            return super().evaluate_profiled(genotype, early_stop)
+
+    thresholds = []
+    pop_eval = PopulationEvaluator(_Recorder(cfg.win_timeout))
+    pop_eval.early_stop = early_stop
+    pop_eval.evaluate(Population.initialize(3, 1, cfg.fitness_scorer()))
+    assert thresholds and all(x == early_stop.threshold for x in thresholds)
+
+    # Results stopped early are lower bounds and are kept out of the cache
+    pop_eval = PopulationEvaluator(SurrogateEvaluator(cfg.win_timeout))
+    pop_eval.early_stop = EarlyStop(cfg.fitness_scorer(), float('inf'))
+    [stopped] = pop_eval.evaluate(
+        Population([Individual(gp.from_str("Q(EEEE)"))], cfg.fitness_scorer()))
+    assert stopped.early_stopped and stopped.fitness is not None
+    assert len(pop_eval.cache) == 0
+    assert pop_eval.stats['early_stop/stopped'] == 1
+    predictor = FitnessPredictor()
+    predictor.add([stopped])
+    assert len(predictor) == 0
+    # Re-evaluations are never stopped early
+    pop_eval.reevaluate([stopped])
+    assert not stopped.early_stopped and len(pop_eval.cache) == 1
+
+
+def test_remote_batches():
+    ray.init(num_cpus=2, include_dashboard=False)
+    try:
+        random.seed(42)
+        evaluator = SurrogateEvaluator(cfg.win_timeout)
+        evaluator.remote = True
+        population = Population.initialize(7, 2, cfg.fitness_scorer())
+        pop_eval = PopulationEvaluator(evaluator, batch_size=3)
+        population = pop_eval.evaluate(population)
+
+        expected = [SurrogateEvaluator(cfg.win_timeout).evaluate(x.genotype) for x in population]
+        assert [x.fitness for x in population] == expected
+        assert pop_eval.stats['serialisation/evaluator_bytes'] > 0
+        assert 0 < pop_eval.stats['serialisation/genotypes_bytes'] < 1000
+        assert pop_eval.stats['profile/scheduling/mean'] >= 0
+    finally:
+        ray.shutdown()
+
+
+def test_failed_evaluations():
+    random.seed(42)
+    population = Population.initialize(6, 1, cfg.fitness_scorer())
+    broken = str(population._population[0].genotype)
+
+    class _Flaky(SurrogateEvaluator):
+        """Crashes on the first attempt at each genotype and always on one"""
+
+        batched = False
+
+        def evaluate(self, genotype):
+            if str(genotype) == broken or str(genotype) not in attempted:
+                attempted.add(str(genotype))
+                raise ConnectionError("SC2 crashed")
+            return super().evaluate(genotype)
+
+    attempted = set()
+    pop_eval = PopulationEvaluator(_Flaky(cfg.win_timeout), retries=1)
+    population = pop_eval.evaluate(population)
+    # The broken genotype is dropped rather than scored as zero
+    assert broken not in [str(x.genotype) for x in population]
+    assert all(x.fitness is not None for x in population)
+    assert broken not in pop_eval.cache
+    assert pop_eval.stats['failures/given_up'] == 1
+    assert pop_eval.stats['failures/retries'] == len(attempted)
+    assert 0 < pop_eval.stats['failures/rate'] < 1
+
+    class _BrokenBatch(SurrogateEvaluator):
+        """Fails any batch containing the broken genotype"""
+
+        def evaluate_batch(self, genotypes, early_stop=None):
+            batch_sizes.append(len(genotypes))
+            if broken in [str(x) for x in genotypes]:
+                raise ConnectionError("SC2 crashed")
+            return super().evaluate_batch(genotypes, early_stop)
+
+    batch_sizes = []
+    random.seed(42)
+    population = Population.initialize(6, 1, cfg.fitness_scorer())
+    pop_eval = PopulationEvaluator(_BrokenBatch(cfg.win_timeout))
+    population = pop_eval.evaluate(population)
+    # The whole population is sent at once, then one at a time to find the
+    # genotype that fails
+    assert batch_sizes[0] > 1 and batch_sizes[1:] == [1] * batch_sizes[0]
+    assert broken not in [str(x.genotype) for x in population]
+    assert len(population) == batch_sizes[0] - 1
+    assert pop_eval.stats['failures/errors'] == 1
+
+
+def test_evaluation_timeout():
+    ray.init(num_cpus=2, include_dashboard=False)
+    try:
+        random.seed(42)
+        population = Population.initialize(4, 1, cfg.fitness_scorer())
+        hung = str(population._population[0].genotype)
+
+        class _Hangs(SurrogateEvaluator):
+            remote = True
+            batched = False
+
+            def evaluate(self, genotype):
+                if str(genotype) == hung:
+                    time.sleep(3600)
+                return super().evaluate(genotype)
+
+        pop_eval = PopulationEvaluator(
+            _Hangs(cfg.win_timeout), num_workers=1, timeout=8, retries=1)
+        population = pop_eval.evaluate(population)
+        assert hung not in [str(x.genotype) for x in population]
+        assert len(population) > 0
+        assert pop_eval.stats['failures/timeouts'] == 2
+        assert pop_eval.stats['workers/replaced_hung'] == 2
+        assert pop_eval.stats['workers/quarantined'] == 0
+    finally:
+        ray.shutdown()
+
+
+def test_racing():
+    random.seed(42)
+    population = Population.initialize(12, 2, cfg.fitness_scorer())
+    genotypes = sorted({FitnessCache.key(x.genotype) for x in population})
+    # Survival times 20 seconds apart with much smaller noise
+    base = {genotype: 20. * i for i, genotype in enumerate(genotypes)}
+
+    class _Noisy(SurrogateEvaluator):
+        batched = False
+
+        def evaluate(self, genotype):
+            return gp.Fitness(base[FitnessCache.key(genotype)] + random.gauss(0, 2), 0, 0)
+
+    pop_eval = PopulationEvaluator(_Noisy(cfg.win_timeout))
+    population = pop_eval.evaluate(population)
+    racing = Racing(pop_eval, selection_size=len(population) // 2, budget=20)
+    population = racing.race(population)
+
+    samples = {genotype: len(pop_eval.cache.samples_of(genotype)) for genotype in genotypes}
+    assert 0 < pop_eval.stats['racing/evaluations'] <= 20
+    assert sum(samples.values()) - len(genotypes) == pop_eval.stats['racing/evaluations']
+    # Only genotypes near the cutoff were raced
+    assert samples[genotypes[0]] == samples[genotypes[-1]] == 1
+    assert pop_eval.stats['racing/noise_std'] > 0
+    for individual in population:
+        key = FitnessCache.key(individual.genotype)
+        assert individual.fitness.time == pytest.approx(
+            np.mean([x.time for x in pop_eval.cache.samples_of(key)]))
+
+
+def test_genotype_features():
+    features = genotype_features(gp.from_str("Q(StB(MMaEE)MM)"))
+    per_unit = features[:32].reshape(4, 8)
+    # Marines, marauders, siege tanks and bunkers outside bunkers
+    assert list(per_unit[:, 0]) == [2, 0, 1, 1]
+    # The marines are in the bottom two quadrants
+    assert list(per_unit[0, 4:]) == [0, 0, 1, 1]
+    assert list(features[32:]) == [1, 1, 2, 2, 7]
+    assert len(genotype_features(gp.Marine())) == len(features)
+
+
+def test_prescreen():
+    random.seed(42)
+    to_fitness_score = cfg.fitness_scorer()
+    pop_eval = PopulationEvaluator(SurrogateEvaluator(cfg.win_timeout))
+    prescreen = Prescreen(to_fitness_score, fraction=0.5, min_samples=50)
+
+    candidates = Population.initialize(prescreen.num_candidates(20), 2, to_fitness_score)
+    assert len(candidates) == 40
+    # Too little training data, nothing is screened but a random subset is
+    # kept so the candidates at the end have a chance
+    kept_ids = [x.id for x in prescreen.screen(candidates, 20)]
+    assert len(set(kept_ids)) == 20
+    assert set(kept_ids) <= {x.id for x in candidates}
+    assert set(kept_ids) & {x.id for x in candidates._population[20:]}
+
+    prescreen.learn(pop_eval.evaluate(Population.initialize(100, 2, to_fitness_score)))
+    assert prescreen.stats['predictor/training_size'] > 50
+    kept = prescreen.screen(candidates, 20)
+    assert len(kept) == 20
+    predicted = to_fitness_score.scores(
+        prescreen.predictor.predict([x.genotype for x in candidates]))
+    assert min(predicted[[x.id for x in candidates].index(k.id)] for k in kept) >= \
+        np.sort(predicted)[-20]
+
+    prescreen.learn(pop_eval.evaluate(kept))
+    assert prescreen.stats['predictor/screened_out'] == 20
+    assert prescreen.stats['predictor/rank_correlation'] > 0
+
+    assert rank_correlation(np.arange(5), np.arange(5) * 2) == pytest.approx(1)
+    assert rank_correlation(np.arange(5), -np.arange(5)) == pytest.approx(-1)
+
+
+def test_predictor_from_checkpoint(tmp_path, scored_population: Population):
+    Checkpoint(str(tmp_path / "checkpoint.jsonl")).after_pop_eval(0, scored_population)
+    predictor = FitnessPredictor()
+    predictor.add(evaluated_individuals(str(tmp_path / "checkpoint.jsonl")))
+    assert len(predictor) == len({str(x.genotype) for x in scored_population})
+    assert len(predictor.predict([x.genotype for x in scored_population])) == \
+        len(scored_population)
+
+
+def test_unique_generation():
+    random.seed(42)
+    unique_cfg = Config()
+    unique_cfg.unique_offspring = True
+    unique_cfg.population_size = 20
+    unique_cfg.selection_size = 10
+    # Every individual is a clone, so diversity is as low as it gets
+    clones = Population([Individual(gp.from_str("Q(MMStE)"), gp.Fitness(100, 200, 125))
+                         for _ in range(20)], cfg.fitness_scorer())
+    assert clones.diversity(FitnessCache.key) == {
+        'diversity/unique': 1, 'diversity/unique_fraction': 0.05, 'diversity/tree_distance': 0}
+
+    offspring = next_generation(clones, unique_cfg, gp.SubtreeMutator(2).mutate,
+                                gp.SubtreeCrossover().crossover)
+    keys = [FitnessCache.key(x.genotype) for x in offspring]
+    assert len(offspring) == 20
+    assert len(set(keys)) == 20
+    assert sum(not x.parents and x.fitness is None for x in offspring) >= unique_cfg.immigrants
+    diversity = offspring.diversity(FitnessCache.key, max_pairs=50)
+    assert diversity['diversity/unique'] == 20
+    assert diversity['diversity/tree_distance'] > 0
@@ -1,12 +1,21 @@
 #!/bin/env python3
-import pickle
+from copy import copy
+import random
 from time import time
 import click
 from config.config import Config
-from evolution.loggers import LogCallback, SaveGeneration, Tensorboard
+from evolution.loggers import LogCallback, ParetoFront, Tensorboard
 import gp
-from evolution.evolution import Population, PopulationEvaluator
+from evolution.evolution import SELECTIONS, Population, PopulationEvaluator, early_stop_for, next_generation
+from evolution.cache import FitnessCache
+from evolution.checkpoint import Checkpoint, evaluated_individuals, load_generation
+from evolution.islands import IslandModel
+from evolution.predictor import Prescreen
+from evolution.racing import Racing
+from evolution.steady_state import SteadyStateEvolution
 from gp.fitness import SquashFitness
+from sc2_evaluator.evaluate import SC2Evaluator, WarmGameClient
+from sc2_evaluator.surrogate import SurrogateEvaluator
 from loguru import logger as log
 import ray
 import typing as t
@@ -27,22 +36,33 @@ def pretty_print(pop: Population, to_fitness_score: SquashFitness):
 @click.option('--num-cpus', default=1, help='Number of CPUs to use')
 @click.option('--resume', default=False, is_flag=True, help='Continue from last generation')
 @click.option('--num-generations', default=100, help='Number of generations to run')
-def main(purge: bool, num_cpus: int, resume: bool, num_generations: int):
+@click.option('--warm/--cold', default=True, help='Reuse running SC2 processes or launch one per evaluation')
+@click.option('--evaluator', 'evaluator_name', default='sc2', type=click.Choice(['sc2', 'surrogate']), help='How genotypes are evaluated')
+@click.option('--steady-state', default=False, is_flag=True, help='Breed new offspring as soon as any evaluation completes')
+@click.option('--seed', default=None, type=int, help='Seed the random number generator for a reproducible run')
+@click.option('--islands', default=1, help='Number of sub-populations evolving in parallel')
+@click.option('--address', default=None, help='Address of an existing Ray cluster to run on')
+@click.option('--selection', default=None, type=click.Choice(SELECTIONS), help='How parents are selected, defaults to the configured scheme')
+def main(purge: bool, num_cpus: int, resume: bool, num_generations: int, warm: bool, evaluator_name: str, steady_state: bool, seed: t.Optional[int], islands: int, address: t.Optional[str], selection: t.Optional[str]):
     cfg = Config()
     cfg.generations = num_generations
-    ray.init(num_cpus=num_cpus)
+    if selection is not None:
+        cfg.selection = selection
+    if cfg.racing_budget > 0 and cfg.selection != "truncation":
+        raise click.UsageError(
+            f"Racing only supports truncation selection, not {cfg.selection}")
+    random.seed(seed)
+    if address:
+        ray.init(address=address)
+    else:
+        ray.init(num_cpus=num_cpus)
 
     if purge and resume:
         log.warning("Cannot purge and resume at the same time")
     elif purge:
-        os.system(f'rm -rf {cfg.tensorboard_log} {cfg.generation_log}')
+        os.system(f'rm -rf {cfg.tensorboard_log} {cfg.generation_log} {cfg.fitness_cache}*')
         os.system(f'mkdir -p {cfg.tensorboard_log} {cfg.generation_log}')
 
-    loggers: t.List[LogCallback] = [
-        Tensorboard(f"{cfg.tensorboard_log}"),
-        SaveGeneration(f"{cfg.generation_log}")
-    ]
-
     to_fitness_score = cfg.fitness_scorer()
 
     population = Population.initialize(
@@ -51,11 +71,34 @@ def main(purge: bool, num_cpus: int, resume: bool, num_generations: int):
         to_fitness_score,
     )
 
+    if evaluator_name == 'surrogate':
+        evaluator = SurrogateEvaluator(cfg.win_timeout)
+    elif warm:
+        evaluator = WarmGameClient(cfg.win_timeout, cfg.ready_time_limit, **cfg.bot_options())
+    else:
+        evaluator = SC2Evaluator(cfg.win_timeout, cfg.ready_time_limit, **cfg.bot_options())
+
     pop_eval = PopulationEvaluator(
-        cfg.win_timeout,
-        cfg.ready_time_limit
+        evaluator,
+        FitnessCache(
+            cfg.fitness_cache,
+            cfg.fitness_cache_size,
+            cfg.fitness_samples
+        ),
+        # Islands evaluate with their own workers
+        num_workers=num_cpus if warm and evaluator.remote and islands <= 1 else 0,
+        batch_size=cfg.evaluation_batch_size,
+        timeout=cfg.evaluation_timeout,
+        retries=cfg.evaluation_retries,
+        quarantine_after=cfg.quarantine_failures
     )
 
+    loggers: t.List[LogCallback] = [
+        Tensorboard(f"{cfg.tensorboard_log}", pop_eval),
+        Checkpoint(cfg.checkpoint, resume=resume),
+        ParetoFront(f"{cfg.generation_log}")
+    ]
+
     log.info("Initial population")
 
     mutator = gp.SubtreeMutator(cfg.mutant_tree_depth)
@@ -63,29 +106,73 @@ def main(purge: bool, num_cpus: int, resume: bool, num_generations: int):
 
     start_generation = 0
     if resume:
-        # get last generation from file
-        start_generation = max(map(lambda x : int(x[-len("0000.pkl"):-len(".pkl")]), os.listdir(cfg.generation_log)))
-        
+        start_generation, population, random_state = load_generation(
+            cfg.checkpoint, to_fitness_score)
+        random.setstate(random_state)
         log.info(f"Resuming from generation {start_generation}")
-        with open(f'{cfg.generation_log}/generation_{start_generation:04d}.pkl', 'rb') as f:
-            population = pickle.load(f)
 
-    for i in range(start_generation, cfg.generations):
-        start = time()
-        population = pop_eval.evaluate(population)
+    start = time()
 
+    def after_generation(i: int, population: Population):
+        nonlocal start
         for logger in loggers:
             logger.after_pop_eval(i, population)
 
         log.info(f"## Generation {i} ##")
         log.info(f"Time taken: {time() - start}")
         pretty_print(population.select(1), to_fitness_score)
+        start = time()
 
-
-        population = population.select(cfg.selection_size)
-        population = population.sample(cfg.population_size)
-        population = population.stochastic_mutate(mutator.mutate, cfg.mutation_probability)
-        population = population.stochastic_sex(sexual_reproduction.crossover, cfg.sex_probability)
+    if islands > 1:
+        population = IslandModel(
+            cfg,
+            evaluator,
+            islands,
+            num_workers=max(1, num_cpus // islands) if warm and evaluator.remote else 0
+        ).run(population, start_generation, cfg.generations, after_generation)
+    elif steady_state:
+        if cfg.selection != "truncation":
+            raise click.UsageError(
+                f"Steady state evolution only supports truncation selection, not {cfg.selection}")
+        population = SteadyStateEvolution(
+            pop_eval,
+            cfg.selection_size,
+            mutator.mutate,
+            cfg.mutation_probability,
+            sexual_reproduction.crossover,
+            cfg.sex_probability,
+            cfg.init_depth,
+            early_stop=cfg.early_stop
+        ).run(population, start_generation, cfg.generations, after_generation)
+    else:
+        racing = Racing(pop_eval, cfg.selection_size, cfg.racing_budget,
+                        cfg.racing_max_samples, cfg.racing_confidence)
+        prescreen = None
+        breed_cfg = cfg
+        if cfg.prescreen_fraction < 1:
+            prescreen = Prescreen(to_fitness_score, cfg.prescreen_fraction,
+                                  cfg.prescreen_min_samples)
+            if resume:
+                prescreen.predictor.add(evaluated_individuals(cfg.checkpoint))
+            breed_cfg = copy(cfg)
+            breed_cfg.population_size = prescreen.num_candidates(cfg.population_size)
+
+        for i in range(start_generation, cfg.generations):
+            population = pop_eval.evaluate(population)
+            if cfg.racing_budget > 0:
+                population = racing.race(population)
+            if prescreen is not None:
+                prescreen.learn(population)
+                pop_eval.stats.update(prescreen.stats)
+            after_generation(i, population)
+            pop_eval.early_stop = early_stop_for(population, cfg)
+
+            population = next_generation(
+                population, breed_cfg, mutator.mutate, sexual_reproduction.crossover)
+            if prescreen is not None:
+                population = prescreen.screen(population, cfg.population_size)
+
+    pop_eval.cache.close()
 
 
 
@@ -2,4 +2,7 @@ from gp.genotype import *
 from gp.initialisation import initialise_genotype
 from gp.breedable import SubtreeCrossover, find_crossover_point, SubtreeMutator
 from gp.fitness import Fitness
-from gp.plot_genotype import plot_individual
+from gp.flat import FlatGenotype, FlatSubtreeCrossover, FlatSubtreeMutator
+from gp.plot_genotype import plot_individual, plot_population
+from gp.codec import encode_genotype, decode_genotype, encode_population, decode_population
+from gp.phenotype import placements, phenotype_grids
@@ -1,50 +1,60 @@
+import typing as t
 import gp
 import random as rnd
 
 
-def find_crossover_point(genotype: gp.Gene) -> gp.Gene:
-    """Return a random gene from the genotype"""
-    # The first element is the root node, so we don't want to select that
-    return rnd.choice(list(genotype.iterate())[1:])
+def find_crossover_point(genotype: gp.Gene, gene_type: t.Optional[t.Type[gp.Gene]] = None) -> gp.Gene:
+    """Return a random gene from the genotype other than the root. If a gene
+    type is given, only genes that could be replaced by that type are
+    considered.
+    """
+    if gene_type is None:
+        # The first element is the root node, so we don't want to select that
+        nodes = genotype.nodes()
+        if len(nodes) < 2:
+            raise gp.BadGenotype(f"{genotype} has no crossover points")
+        return nodes[rnd.randrange(1, len(nodes))]
+
+    points = genotype.replaceable_by(gene_type)
+    if not points:
+        raise gp.BadGenotype(
+            f"{genotype} has no crossover points for {gene_type.__name__}")
+    return rnd.choice(points)
 
 
 class SubtreeCrossover():
     """A crossover operator that performs subtree crossover"""
 
-    def __init__(self, retries=5):
-        self.retries = retries
-
     def crossover(self, genotype_1: gp.Gene, genotype_2: gp.Gene) -> gp.Gene:
         """Perform subtree crossover on the two genotypes.
         This is a genetic operator that takes two genotypes and returns a new
         genotype. The new genotype is created by taking a random subtree from
         one genotype and replacing a random subtree in the other genotype with
-        the subtree from the first genotype. This is repeated until a valid
-        genotype is created.
+        the subtree from the first genotype. Only points where the subtree is
+        valid are considered, e.g. only Infantry can replace a gene in a
+        Bunker.
         """
         child = genotype_1.copy()
-        for _ in range(self.retries):
-            crossover_point_1 = find_crossover_point(child)
+        crossover_point_1 = find_crossover_point(child)
+        donors = genotype_2.descendants_of_type(crossover_point_1.parent.child_type)
+        if donors:
+            crossover_point_2 = rnd.choice(donors)
+        else:
+            # Nothing in genotype 2 can replace the gene e.g. it is in a
+            # Bunker and genotype 2 has no Infantry. Pick a point that can be
+            # replaced by anything instead.
+            crossover_point_1 = find_crossover_point(child, gp.Gene)
             crossover_point_2 = find_crossover_point(genotype_2)
 
-            try:
-                crossover_point_1.replace_node(crossover_point_2.copy())
-                return child
-            except gp.BadGenotype:
-                continue
-
-        raise gp.BadGenotype("Could not create a valid child")
+        crossover_point_1.replace_node(crossover_point_2.copy())
+        return child
 
 
 class SubtreeMutator():
     """A mutation operator that performs subtree mutation"""
 
-    def __init__(self,
-                 random_subtree_depth: int,
-                 retries: int = 5
-                 ):
+    def __init__(self, random_subtree_depth: int):
         self.random_subtree_depth = random_subtree_depth
-        self.retries = retries
 
     def mutate(self, genotype: gp.Gene) -> gp.Gene:
         """Perform subtree mutation on the genotype.
@@ -53,13 +63,6 @@ class SubtreeMutator():
         """
         random_subtree = gp.initialise_genotype(self.random_subtree_depth)
         child = genotype.copy()
-        for _ in range(self.retries):
-            crossover_point = find_crossover_point(child)
-
-            try:
-                crossover_point.replace_node(random_subtree)
-                return child
-            except gp.BadGenotype:
-                continue
-
-        raise gp.BadGenotype("Could not create a valid child")
+        crossover_point = find_crossover_point(child, type(random_subtree))
+        crossover_point.replace_node(random_subtree)
+        return child
@@ -0,0 +1,108 @@
+import typing as t
+import numpy as np
+import gp.genotype as gp
+from gp.flat import CHILD_COUNT, CODES, COMPOSITES, GENES
+
+BITS = 3
+"""Bits per gene, enough for the six gene types of `gp.flat.CODES`"""
+_SHIFTS = np.arange(BITS - 1, -1, -1, dtype=np.uint8)
+_IS_COMPOSITE = np.isin(np.arange(2 ** BITS), COMPOSITES)
+_BRANCHING = np.where(_IS_COMPOSITE, CHILD_COUNT - 1, -1)
+"""How each gene changes the number of genes still to be read"""
+
+
+def genotype_codes(genotype: gp.Gene) -> np.ndarray:
+    """Return the code of every gene in prefix order"""
+    return np.fromiter((CODES[type(gene)] for gene in genotype.nodes()), dtype=np.uint8)
+
+
+def _from_codes(codes: t.Sequence[int]) -> gp.Gene:
+    """Build the tree from prefix ordered codes"""
+    open_genes: t.List[t.Tuple[int, t.List[gp.Gene]]] = []
+    for code in codes:
+        if code in COMPOSITES:
+            open_genes.append((code, []))
+            continue
+        gene = GENES[code]()
+        while True:
+            if not open_genes:
+                return gene
+            open_genes[-1][1].append(gene)
+            if len(open_genes[-1][1]) < CHILD_COUNT:
+                break
+            code, children = open_genes.pop()
+            gene = GENES[code](children=children)
+    raise gp.ParseFail("Truncated genotype encoding")
+
+
+def encode_population(genotypes: t.Sequence[gp.Gene]) -> t.Tuple[bytes, np.ndarray]:
+    """Pack genotypes into a compact binary form for bulk storage.
+
+    Each genotype is its gene codes in prefix order, 3 bits per gene,
+    padded to a whole byte. Composites always have four children so the
+    end of a genotype needs no marker.
+
+    :return: The packed bytes and the byte offset of each genotype, with the
+        total length appended
+    """
+    codes = [genotype_codes(genotype) for genotype in genotypes]
+    lengths = np.array([len(x) for x in codes], dtype=np.int64)
+    byte_lengths = (lengths * BITS + 7) // 8
+    offsets = np.concatenate([[0], np.cumsum(byte_lengths)])
+
+    all_codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.uint8)
+    # The bit position of every gene: its genotype's first bit plus its
+    # index within the genotype
+    owner = np.repeat(np.arange(len(codes)), lengths)
+    index = np.arange(len(all_codes)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    first_bit = offsets[owner] * 8 + index * BITS
+    bits = np.zeros(int(offsets[-1]) * 8, dtype=np.uint8)
+    for i, shift in enumerate(_SHIFTS):
+        bits[first_bit + i] = (all_codes >> shift) & 1
+    return np.packbits(bits).tobytes(), offsets
+
+
+def decode_population(data: bytes, offsets: np.ndarray) -> t.List[gp.Gene]:
+    """Unpack the genotypes packed by `encode_population`"""
+    offsets = np.asarray(offsets, dtype=np.int64)
+    bits = np.unpackbits(np.frombuffer(data, dtype=np.uint8))
+
+    # Read every whole 3 bit group of every genotype at once
+    groups = (offsets[1:] - offsets[:-1]) * 8 // BITS
+    empty = np.flatnonzero(groups == 0)
+    if len(empty):
+        raise gp.ParseFail(f"Truncated genotype encoding at byte {offsets[empty[0]]}")
+    owner = np.repeat(np.arange(len(groups)), groups)
+    index = np.arange(groups.sum()) - np.repeat(np.cumsum(groups) - groups, groups)
+    first_bit = offsets[owner] * 8 + index * BITS
+    codes = np.zeros(len(first_bit), dtype=np.int64)
+    for i, shift in enumerate(_SHIFTS):
+        codes |= bits[first_bit + i].astype(np.int64) << shift
+
+    # A genotype ends once no more genes are needed, which skips the padding
+    segment_starts = np.cumsum(groups) - groups
+    branching = _BRANCHING[codes]
+    read = np.cumsum(branching)
+    needed = 1 + read - np.repeat((read - branching)[segment_starts], groups)
+    ends = np.flatnonzero(needed == 0)
+    first_end = np.searchsorted(ends, segment_starts)
+
+    genotypes = []
+    for i, start in enumerate(segment_starts):
+        if first_end[i] == len(ends) or owner[ends[first_end[i]]] != i:
+            raise gp.ParseFail(f"Truncated genotype encoding at byte {offsets[i]}")
+        gene_codes = codes[start:ends[first_end[i]] + 1]
+        if gene_codes.max() >= len(GENES):
+            raise gp.ParseFail(f"Invalid gene code at byte {offsets[i]}")
+        genotypes.append(_from_codes(gene_codes.tolist()))
+    return genotypes
+
+
+def encode_genotype(genotype: gp.Gene) -> bytes:
+    """Pack a single genotype, see `encode_population`"""
+    return encode_population([genotype])[0]
+
+
+def decode_genotype(data: bytes) -> gp.Gene:
+    """Unpack a single genotype packed by `encode_genotype`"""
+    return decode_population(data, np.array([0, len(data)]))[0]
@@ -1,4 +1,6 @@
 from dataclasses import dataclass
+import typing as t
+import numpy as np
 
 
 @dataclass
@@ -14,6 +16,31 @@ class Fitness():
         return f'Fitness(time={self.time}, minerals={self.minerals}, gas={self.gas})'
 
 
+FITNESS_DTYPE = np.dtype([
+    ('time', np.float64),
+    ('minerals', np.float64),
+    ('gas', np.float64)
+])
+"""A structured array of fitness components"""
+
+
+def fitness_array(fitnesses: t.Sequence[Fitness]) -> np.ndarray:
+    """Convert fitnesses into a structured array of FITNESS_DTYPE"""
+    return np.array([(x.time, x.minerals, x.gas) for x in fitnesses], dtype=FITNESS_DTYPE)
+
+
+def mean_fitness(samples: t.Sequence[Fitness]) -> Fitness:
+    """Average several evaluations of the same genotype"""
+    n = len(samples)
+    if n == 1:
+        return samples[0]
+    return Fitness(
+        sum(x.time for x in samples) / n,
+        sum(x.minerals for x in samples) / n,
+        sum(x.gas for x in samples) / n
+    )
+
+
 class SquashFitness():
     """Squash the fitness into a single value. Used for sorting and selection."""
 
@@ -24,3 +51,59 @@ class SquashFitness():
 
     def __call__(self, a: Fitness) -> float:
         return a.time * self.time_weight + a.minerals * self.mineral_weight + a.gas * self.gas_weight
+
+    def objectives(self, fitness: np.ndarray) -> np.ndarray:
+        """Return the fitness components as an (N, 3) array of objectives to
+        maximise. Only the sign of each weight is used, so multi-objective
+        selection does not depend on how the components are traded off."""
+        return np.stack([
+            fitness['time'] * np.sign(self.time_weight),
+            fitness['minerals'] * np.sign(self.mineral_weight),
+            fitness['gas'] * np.sign(self.gas_weight)], axis=1)
+
+    def scores(self, fitness: np.ndarray) -> np.ndarray:
+        """Squash a structured array of FITNESS_DTYPE in one vector operation"""
+        return fitness['time'] * self.time_weight + fitness['minerals'] * self.mineral_weight + fitness['gas'] * self.gas_weight
+
+
+@dataclass
+class EarlyStop():
+    """Stops an evaluation once its fitness score can no longer reach a
+    threshold, e.g. the score needed to be selected"""
+    to_fitness_score: SquashFitness
+    threshold: float
+
+    def hopeless(self, best_case: Fitness) -> bool:
+        """
+        :param best_case: The best fitness the evaluation can still reach
+        """
+        return self.to_fitness_score(best_case) < self.threshold
+
+    def hopeless_array(self, best_cases: np.ndarray) -> np.ndarray:
+        """As `hopeless` for a structured array of FITNESS_DTYPE"""
+        return self.to_fitness_score.scores(best_cases) < self.threshold
+
+
+DAMAGE_RATE_WINDOW = 5.0
+"""Game seconds of damage to observe before the damage rate is trusted"""
+
+
+def best_case_survival(time_survived: float,
+                       win_timeout: float,
+                       health: float,
+                       first_damage: t.Optional[t.Tuple[float, float]]) -> float:
+    """Bound how long an undefended town hall can still survive.
+
+    Once no defenders are left nothing reduces the damage it takes and the
+    attack waves only grow, so it keeps losing health at least as fast as
+    it has since it was first damaged.
+
+    :param first_damage: The time survived and health when the town hall
+        was first seen damaged, None if it hasn't been
+    """
+    if first_damage is None or time_survived - first_damage[0] < DAMAGE_RATE_WINDOW:
+        return win_timeout
+    damage_rate = (first_damage[1] - health) / (time_survived - first_damage[0])
+    if damage_rate <= 0:
+        return win_timeout
+    return min(win_timeout, time_survived + health / damage_rate)
@@ -0,0 +1,252 @@
+from array import array
+import random as rnd
+import typing as t
+import gp.genotype as gp
+from gp.initialisation import initialise_genotype
+
+EMPTY, MARINE, MARAUDER, SIEGE_TANK, BUNKER, QUADRANT = range(6)
+
+CODES: t.Dict[t.Type[gp.Gene], int] = {
+    gp.Empty: EMPTY,
+    gp.Marine: MARINE,
+    gp.Marauder: MARAUDER,
+    gp.SiegeTank: SIEGE_TANK,
+    gp.Bunker: BUNKER,
+    gp.Quadrant: QUADRANT,
+}
+GENES: t.List[t.Type[gp.Gene]] = [
+    gp.Empty, gp.Marine, gp.Marauder, gp.SiegeTank, gp.Bunker, gp.Quadrant]
+TOKENS = ["E", "M", "Ma", "St", "B(", "Q("]
+COMPOSITES = (BUNKER, QUADRANT)
+INFANTRY = (EMPTY, MARINE, MARAUDER)
+CHILD_COUNT = 4
+
+
+class FlatGenotype():
+    """A genotype stored as a prefix ordered array of node codes.
+
+    `sizes[i]` is the number of nodes in the subtree rooted at `i`, so the
+    subtree is the slice `codes[i:i + sizes[i]]`. Picking a random node is
+    O(1) and replacing a subtree is a slice concatenation, there are no
+    parent references to update. Use `from_gene` and `to_gene` to convert
+    to and from the `Gene` classes.
+    """
+
+    __slots__ = ("codes", "sizes")
+
+    def __init__(self, codes: array, sizes: array):
+        self.codes = codes
+        self.sizes = sizes
+
+    @staticmethod
+    def from_gene(gene: gp.Gene) -> 'FlatGenotype':
+        codes, sizes = array('B'), array('I')
+
+        def _add(gene: gp.Gene):
+            i = len(codes)
+            codes.append(CODES[type(gene)])
+            sizes.append(1)
+            if isinstance(gene, gp.Composite):
+                for child in gene.children:
+                    _add(child)
+                sizes[i] = len(codes) - i
+
+        _add(gene)
+        return FlatGenotype(codes, sizes)
+
+    @staticmethod
+    def from_str(stringified_genotype: str) -> 'FlatGenotype':
+        """Parse the format produced by `str(gene)`"""
+        codes, sizes = array('B'), array('I')
+        open_nodes: t.List[int] = []
+        i = 0
+        while i < len(stringified_genotype):
+            if codes and not open_nodes:
+                raise gp.ParseFail(
+                    f"Unexpected text at {i} after the genotype ended in {stringified_genotype}")
+            if stringified_genotype[i] == ")":
+                if not open_nodes:
+                    raise gp.ParseFail(
+                        f"Unexpected ) at {i} in {stringified_genotype}")
+                start = open_nodes.pop()
+                sizes[start] = len(codes) - start
+                if len(list(FlatGenotype(codes, sizes).children(start))) != CHILD_COUNT:
+                    raise gp.ParseFail(
+                        f"Expected {CHILD_COUNT} children at {i} in {stringified_genotype}")
+                i += 1
+                continue
+            for code in (MARAUDER, SIEGE_TANK, BUNKER, QUADRANT, MARINE, EMPTY):
+                if stringified_genotype.startswith(TOKENS[code], i):
+                    break
+            else:
+                raise gp.ParseFail(
+                    f"Unexpected token at {i} in {stringified_genotype}")
+            if open_nodes and codes[open_nodes[-1]] == BUNKER and code not in INFANTRY:
+                raise gp.ParseFail(
+                    f"Only infantry can be in a bunker, found {TOKENS[code]} at {i} "
+                    f"in {stringified_genotype}")
+            if code in COMPOSITES:
+                open_nodes.append(len(codes))
+            codes.append(code)
+            sizes.append(1)
+            i += len(TOKENS[code])
+        if open_nodes or not codes:
+            raise gp.ParseFail(f"Unbalanced genotype {stringified_genotype}")
+        return FlatGenotype(codes, sizes)
+
+    def to_gene(self) -> gp.Gene:
+        def _build(i: int) -> gp.Gene:
+            gene = GENES[self.codes[i]]()
+            if self.codes[i] in COMPOSITES:
+                gene.children = [_build(child) for child in self.children(i)]
+            return gene
+        return _build(0)
+
+    def __str__(self) -> str:
+        out = []
+        closes: t.List[int] = []
+        for i, code in enumerate(self.codes):
+            out.append(TOKENS[code])
+            if code in COMPOSITES:
+                closes.append(i + self.sizes[i])
+            while closes and closes[-1] == i + 1:
+                out.append(")")
+                closes.pop()
+        return "".join(out)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def __getitem__(self, i: int) -> 'FlatNode':
+        return FlatNode(self, i)
+
+    def copy(self) -> 'FlatGenotype':
+        return FlatGenotype(array('B', self.codes), array('I', self.sizes))
+
+    def children(self, i: int) -> t.Iterator[int]:
+        """Iterate over the indices of the children of node i"""
+        child, end = i + 1, i + self.sizes[i]
+        while child < end:
+            yield child
+            child += self.sizes[child]
+
+    def ancestors(self, i: int) -> t.List[int]:
+        """Return the indices of the ancestors of node i, root first"""
+        path = []
+        node = 0
+        while node != i:
+            path.append(node)
+            for child in self.children(node):
+                if child <= i < child + self.sizes[child]:
+                    node = child
+                    break
+        return path
+
+    def parent(self, i: int) -> t.Optional[int]:
+        ancestors = self.ancestors(i)
+        return ancestors[-1] if ancestors else None
+
+    def random_node(self) -> int:
+        """Return the index of a random node other than the root"""
+        return rnd.randrange(1, len(self.codes))
+
+    def replace(self, i: int, donor: 'FlatGenotype', j: int = 0) -> 'FlatGenotype':
+        """Return a new genotype where the subtree at i is replaced by the
+        subtree at j in the donor"""
+        ancestors = self.ancestors(i)
+        if ancestors and self.codes[ancestors[-1]] == BUNKER \
+                and donor.codes[j] not in INFANTRY:
+            raise gp.BadGenotype("Bunker must have only Infantry children")
+
+        old_size, new_size = self.sizes[i], donor.sizes[j]
+        codes = self.codes[:i] + donor.codes[j:j + new_size] + \
+            self.codes[i + old_size:]
+        sizes = self.sizes[:i] + donor.sizes[j:j + new_size] + \
+            self.sizes[i + old_size:]
+        for ancestor in ancestors:
+            sizes[ancestor] += new_size - old_size
+        return FlatGenotype(codes, sizes)
+
+    def depth(self) -> int:
+        """Return the depth of the genotype, matching `Gene.depth`"""
+        depth, deepest = [0] * len(self.codes), 0
+        for i, code in enumerate(self.codes):
+            if code in COMPOSITES:
+                for child in self.children(i):
+                    depth[child] = depth[i] + 1
+                    deepest = max(deepest, depth[child])
+        return deepest
+
+    def size(self) -> int:
+        """Return the size of the genotype, matching `Gene.size`"""
+        return len(self.codes) - self.codes.count(EMPTY)
+
+
+class FlatNode():
+    """A lightweight view of a single node in a `FlatGenotype`"""
+
+    __slots__ = ("genotype", "index")
+
+    def __init__(self, genotype: FlatGenotype, index: int):
+        self.genotype = genotype
+        self.index = index
+
+    @property
+    def code(self) -> int:
+        return self.genotype.codes[self.index]
+
+    @property
+    def gene_type(self) -> t.Type[gp.Gene]:
+        return GENES[self.code]
+
+    @property
+    def size(self) -> int:
+        return self.genotype.sizes[self.index]
+
+    @property
+    def children(self) -> t.List['FlatNode']:
+        return [FlatNode(self.genotype, i) for i in self.genotype.children(self.index)]
+
+    def __str__(self) -> str:
+        return str(FlatGenotype(
+            self.genotype.codes[self.index:self.index + self.size],
+            self.genotype.sizes[self.index:self.index + self.size]))
+
+
+class FlatSubtreeCrossover():
+    """`SubtreeCrossover` for flat genotypes"""
+
+    def __init__(self, retries=5):
+        self.retries = retries
+
+    def crossover(self, genotype_1: FlatGenotype, genotype_2: FlatGenotype) -> FlatGenotype:
+        for _ in range(self.retries):
+            try:
+                return genotype_1.replace(
+                    genotype_1.random_node(), genotype_2, genotype_2.random_node())
+            except gp.BadGenotype:
+                continue
+
+        raise gp.BadGenotype("Could not create a valid child")
+
+
+class FlatSubtreeMutator():
+    """`SubtreeMutator` for flat genotypes"""
+
+    def __init__(self,
+                 random_subtree_depth: int,
+                 retries: int = 5
+                 ):
+        self.random_subtree_depth = random_subtree_depth
+        self.retries = retries
+
+    def mutate(self, genotype: FlatGenotype) -> FlatGenotype:
+        random_subtree = FlatGenotype.from_gene(
+            initialise_genotype(self.random_subtree_depth))
+        for _ in range(self.retries):
+            try:
+                return genotype.replace(genotype.random_node(), random_subtree)
+            except gp.BadGenotype:
+                continue
+
+        raise gp.BadGenotype("Could not create a valid child")
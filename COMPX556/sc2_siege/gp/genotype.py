@@ -1,5 +1,5 @@
+import json
 import typing as t
-from copy import deepcopy
 from gp.rectangle import Rectangle
 import re
 
@@ -34,21 +34,40 @@ class Gene():
 
     def to_json(self):
         """Convert this gene to a JSON string"""
-        return "{}"
+        return json.dumps(self._json_value(), separators=(",", ":"))
+
+    def _json_value(self) -> t.Any:
+        """The value `to_json` serialises"""
+        return {}
 
     def __str__(self) -> str:
         """Return a short string representation of this gene"""
         return ""
 
     def copy(self) -> 'Gene':
-        """Return a deep copy of this gene"""
-        new_copy = deepcopy(self)
-        new_copy._update_parent_references()
-        return new_copy
+        """Return a deep copy of this gene. The copy is the root of a new
+        tree"""
+        # Genes hold no state other than their position in the tree so a
+        # new instance is a copy. This is much faster than deepcopy.
+        return type(self).__new__(type(self))
 
     def iterate(self) -> 'Gene':
         """Iterate over all genes in this gene"""
-        yield self
+        yield from self.nodes()
+
+    def nodes(self) -> t.List['Gene']:
+        """Return all genes in this gene in prefix order. The list is cached
+        and must not be modified"""
+        return [self]
+
+    def replaceable_by(self, gene_type: t.Type['Gene']) -> t.List['Gene']:
+        """Return the genes below this gene that could be replaced by a gene
+        of the given type"""
+        return []
+
+    def descendants_of_type(self, gene_type: t.Type['Gene']) -> t.List['Gene']:
+        """Return the genes below this gene that are of the given type"""
+        return []
 
     def locations(self, parent_quad: Rectangle) -> t.Tuple['Gene', t.Tuple[float, float]]:
         """Return a list of genes and their locations"""
@@ -62,10 +81,6 @@ class Gene():
         parent = self.parent
         parent.replace_child(self, replacement)
 
-    def _update_parent_references(self):
-        """When a gene is copied, the parent references need to be updated"""
-        pass
-
     def depth(self) -> int:
         """Return the depth of this gene"""
         return 0
@@ -74,6 +89,17 @@ class Gene():
         """Return the size of this gene"""
         return 1
 
+    def _invalidate(self):
+        """Forget the cached properties of this gene and its ancestors. Must
+        be called whenever the tree below a gene changes"""
+        gene = self
+        while gene is not None:
+            gene._clear_cache()
+            gene = gene._parent
+
+    def _clear_cache(self):
+        pass
+
 
 class Leaf(Gene):
     """A leaf gene is a gene that has no children"""
@@ -84,8 +110,19 @@ class Composite(Gene):
     """A composite gene is a gene that has children"""
 
     child_count = 4
+    child_type: t.Type[Gene] = Gene
+    """The type of gene that can be a child of this gene"""
     _children: t.List[Gene] = []
 
+    # Cached properties of the tree below this gene
+    _size: t.Optional[int] = None
+    _depth: t.Optional[int] = None
+    _nodes: t.Optional[t.List[Gene]] = None
+    _index: t.Optional[t.Dict[t.Tuple[str, t.Type[Gene]], t.List[Gene]]] = None
+
+    def _json_value(self) -> t.Any:
+        return {type(self).__name__: [[child._json_value() for child in self._children]]}
+
     def __init__(self, children: t.List[Gene] = None, parent: Gene = None) -> None:
         super().__init__()
         if parent:
@@ -115,10 +152,35 @@ class Composite(Gene):
         self._children = children
         for child in children:
             child.set_parent(self)
+        self._invalidate()
 
     def _check_child(self, child: Gene):
         """Check if the child can be added to this gene"""
-        pass
+        if not isinstance(child, self.child_type):
+            raise BadGenotype(
+                f"{type(self)} must have only {self.child_type.__name__} children")
+
+    def _clear_cache(self):
+        self._size = None
+        self._depth = None
+        self._nodes = None
+        self._index = None
+
+    def __getstate__(self):
+        # Caches are cheap to rebuild, don't pickle them
+        state = self.__dict__.copy()
+        for cached in ('_size', '_depth', '_nodes', '_index'):
+            state.pop(cached, None)
+        return state
+
+    def copy(self) -> 'Composite':
+        # The children of a valid gene do not need to be checked again
+        new_copy = type(self).__new__(type(self))
+        new_copy._children = [child.copy() for child in self._children]
+        for child in new_copy._children:
+            child._parent = new_copy
+        new_copy._size, new_copy._depth = self._size, self._depth
+        return new_copy
 
     def replace_child(self, old_child: Gene, new_child: Gene):
         """Replace a child of this gene with a new child"""
@@ -128,30 +190,54 @@ class Composite(Gene):
         new_child.set_parent(self)
         old_child.set_parent(None)
         self._children[self._children.index(old_child)] = new_child
-
-    def iterate(self) -> Gene:
-        yield self
-        for item in self._children:
-            for sub_item in item.iterate():
-                yield sub_item
+        self._invalidate()
+
+    def nodes(self) -> t.List[Gene]:
+        if self._nodes is None:
+            nodes: t.List[Gene] = []
+            stack: t.List[Gene] = [self]
+            while stack:
+                gene = stack.pop()
+                nodes.append(gene)
+                if isinstance(gene, Composite):
+                    stack.extend(reversed(gene._children))
+            self._nodes = nodes
+        return self._nodes
+
+    def replaceable_by(self, gene_type: t.Type[Gene]) -> t.List[Gene]:
+        return self._indexed("replaceable_by", gene_type, lambda gene: issubclass(
+            gene_type, gene.parent.child_type))
+
+    def descendants_of_type(self, gene_type: t.Type[Gene]) -> t.List[Gene]:
+        return self._indexed("descendants_of_type", gene_type, lambda gene: isinstance(
+            gene, gene_type))
+
+    def _indexed(self, name: str, gene_type: t.Type[Gene], predicate: t.Callable[[Gene], bool]) -> t.List[Gene]:
+        """Cache the genes below this gene that match the predicate"""
+        if self._index is None:
+            self._index = {}
+        key = (name, gene_type)
+        if key not in self._index:
+            self._index[key] = [
+                gene for gene in self.nodes()[1:] if predicate(gene)]
+        return self._index[key]
 
     def locations(self, parent_quad: Rectangle) -> t.Tuple[Gene, t.Tuple[float, float]]:
         for item, rect in zip(self._children, parent_quad.quarters()):
             for sub_item in item.locations(rect):
                 yield sub_item
 
-    def _update_parent_references(self):
-        for child in self._children:
-            child.set_parent(self)
-            child._update_parent_references()
-
     def depth(self) -> int:
         """Return the depth of this gene"""
-        return max(child.depth() for child in self._children) + 1
+        if self._depth is None:
+            self._depth = max(child.depth() for child in self._children) + 1
+        return self._depth
 
     def size(self) -> int:
         """Return the size of this gene"""
-        return sum(child.size() for child in self._children) + 1
+        if self._size is None:
+            self._size = sum(child.size() for child in self._children) + 1
+        return self._size
 
 
 class Infantry(Leaf):
@@ -162,8 +248,8 @@ class Infantry(Leaf):
 class Marine(Infantry):
     """A basic infantry unit"""
 
-    def to_json(self):
-        return '"Marine"'
+    def _json_value(self) -> t.Any:
+        return "Marine"
 
     def __str__(self) -> str:
         return "M"
@@ -172,8 +258,8 @@ class Marine(Infantry):
 class Marauder(Infantry):
     """An infantry unit that is good against armored units"""
 
-    def to_json(self):
-        return '"Marauder"'
+    def _json_value(self) -> t.Any:
+        return "Marauder"
 
     def __str__(self) -> str:
         return "Ma"
@@ -182,8 +268,8 @@ class Marauder(Infantry):
 class Empty(Infantry):
     """An empty slot in a bunker"""
 
-    def to_json(self):
-        return '"Empty"'
+    def _json_value(self) -> t.Any:
+        return "Empty"
 
     def __str__(self) -> str:
         return "E"
@@ -196,8 +282,8 @@ class Empty(Infantry):
 class SiegeTank(Leaf):
     """A factory unit that can deal with swarms"""
 
-    def to_json(self):
-        return '"SiegeTank"'
+    def _json_value(self) -> t.Any:
+        return "SiegeTank"
 
     def __str__(self) -> str:
         return "St"
@@ -210,10 +296,6 @@ class Quadrant(Composite):
 
     child_count = 4
 
-    def to_json(self):
-        str = ','.join(map(lambda x: x.to_json(), self._children))
-        return f'{{"Quadrant":[[{str}]]}}'
-
     def __str__(self) -> str:
         return "Q(" + ''.join(map(lambda x: x.__str__(), self._children)) + ")"
 
@@ -223,16 +305,7 @@ class Bunker(Composite):
     in a bunker.
     """
     child_count = 4
-
-    def _check_child(self, child: Gene):
-        if not isinstance(child, Infantry):
-            raise BadGenotype(
-                f"{type(self)} must have only Infantry children")
-        super()._check_child(child)
-
-    def to_json(self):
-        str = ','.join(map(lambda x: x.to_json(), self._children))
-        return f'{{"Bunker":[[{str}]]}}'
+    child_type = Infantry
 
     def locations(self, parent_quad: Rectangle) -> t.Tuple[Gene, t.Tuple[float, float]]:
         yield from []
@@ -246,54 +319,70 @@ class ParseFail(Exception):
 
 
 def from_str(stringified_genotype: str) -> Gene:
-    """Parses a stringified genotype into a genotype tree"""
-
-    def _consume_token(x: str, token: str) -> t.Optional[str]:
-        if x.startswith(token):
-            return x[len(token):]
-        return None
-
-    def _parse(x: str, parent: Gene) -> t.Optional[t.Tuple[str, Gene]]:
-        # Consume terminals
-        if (r := _consume_token(x, "Ma")) is not None:
-            return r, Marauder().set_parent(parent)
-        elif (r := _consume_token(x, "M")) is not None:
-            return r, Marine().set_parent(parent)
-        elif (r := _consume_token(x, "E")) is not None:
-            return r, Empty().set_parent(parent)
-        elif (r := _consume_token(x, "St")) is not None:
-            return r, SiegeTank().set_parent(parent)
-        # Consume non-terminals
-        elif (r := _consume_token(x, "B(")) is not None:
-            # Parse children
-            children = []
-            for _ in range(4):
-                result = _parse(r, parent)
-                r, child = result
-                if child is None:
-                    return None
-
-                children.append(child)
-
-            if (e := _consume_token(r, ")")) is not None:
-                return e, Bunker(children=children).set_parent(parent)
-        elif (r := _consume_token(x, "Q(")) is not None:
-            # Parse children
-            children = []
-            for _ in range(4):
-                r, child = _parse(r, parent)
-                if child is None:
-                    return None
-                children.append(child)
-
-            if (e := _consume_token(r, ")")) is not None:
-                return e, Quadrant(children=children).set_parent(parent)
-
-        return None
-
-    x, gene = _parse(stringified_genotype, parent=None)
-    assert len(x) == 0, f"Failed to parse {x}"
-    return gene
+    """Parses a stringified genotype into a genotype tree.
+
+    A single pass over the string with an explicit stack of the composite
+    genes still waiting for their children, so parsing is linear in the
+    length of the genotype and deep trees can't exhaust the recursion limit.
+    """
+    text = stringified_genotype
+    # Composite genes waiting for their children: (type, children, position)
+    open_genes: t.List[t.Tuple[t.Type[Composite], t.List[Gene], int]] = []
+    root: t.Optional[Gene] = None
+    i, end = 0, len(text)
+    while i < end:
+        if root is not None:
+            raise ParseFail(f"Unexpected {text[i]!r} at {i} after the genotype ended")
+        char = text[i]
+        if char == ")":
+            if not open_genes:
+                raise ParseFail(f"Unmatched ) at {i}")
+            gene_type, children, position = open_genes.pop()
+            if len(children) != 4:
+                raise ParseFail(f"{gene_type.__name__} at {position} has "
+                                f"{len(children)} children, expected 4")
+            gene: Gene = gene_type(children=children)
+            i += 1
+        elif char == "M":
+            if text.startswith("a", i + 1):
+                gene, i = Marauder(), i + 2
+            else:
+                gene, i = Marine(), i + 1
+        elif char == "E":
+            gene, i = Empty(), i + 1
+        elif text.startswith("St", i):
+            gene, i = SiegeTank(), i + 2
+        elif text.startswith("B(", i) or text.startswith("Q(", i):
+            open_genes.append((Bunker if char == "B" else Quadrant, [], i))
+            i += 2
+            continue
+        else:
+            raise ParseFail(f"Unexpected {char!r} at {i}")
+
+        if open_genes:
+            gene_type, children, position = open_genes[-1]
+            if len(children) == 4:
+                raise ParseFail(f"{gene_type.__name__} at {position} has more than 4 children")
+            children.append(gene)
+        else:
+            root = gene
+
+    if open_genes:
+        raise ParseFail(f"Unclosed {open_genes[-1][0].__name__} at {open_genes[-1][2]}")
+    if root is None:
+        raise ParseFail("Empty genotype")
+    return root
+
+
+def tree_distance(a: Gene, b: Gene) -> int:
+    """Count the genes that differ between two genotypes, comparing the trees
+    from the root down. Where two genes differ both of their subtrees count
+    in full."""
+    if type(a) is not type(b):
+        return len(a.nodes()) + len(b.nodes())
+    if isinstance(a, Composite):
+        return sum(tree_distance(x, y) for x, y in zip(a.children, b.children))
+    return 0
 
 
 INFANTRY = [
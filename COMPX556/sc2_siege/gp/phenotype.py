@@ -0,0 +1,123 @@
+from dataclasses import dataclass
+import typing as t
+import numpy as np
+import gp.genotype as gp
+from gp.codec import genotype_codes
+from gp.flat import BUNKER, CHILD_COUNT, COMPOSITES, MARAUDER, MARINE, QUADRANT, SIEGE_TANK
+
+GRID_SIZE = 16
+"""The width and height of the area a genotype is built in, one cell per
+game tile"""
+CHANNELS = ["Marine", "Marauder", "SiegeTank", "Bunker", "GarrisonedMarine", "GarrisonedMarauder"]
+"""The unit types counted in each cell of a phenotype grid"""
+_PLACED_CHANNEL = {MARINE: 0, MARAUDER: 1, SIEGE_TANK: 2, BUNKER: 3}
+_GARRISONED_CHANNEL = {MARINE: 4, MARAUDER: 5}
+
+
+@dataclass
+class Placements():
+    """Every unit placed by a population of genotypes, one entry per unit.
+    Positions are in the genotype's own frame, (0, 0) to
+    (GRID_SIZE, GRID_SIZE), as in `plot_individual`. Garrisoned units share
+    the position of their bunker."""
+    individual: np.ndarray
+    channel: np.ndarray
+    """The index into `CHANNELS`"""
+    x: np.ndarray
+    y: np.ndarray
+    quadrant: np.ndarray
+    """Which top level quadrant the unit is in, 0 if the root is not a
+    Quadrant"""
+
+
+def _lookup(table: t.Dict[int, int], codes: np.ndarray) -> np.ndarray:
+    """Map gene codes through the table, -1 where they are not in it"""
+    lookup = np.full(QUADRANT + 1, -1)
+    lookup[list(table)] = list(table.values())
+    return lookup[codes]
+
+
+def placements(genotypes: t.Sequence[gp.Gene]) -> Placements:
+    """Place the units of every genotype at once.
+
+    The genotypes are flattened into one prefix ordered array of gene
+    codes. Where each subtree ends is found for every gene together, which
+    gives the children of every composite, and the quadrants are then
+    split one tree level at a time across the whole population. No
+    `Rectangle` is allocated and there is no per gene recursion.
+    """
+    codes_per_genotype = [genotype_codes(genotype) for genotype in genotypes]
+    lengths = np.array([len(x) for x in codes_per_genotype], dtype=np.int64)
+    if lengths.sum() == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return Placements(empty, empty, np.zeros(0), np.zeros(0), empty)
+    codes = np.concatenate(codes_per_genotype).astype(np.int64)
+    n = len(codes)
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+    roots = np.cumsum(lengths) - lengths
+
+    # Reading genes in prefix order, a subtree ends at the first gene where
+    # the genes still needed drop below what was needed before it started
+    composite = np.isin(codes, COMPOSITES)
+    branching = np.where(composite, CHILD_COUNT - 1, -1)
+    needed = np.cumsum(branching)
+    offset = needed.min()
+    keys = np.sort((needed - offset) * n + np.arange(n))
+    targets = (needed - branching - 1 - offset) * n + np.arange(n)
+    subtree_end = keys[np.searchsorted(keys, targets)] % n
+
+    # The children of every composite, each starts after its sibling ends
+    parents = np.flatnonzero(composite)
+    children = np.empty((len(parents), CHILD_COUNT), dtype=np.int64)
+    child = parents + 1
+    for i in range(CHILD_COUNT):
+        children[:, i] = child
+        child = subtree_end[child] + 1
+    row = np.full(n, -1)
+    row[parents] = np.arange(len(parents))
+    parent = np.full(n, -1)
+    parent[children] = parents[:, None]
+
+    # Split the quadrants one level at a time, the quarters are ordered as
+    # in `Rectangle.quarters`
+    x, y = np.zeros(n), np.zeros(n)
+    size = np.full(n, float(GRID_SIZE))
+    quadrant = np.zeros(n, dtype=np.int64)
+    corner = np.arange(CHILD_COUNT)
+    level = roots
+    while len(level):
+        quadrants = level[codes[level] == QUADRANT]
+        below = children[row[quadrants]]
+        half = size[quadrants, None] / 2
+        x[below] = x[quadrants, None] + half * (corner % 2)
+        y[below] = y[quadrants, None] + half * (corner // 2)
+        size[below] = half
+        is_root = (parent[quadrants] == -1)[:, None]
+        quadrant[below] = np.where(is_root, corner, quadrant[quadrants, None])
+        level = below.ravel()
+
+    # Garrisoned units are placed at their bunker
+    garrisoned = (parent >= 0) & (codes[np.maximum(parent, 0)] == BUNKER)
+    channel = np.where(garrisoned, _lookup(_GARRISONED_CHANNEL, codes),
+                       _lookup(_PLACED_CHANNEL, codes))
+    at = np.where(garrisoned, parent, np.arange(n))
+    units = np.flatnonzero(channel >= 0)
+    at = at[units]
+    return Placements(owner[units], channel[units],
+                      x[at] + size[at] / 2, y[at] + size[at] / 2, quadrant[at])
+
+
+def phenotype_grids(genotypes: t.Sequence[gp.Gene]) -> np.ndarray:
+    """Count the units each genotype places in each cell of the build area.
+
+    :return: An array of shape (len(genotypes), GRID_SIZE, GRID_SIZE,
+        len(CHANNELS)) indexed by individual, row (y), column (x) and
+        channel. A unit on the edge between cells counts in the cell below
+        and to the right of it.
+    """
+    units = placements(genotypes)
+    column = np.clip(np.floor(units.x).astype(np.int64), 0, GRID_SIZE - 1)
+    row = np.clip(np.floor(units.y).astype(np.int64), 0, GRID_SIZE - 1)
+    cell = ((units.individual * GRID_SIZE + row) * GRID_SIZE + column) * len(CHANNELS) + units.channel
+    shape = (len(genotypes), GRID_SIZE, GRID_SIZE, len(CHANNELS))
+    return np.bincount(cell, minlength=int(np.prod(shape))).astype(np.uint16).reshape(shape)
@@ -1,7 +1,9 @@
 from PIL import Image
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
+import typing as t
 import gp
+from gp.phenotype import CHANNELS, GRID_SIZE
 from gp.rectangle import Rectangle
 import io
 
@@ -50,3 +52,17 @@ def plot_individual(gene: gp.Gene) -> Image:
     img = fig2img(fig)
     plt.close(fig)
     return img
+
+
+def plot_population(genotypes: t.Sequence[gp.Gene]) -> Image:
+    """Plot the mean number of each unit type in each cell across the
+    genotypes"""
+    density = gp.phenotype_grids(genotypes).mean(axis=0)
+    fig, axes = plt.subplots(2, 3, figsize=(12, 8))
+    for i, (ax, name) in enumerate(zip(axes.ravel(), CHANNELS)):
+        image = ax.imshow(density[..., i], extent=(0, GRID_SIZE, GRID_SIZE, 0), cmap="viridis")
+        ax.set_title(name)
+        fig.colorbar(image, ax=ax)
+    img = fig2img(fig)
+    plt.close(fig)
+    return img
@@ -79,7 +79,7 @@ def test_copy():
 def test_subtree_crossover():
     parent_a = gp.initialise_genotype(3)
     parent_b = gp.initialise_genotype(3)
-    crossover = gp.SubtreeCrossover(5)
+    crossover = gp.SubtreeCrossover()
 
     for _ in range(10):
         parent_a = crossover.crossover(parent_a, parent_b)
@@ -88,7 +88,156 @@ def test_subtree_crossover():
 def test_subtree_mutation():
     random.seed(42)
     parent_a = gp.initialise_genotype(2)
-    mutator = SubtreeMutator(1, 5)
+    mutator = SubtreeMutator(1)
     for _ in range(10):
         parent_a = mutator.mutate(parent_a)
         print(parent_a)
+
+
+def test_flat_genotype():
+    random.seed(42)
+    for genotype in ["M", "Q(StMaMM)", "Q(StB(MEEMa)StQ(EEB(MMMM)St))"]:
+        flat = gp.FlatGenotype.from_str(genotype)
+        assert str(flat) == genotype
+        assert str(flat.to_gene()) == genotype
+        assert str(gp.FlatGenotype.from_gene(gp.from_str(genotype))) == genotype
+
+    gene = gp.initialise_genotype(3)
+    flat = gp.FlatGenotype.from_gene(gene)
+    assert str(flat) == str(gene)
+    assert flat.depth() == gene.depth()
+    assert flat.size() == gene.size()
+
+    for genotype in ["Q(MMM)", "MM", "Q(MMMM)M", "B(StMMM)", "Q(MMMM))"]:
+        with pytest.raises(gp.ParseFail):
+            gp.FlatGenotype.from_str(genotype)
+
+
+def test_flat_replace():
+    flat = gp.FlatGenotype.from_str("Q(StB(MEEMa)MQ(EEEE))")
+    bunker = flat[2]
+    assert bunker.gene_type is gp.Bunker
+    assert [str(child) for child in bunker.children] == ["M", "E", "E", "Ma"]
+
+    donor = gp.FlatGenotype.from_str("Q(StQ(MMMM)EE)")
+    child = flat.replace(1, donor, 2)
+    assert str(child) == "Q(Q(MMMM)B(MEEMa)MQ(EEEE))"
+    assert str(child.to_gene()) == str(child)
+    assert str(flat) == "Q(StB(MEEMa)MQ(EEEE))"
+
+    # Only infantry can be placed in a bunker
+    with pytest.raises(BadGenotype):
+        flat.replace(3, donor, 2)
+    assert str(flat.replace(3, donor, 3)) == "Q(StB(MEEMa)MQ(EEEE))"
+
+
+def test_flat_breeding():
+    random.seed(42)
+    parent_a = gp.FlatGenotype.from_gene(gp.initialise_genotype(3))
+    parent_b = gp.FlatGenotype.from_gene(gp.initialise_genotype(3))
+    crossover = gp.FlatSubtreeCrossover(5)
+    mutator = gp.FlatSubtreeMutator(1, 5)
+
+    for _ in range(10):
+        parent_a = crossover.crossover(parent_a, parent_b)
+        parent_a = mutator.mutate(parent_a)
+        assert str(gp.FlatGenotype.from_str(str(parent_a))) == str(parent_a)
+        assert str(parent_a.to_gene()) == str(parent_a)
+
+
+def test_cached_properties():
+    """Test that cached size, depth and nodes are updated when the tree changes"""
+    marine = gp.Marine()
+    inner = gp.Quadrant([marine, gp.Marine(), gp.Empty(), gp.Marine()])
+    root = gp.Quadrant([inner, gp.SiegeTank(), gp.Marine(), gp.Marine()])
+    assert (root.depth(), root.size(), len(root.nodes())) == (2, 8, 9)
+    assert root.replaceable_by(gp.SiegeTank) == root.nodes()[1:]
+
+    marine.replace_node(gp.Bunker([gp.Marine(), gp.Marauder(), gp.Empty(), gp.Empty()]))
+    assert (root.depth(), root.size(), len(root.nodes())) == (3, 10, 13)
+    assert [str(x) for x in root.iterate()] == [str(x) for x in root.copy().iterate()]
+    assert len(root.replaceable_by(gp.SiegeTank)) == 8
+    assert len(root.replaceable_by(gp.Marine)) == 12
+
+
+def test_crossover_respects_bunkers():
+    random.seed(42)
+    bunker = gp.from_str("B(MMMaE)")
+    crossover = gp.SubtreeCrossover()
+    for _ in range(20):
+        child = crossover.crossover(bunker, gp.from_str("Q(StStQ(StStStSt)M)"))
+        assert all(isinstance(x, gp.Infantry) for x in child.children)
+
+
+def test_tree_distance():
+    genotype = gp.from_str("Q(MMMM)")
+    assert gp.tree_distance(genotype, genotype.copy()) == 0
+    assert gp.tree_distance(genotype, gp.from_str("Q(MMMMa)")) == 2
+    # A replaced subtree counts in full
+    assert gp.tree_distance(genotype, gp.from_str("Q(MMMQ(MMMM))")) == 1 + 5
+
+
+def test_parse_errors():
+    deep = "Q(" * 200 + "MMMM)" + "MMM)" * 199
+    assert str(gp.from_str(deep)) == deep
+    for genotype, message in [
+            ("Q(MMM)", "Quadrant at 0 has 3 children"),
+            ("Q(MMB(EEEE)MM)", "Quadrant at 0 has more than 4 children"),
+            ("Q(MMMX)", "'X' at 5"),
+            ("MM", "'M' at 1 after"),
+            ("M)", "'\\)' at 1 after"),
+            ("Q(MMQ(MMMM)", "Unclosed Quadrant at 0"),
+            (")", "Unmatched \\) at 0"),
+            ("", "Empty genotype")]:
+        with pytest.raises(gp.ParseFail, match=message):
+            gp.from_str(genotype)
+
+
+def test_codec():
+    random.seed(42)
+    genotypes = [gp.initialise_genotype(depth) for depth in range(1, 6) for _ in range(5)]
+    genotypes.append(gp.Marine())
+    data, offsets = gp.encode_population(genotypes)
+    assert [str(x) for x in gp.decode_population(data, offsets)] == [str(x) for x in genotypes]
+    # 3 bits per gene, each genotype padded to a whole byte
+    assert len(data) == sum((len(x.nodes()) * 3 + 7) // 8 for x in genotypes)
+    assert len(data) < sum(len(str(x)) for x in genotypes) / 2
+
+    genotype = gp.from_str("Q(StB(MEEMa)MQ(EEEE))")
+    assert len(gp.encode_genotype(genotype)) == 5
+    assert str(gp.decode_genotype(gp.encode_genotype(genotype))) == str(genotype)
+    assert gp.decode_population(*gp.encode_population([])) == []
+    with pytest.raises(gp.ParseFail):
+        gp.decode_genotype(gp.encode_genotype(genotype)[:2])
+    with pytest.raises(gp.ParseFail):
+        gp.decode_genotype(b"")
+    # An empty genotype between two others
+    with pytest.raises(gp.ParseFail, match="byte 1"):
+        gp.decode_population(b"\x00\x00", [0, 1, 1, 2])
+
+
+def test_phenotype_grids():
+    genotypes = [gp.from_str("Q(StB(MMaEM)MQ(EEEMa))"), gp.Marine(), gp.from_str("B(EEEE)")]
+    grids = gp.phenotype_grids(genotypes)
+    assert grids.shape == (3, 16, 16, 6)
+    marine, marauder, tank, bunker, garrisoned_marine, garrisoned_marauder = range(6)
+    # Indexed by row (y) then column (x), as in plot_individual
+    assert grids[0, 4, 4, tank] == 1
+    assert grids[0, 4, 12, bunker] == 1
+    assert grids[0, 4, 12, garrisoned_marine] == 2
+    assert grids[0, 4, 12, garrisoned_marauder] == 1
+    assert grids[0, 12, 4, marine] == 1
+    assert grids[0, 14, 14, marauder] == 1
+    assert grids[0].sum() == 7
+    assert grids[1, 8, 8, marine] == 1 and grids[1].sum() == 1
+    assert grids[2, 8, 8, bunker] == 1 and grids[2].sum() == 1
+
+    random.seed(42)
+    population = [gp.initialise_genotype(depth) for depth in range(1, 5) for _ in range(5)]
+    grids = gp.phenotype_grids(population)
+    for genotype, grid in zip(population, grids):
+        assert (grid == gp.phenotype_grids([genotype])[0]).all()
+        units = [gene for gene in genotype.iterate()
+                 if isinstance(gene, (gp.Marine, gp.Marauder, gp.SiegeTank, gp.Bunker))]
+        assert grid.sum() == len(units)
+    assert gp.phenotype_grids([]).shape == (0, 16, 16, 6)
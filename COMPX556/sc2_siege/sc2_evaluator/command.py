@@ -33,12 +33,22 @@ class TrainUnit(Command):
         self.building = building
         super().__init__()
 
-    def train(self, bot: BotAI):
-        building = bot.structures(self.building).idle.random
-        if building is None:
+    def train(self, bot: BotAI, claimed: t.AbstractSet[int] = frozenset()) -> int:
+        """Train the unit in an idle building
+
+        :param claimed: Buildings already given an order this step, they are
+            still idle until the next observation
+        :return: The tag of the building
+        """
+        if not bot.can_afford(self.unit):
+            raise CommandFailed(f'Cannot afford {self.unit}')
+        buildings = bot.structures(self.building).idle.tags_not_in(claimed)
+        if buildings.empty:
             raise CommandFailed(
                 f'No idle {self.building} to train {self.unit}')
+        building = buildings.random
         building.train(self.unit)
+        return building.tag
 
 
 class PlaceUnit(Command):
@@ -66,12 +76,21 @@ class BuildStructure(Command):
         self.location = location
         super().__init__()
 
-    def build(self, bot: BotAI):
-        if not bot.workers.idle.exists:
+    def build(self, bot: BotAI, claimed: t.AbstractSet[int] = frozenset()) -> int:
+        """Order an idle worker to build the structure
+
+        :param claimed: Workers already given an order this step
+        :return: The tag of the worker
+        """
+        if not bot.can_afford(self.unit):
+            raise CommandFailed(f'Cannot afford {self.unit}')
+        workers = bot.workers.idle.tags_not_in(claimed)
+        if workers.empty:
             raise CommandFailed("No idle workers to build")
 
-        worker = bot.workers.idle.random
+        worker = workers.random
         worker.build(self.unit, self.location)
+        return worker.tag
 
 
 class GarrisonStructure(PlaceUnit):
@@ -96,6 +115,10 @@ class GarrisonStructure(PlaceUnit):
         return unit.tag
 
 
+BUILD_AREA = Rectangle(40, 40, 16, 16)
+"""The area genotypes are built in"""
+
+
 def build_command_queue(gene: gp.Gene, parent_quad: Rectangle) -> t.List[Command]:
     queue = []
     x, y = parent_quad.center()
@@ -129,3 +152,27 @@ def build_command_queue(gene: gp.Gene, parent_quad: Rectangle) -> t.List[Command
                 GarrisonStructure(unit, position, UnitTypeId.BUNKER)))
         queue.append(cmd)
     return queue
+
+
+def _describe(command: Command) -> t.List[str]:
+    """Describe the units and structures a command and the commands after
+    it leave on the battlefield"""
+    if isinstance(command, BuildStructure):
+        garrison = sorted(
+            part for after in command.after for part in _describe(after))
+        x, y = command.location
+        return [f"{command.unit.name}({','.join(garrison)})@{x:g},{y:g}"]
+    if isinstance(command, GarrisonStructure):
+        return [command.unit.name]
+    if isinstance(command, PlaceUnit):
+        x, y = command.location
+        return [f"{command.unit.name}@{x:g},{y:g}"]
+    return [part for after in command.after for part in _describe(after)]
+
+
+def phenotype_key(commands: t.List[Command]) -> str:
+    """Return a canonical description of the layout a command queue builds:
+    the multiset of units with their positions and bunker contents.
+    Genotypes with the same key build the same battlefield, e.g. `E` and
+    `Q(EEEE)`, or bunkers whose slots are in a different order."""
+    return " ".join(sorted(part for command in commands for part in _describe(command)))
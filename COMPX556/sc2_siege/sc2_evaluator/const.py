@@ -12,3 +12,11 @@ PRODUCTION_UNIT = {
     UnitTypeId.MARAUDER: UnitTypeId.BARRACKS,
     UnitTypeId.SIEGETANK: UnitTypeId.FACTORY
 }
+
+UNIT_COST = {
+    # (minerals, gas)
+    UnitTypeId.MARINE: (50, 0),
+    UnitTypeId.MARAUDER: (100, 25),
+    UnitTypeId.SIEGETANK: (150, 125),
+    UnitTypeId.BUNKER: (100, 0)
+}
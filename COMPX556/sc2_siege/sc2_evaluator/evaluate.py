@@ -1,25 +1,89 @@
+import asyncio
+from time import perf_counter
 import typing as t
 
 import gp
-from gp.fitness import Fitness
+from gp.fitness import EarlyStop, Fitness, best_case_survival
 from gp.rectangle import Rectangle
 from loguru import logger
 from sc2 import maps
+from s2clientprotocol import sc2api_pb2 as sc_pb
 from sc2.bot_ai import BotAI
-from sc2.data import Race
+from sc2.controller import Controller
+from sc2.data import Race, Result, Status
 from sc2.ids.ability_id import AbilityId
 from sc2.ids.unit_typeid import UnitTypeId
-from sc2.main import run_game
+from sc2.main import GameMatch, maintain_SCII_count, run_game, run_match
 from sc2.player import Bot, Human
 from sc2.position import Point2
+from sc2.protocol import ProtocolError
 from sc2.unit import Unit, UnitOrder
 
 import sc2_evaluator.command as cmd
 
 
+Profile = t.Dict[str, float]
+"""Named timings in seconds, and counts, describing a single evaluation"""
+
+
+class Evaluator():
+    """Scores genotypes. Implementations are copied to ray workers so they
+    should be cheap to pickle."""
+
+    remote: bool = True
+    """Whether evaluations are expensive enough to be sent to ray workers"""
+    batched: bool = False
+    """Whether `evaluate_batch` is faster than evaluating the genotypes one
+    at a time"""
+
+    def evaluate(self, genotype: gp.Gene) -> gp.Fitness:
+        """Return the fitness of a genotype"""
+        raise NotImplementedError
+
+    def evaluate_profiled(self,
+                          genotype: gp.Gene,
+                          early_stop: t.Optional[EarlyStop] = None
+                          ) -> t.Tuple[gp.Fitness, Profile]:
+        """Return the fitness of a genotype and where the time went
+
+        :param early_stop: Evaluators may stop early once the genotype
+            cannot reach the threshold. The fitness is then a lower bound.
+        """
+        return self.evaluate(genotype), {}
+
+    def evaluate_batch(self,
+                       genotypes: t.Sequence[gp.Gene],
+                       early_stop: t.Optional[EarlyStop] = None
+                       ) -> t.List[t.Tuple[gp.Fitness, Profile]]:
+        """Return the fitness of several genotypes and where the time went"""
+        return [self.evaluate_profiled(genotype, early_stop) for genotype in genotypes]
+
+    def healthy(self) -> bool:
+        """Return True if the evaluator is able to evaluate genotypes"""
+        return True
+
+
 class Evaluategenotype(BotAI):
 
-    def __init__(self, commands: t.List[cmd.Command], win_timeout: float, ready_time_limit: float) -> None:
+    def __init__(self,
+                 commands: t.List[cmd.Command],
+                 win_timeout: float,
+                 ready_time_limit: float,
+                 batch_commands: bool = True,
+                 early_stop: t.Optional[EarlyStop] = None,
+                 setup_game_step: int = 4,
+                 survival_game_step: int = 4) -> None:
+        """
+        :param batch_commands: Issue every command that can succeed each
+            step, rather than one command per step
+        :param early_stop: Leave the game once the genotype's best case
+            fitness cannot reach the threshold
+        :param setup_game_step: Game loops between calls to `on_step` while
+            setting up
+        :param survival_game_step: Game loops between calls to `on_step`
+            once the game is ready. The time survived is measured to this
+            resolution, 22.4 game loops are one game second.
+        """
         super().__init__()
         self.commands = commands
         self.placed_units: t.Set[int] = set()
@@ -32,35 +96,101 @@ class Evaluategenotype(BotAI):
         self.starting_game_time: int = -1
         self.win_timeout = win_timeout
         self.ready_time_limit = ready_time_limit
-
-    def consume_command(self) -> t.List[cmd.Command]:
-        command = self.commands.pop()
-
+        self.batch_commands = batch_commands
+        self.early_stop = early_stop
+        self.early_stopped: bool = False
+        self.ending: t.Optional[str] = None
+        """Why the game ended: 'destroyed', 'win_timeout' or 'early_stop'.
+        None if it ended some other way e.g. the SC2 process crashed."""
+        self.error: t.Optional[Exception] = None
+        """The exception raised by `on_step`, which burnysc2 may report as
+        a defeat"""
+        self.first_damage: t.Optional[t.Tuple[float, float]] = None
+        """The time survived and town hall health when it was first seen
+        damaged"""
+        self.setup_game_step = setup_game_step
+        self.survival_game_step = survival_game_step
+        self.ordered: t.Set[int] = set()
+        """Tags of own units that were given an order which may still be
+        outstanding"""
+        self.setup_steps: int = 0
+        self.setup_game_time: float = 0
+        """Game seconds spent issuing commands and moving into position"""
+        self.command_retries: int = 0
+        self.marks: t.Dict[str, float] = {}
+        """`perf_counter` of the start, commands done, ready and last step"""
+
+    def try_command(self, command: cmd.Command, claimed: t.Set[int]) -> bool:
+        """Issue a command, returning False if it failed and must be retried
+
+        :param claimed: The tags of buildings and workers that were given an
+            order this step
+        """
         logger.trace(f'Performing command {command}')
         try:
             if isinstance(command, cmd.TrainUnit):
-                command.train(self)
+                tag = command.train(self, claimed)
+                claimed.add(tag)
+                self.ordered.add(tag)
                 logger.trace(
                     f'Training  {command.unit.name} in {command.building.name}')
             elif isinstance(command, cmd.PlaceUnit):
                 tag = command.place(self, self.placed_units)
                 self.placed_units.add(tag)
+                self.ordered.add(tag)
                 logger.trace(
                     f'Placing   {command.unit.name} at {command.location}')
             elif isinstance(command, cmd.BuildStructure):
-                command.build(self)
+                tag = command.build(self, claimed)
+                claimed.add(tag)
+                self.ordered.add(tag)
                 self.bunkers[command.location] = command.after
                 logger.trace(
                     f'Building  {command.unit.name} at {command.location}')
-
-            self.commands.extend(command.after)
-
         except cmd.CommandFailed as e:
             logger.trace(f'Retrying {command} after exception {e}')
+            self.command_retries += 1
+            return False
+        return True
+
+    def consume_command(self):
+        """Issue the next command, it is retried next step if it fails"""
+        command = self.commands.pop()
+        if self.try_command(command, set()):
+            self.commands.extend(command.after)
+        else:
             self.commands.append(command)
 
+    def consume_commands(self):
+        """Issue every queued command that can currently succeed.
+
+        Commands are tried in the order `consume_command` would pop them.
+        Buildings and workers given an order are claimed, because they are
+        reported idle until the next step, and the cost of each order is
+        subtracted as it is issued so unaffordable commands are skipped.
+        Follow up commands are first tried next step, once the result of
+        this step can be observed.
+        """
+        claimed: t.Set[int] = set()
+        retry: t.List[cmd.Command] = []
+        after: t.List[cmd.Command] = []
+        for command in reversed(self.commands):
+            if self.try_command(command, claimed):
+                after.extend(command.after)
+            else:
+                retry.append(command)
+        retry.reverse()
+        self.commands = retry + after
+
     def num_outstanding_orders(self):
-        return len(self.all_own_units.filter(lambda unit: len(unit.orders) > 0))
+        """Count the units that have not finished the orders they were given.
+
+        Only units in `ordered` are checked, and units found idle or dead
+        are forgotten, rather than parsing the orders of every unit.
+        """
+        self.ordered = {unit.tag for unit in self.all_own_units.tags_in(self.ordered)
+                        if unit.orders}
+        return len(self.ordered)
 
     def cancel_impossible_orders(self):
         def _cancel_impossible_order(self, unit: Unit, order: UnitOrder):
@@ -74,7 +204,7 @@ class Evaluategenotype(BotAI):
                         f'Canceling impossible order {order} on {unit}')
                     unit.stop()
 
-        for unit in self.all_own_units:
+        for unit in self.all_own_units.tags_in(self.ordered):
             for order in unit.orders:
                 _cancel_impossible_order(self, unit, order)
 
@@ -85,14 +215,21 @@ class Evaluategenotype(BotAI):
         return self.time - self.starting_game_time
 
     async def on_start(self):
+        self.marks['start'] = perf_counter()
+        self.client.game_step = self.setup_game_step
         self.starting_gas = self.vespene
         self.starting_minerals = self.minerals
 
     async def on_setup_step(self, iteration):
-        # While commands are available, consume them one by one
+        self.setup_steps += 1
+        self.setup_game_time = self.time
         if len(self.commands) != 0:
-            self.consume_command()
+            if self.batch_commands:
+                self.consume_commands()
+            else:
+                self.consume_command()
         else:
+            self.marks.setdefault('commands_done', perf_counter())
             # Once all commands are consumed, we can start the game if
             # everything is in position
             if self.num_outstanding_orders() == 0:
@@ -110,26 +247,65 @@ class Evaluategenotype(BotAI):
         for unit in self.all_own_units.of_type(UnitTypeId.SIEGETANK):
             unit(AbilityId.SIEGEMODE_SIEGEMODE)
         self.setup_done = True
+        self.client.game_step = self.survival_game_step
+        self.marks['ready'] = perf_counter()
         self.starting_game_time = self.time
         logger.info("Evaluating Now ...")
         await self.chat_send("Ready!")
 
     async def on_after_ready_step(self, iteration):
+        if self.first_damage is None and self.townhalls.exists and \
+                self.townhalls.first.health < self.townhalls.first.health_max:
+            self.first_damage = (self.time_survived, self.townhalls.first.health)
+
         # We have been destroyed
         if not self.townhalls.exists:
             await self.chat_send("Survived " + str(self.time) + " seconds")
+            self.ending = 'destroyed'
             await self.client.leave()
 
         # win cond. Last wave spawns at roughly 108 seconds (1.8 minutes)
         # in testing: final wave actually spawns around 56-58
-        if self.time_survived > self.win_timeout:
+        elif self.time_survived > self.win_timeout:
+            self.ending = 'win_timeout'
             await self.client.leave()
 
+        elif self.early_stop is not None and self.early_stop.hopeless(self.best_case()):
+            logger.info("Stopping early, the genotype cannot reach the threshold")
+            self.early_stopped = True
+            self.ending = 'early_stop'
+            await self.client.leave()
+
+    def best_case(self) -> Fitness:
+        """The best fitness the genotype can still reach. Nothing is spent
+        after setup, so the cost is the resources already used. Once no
+        defenders are left the time survived is bounded by how fast the
+        town hall is losing health."""
+        best_time = self.win_timeout
+        if self.townhalls.exists:
+            town_hall = self.townhalls.first
+            defended = self.units.exclude_type(UnitTypeId.SCV).exists or any(
+                bunker.cargo_used > 0 for bunker in self.structures(UnitTypeId.BUNKER))
+            if not defended:
+                best_time = best_case_survival(
+                    self.time_survived, self.win_timeout, town_hall.health, self.first_damage)
+        return Fitness(best_time, self.minerals_used, self.gas_used)
+
     async def on_step(self, iteration):
-        if not self.setup_done:
-            await self.on_setup_step(iteration)
-        else:
-            await self.on_after_ready_step(iteration)
+        self.marks['last_step'] = perf_counter()
+        try:
+            if not self.setup_done:
+                await self.on_setup_step(iteration)
+            else:
+                await self.on_after_ready_step(iteration)
+        except Exception as e:
+            self.error = e
+            raise
+
+    async def on_end(self, game_result: Result):
+        # The game ends itself once the last structure is destroyed
+        if game_result == Result.Defeat and self.setup_done and self.ending is None:
+            self.ending = 'destroyed'
 
     @property
     def gas_used(self):
@@ -146,36 +322,233 @@ class Evaluategenotype(BotAI):
             return await super().on_building_construction_complete(unit)
 
 
+def _create_bot(
+    genotype: gp.Gene,
+    win_timeout: float,
+    ready_time_limit: float,
+    **bot_options
+) -> Evaluategenotype:
+    """
+    :param bot_options: Keyword arguments of `Evaluategenotype`
+    """
+    commands = cmd.build_command_queue(genotype, Rectangle(40, 40, 16, 16))
+    return Evaluategenotype(commands,
+                            win_timeout,
+                            ready_time_limit,
+                            **bot_options
+                            )
+
+
+def _bot_fitness(bot: Evaluategenotype, genotype: gp.Gene) -> gp.Fitness:
+    fitness: Fitness = Fitness(
+        bot.time_survived, bot.minerals_used, bot.gas_used)
+
+    if not bot.setup_done:
+        logger.error(f"Timeout before setup was done {genotype}")
+    return fitness
+
+
+def _check_ending(bot: Evaluategenotype, genotype: gp.Gene, result) -> None:
+    """Raise if the game did not end the way the bot ends it, so a crashed
+    game is retried rather than scored
+
+    :param result: The `Result` of the game, or the exception it raised
+    """
+    if isinstance(result, BaseException):
+        raise RuntimeError(f"Game crashed evaluating {genotype}: {result}") from result
+    if bot.error is not None:
+        raise RuntimeError(f"Bot crashed evaluating {genotype}: {bot.error}") from bot.error
+    if bot.ending is None:
+        raise RuntimeError(f"Game ended early with {result} evaluating {genotype}")
+
+
+def _bot_profile(bot: Evaluategenotype, joined: float, finished: float) -> Profile:
+    """Split the time from joining the game until it was left into phases
+
+    :param joined: When the game was requested, `on_start` marks the end of
+        loading the map
+    :param finished: When the game was left
+    """
+    marks = bot.marks
+    start = marks.get('start', finished)
+    last_step = marks.get('last_step', finished)
+    ready = marks.get('ready', last_step)
+    return {
+        'map_load': start - joined,
+        'setup': ready - start,
+        'ready_wait': ready - marks.get('commands_done', ready),
+        'survival': last_step - ready,
+        'teardown': finished - last_step,
+        'setup_steps': bot.setup_steps,
+        'setup_game_time': bot.setup_game_time,
+        'command_retries': bot.command_retries,
+        'early_stopped': bot.early_stopped,
+    }
+
+
 def evaluate(
     genotype: gp.Gene,
     realtime: bool,
     win_timeout: float,
-    ready_time_limit: float
+    ready_time_limit: float,
+    **bot_options
 ) -> gp.Fitness:
+    return evaluate_profiled(genotype, realtime, win_timeout, ready_time_limit, **bot_options)[0]
 
-    commands = cmd.build_command_queue(genotype, Rectangle(40, 40, 16, 16))
-    bot = Evaluategenotype(commands,
-                           win_timeout,
-                           ready_time_limit
-                           )
+
+def evaluate_profiled(
+    genotype: gp.Gene,
+    realtime: bool,
+    win_timeout: float,
+    ready_time_limit: float,
+    **bot_options
+) -> t.Tuple[gp.Fitness, Profile]:
+    """Evaluate a genotype in a new SC2 process. `map_load` includes
+    launching the process.
+
+    :param bot_options: Keyword arguments of `Evaluategenotype`
+    """
+    joined = perf_counter()
+    bot = _create_bot(genotype, win_timeout, ready_time_limit, **bot_options)
     game_map = maps.get("Siege")
 
     logger.info(f"Map Full Path  : {game_map.path}")
     logger.info(f"chr: {genotype}")
     # plot_gene(gene, "gene.png")
     # res just holds a Result enum value of either Victory or Defeat
-    run_game(
+    res = run_game(
         game_map,
         [Bot(Race.Terran, bot, name="EvaluationBot")],
         realtime=realtime,
     )
 
-    fitness: Fitness = Fitness(
-        bot.time_survived, bot.minerals_used, bot.gas_used)
+    _check_ending(bot, genotype, res)
+    return _bot_fitness(bot, genotype), _bot_profile(bot, joined, perf_counter())
 
-    if not bot.setup_done:
-        logger.error(f"Timeout before setup was done {genotype}")
-    return fitness
+
+class SC2Evaluator(Evaluator):
+    """Evaluates each genotype in a freshly launched StarCraft II process"""
+
+    def __init__(self,
+                 win_timeout: float,
+                 ready_time_limit: float,
+                 realtime: bool = False,
+                 **bot_options) -> None:
+        """
+        :param bot_options: Keyword arguments of `Evaluategenotype` e.g.
+            `batch_commands` or `survival_game_step`
+        """
+        self.win_timeout = win_timeout
+        self.ready_time_limit = ready_time_limit
+        self.realtime = realtime
+        self.bot_options = bot_options
+
+    def evaluate(self, genotype: gp.Gene) -> gp.Fitness:
+        return self.evaluate_profiled(genotype)[0]
+
+    def evaluate_profiled(self,
+                          genotype: gp.Gene,
+                          early_stop: t.Optional[EarlyStop] = None
+                          ) -> t.Tuple[gp.Fitness, Profile]:
+        return evaluate_profiled(genotype, self.realtime, self.win_timeout,
+                                 self.ready_time_limit, early_stop=early_stop,
+                                 **self.bot_options)
+
+
+class WarmGameClient(Evaluator):
+    """Evaluates genotypes on a StarCraft II process that is kept running
+    between games. `evaluate` launches, loads the map and tears down a new
+    process for every genotype, which dominates the cost of an evaluation.
+    The process is launched on the first evaluation.
+    """
+
+    def __init__(self,
+                 win_timeout: float,
+                 ready_time_limit: float,
+                 **bot_options) -> None:
+        """
+        :param bot_options: Keyword arguments of `Evaluategenotype` e.g.
+            `batch_commands` or `survival_game_step`
+        """
+        self.win_timeout = win_timeout
+        self.ready_time_limit = ready_time_limit
+        self.bot_options = bot_options
+        self.controllers: t.List[Controller] = []
+        self.loop: t.Optional[asyncio.AbstractEventLoop] = None
+
+    def __getstate__(self):
+        # Each copy owns its own SC2 process
+        state = self.__dict__.copy()
+        state['controllers'] = []
+        state['loop'] = None
+        return state
+
+    def _run(self, coroutine):
+        if self.loop is None:
+            self.loop = asyncio.new_event_loop()
+        return self.loop.run_until_complete(coroutine)
+
+    def evaluate(self, genotype: gp.Gene) -> gp.Fitness:
+        """Evaluate a genotype, reusing the running SC2 process"""
+        return self.evaluate_profiled(genotype)[0]
+
+    def evaluate_profiled(self,
+                          genotype: gp.Gene,
+                          early_stop: t.Optional[EarlyStop] = None
+                          ) -> t.Tuple[gp.Fitness, Profile]:
+        return self._run(self._evaluate(genotype, early_stop))
+
+    def healthy(self) -> bool:
+        """Return True if the SC2 process responds to a ping"""
+        return self._run(self._healthy())
+
+    def close(self):
+        """Shutdown the SC2 process"""
+        self._run(maintain_SCII_count(0, self.controllers))
+
+    async def _evaluate(self,
+                        genotype: gp.Gene,
+                        early_stop: t.Optional[EarlyStop] = None
+                        ) -> t.Tuple[gp.Fitness, Profile]:
+        bot = _create_bot(genotype, self.win_timeout, self.ready_time_limit,
+                          early_stop=early_stop, **self.bot_options)
+        logger.info(f"chr: {genotype}")
+
+        # Replace the SC2 process if it has crashed or stopped responding
+        launch = perf_counter()
+        await maintain_SCII_count(1, self.controllers)
+        joined = perf_counter()
+        player = Bot(Race.Terran, bot, name="EvaluationBot")
+        match = GameMatch(maps.get("Siege"), [player], realtime=False)
+        try:
+            # Exceptions are returned as the player's result
+            results = await run_match(self.controllers, match, close_ws=False)
+        finally:
+            await self._leave_game()
+
+        _check_ending(bot, genotype, results[player])
+        profile = _bot_profile(bot, joined, perf_counter())
+        profile['launch'] = joined - launch
+        return _bot_fitness(bot, genotype), profile
+
+    async def _leave_game(self):
+        """Leave the game so the process can host the next one"""
+        for controller in self.controllers:
+            try:
+                await controller.ping()
+                if controller._status != Status.launched:
+                    await controller._execute(leave_game=sc_pb.RequestLeaveGame())
+            except ProtocolError as e:
+                if not e.is_game_over_error:
+                    logger.warning(f"Failed to leave game: {e}")
+
+    async def _healthy(self) -> bool:
+        try:
+            for controller in self.controllers:
+                await asyncio.wait_for(controller.ping(), timeout=20)
+        except Exception:
+            return False
+        return True
 
 
 def run_human_playable():
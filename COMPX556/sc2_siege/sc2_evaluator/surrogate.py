@@ -0,0 +1,420 @@
+from dataclasses import dataclass, fields
+import typing as t
+
+import numpy as np
+from sc2.ids.unit_typeid import UnitTypeId
+
+import gp
+import sc2_evaluator.command as cmd
+from gp.fitness import FITNESS_DTYPE, EarlyStop, Fitness, best_case_survival
+from gp.rectangle import Rectangle
+from sc2_evaluator.const import UNIT_COST
+from sc2_evaluator.evaluate import Evaluator, Profile
+
+
+@dataclass
+class UnitStats():
+    hp: float
+    dps: float
+    """Damage per second against unarmored targets"""
+    range: float
+    armored: bool
+    armored_bonus: float = 0
+    """Extra damage per second against armored targets"""
+    min_range: float = 0
+    splash: int = 0
+    """The number of additional clumped units hit by an attack"""
+    speed: float = 0
+
+
+DEFENDER_STATS = {
+    UnitTypeId.MARINE: UnitStats(45, 9.8, 5, armored=False),
+    UnitTypeId.MARAUDER: UnitStats(125, 9.3, 6, armored=True, armored_bonus=9.3),
+    UnitTypeId.SIEGETANK: UnitStats(175, 18.7, 13, armored=True, armored_bonus=14.0,
+                                    min_range=2, splash=3),
+    UnitTypeId.BUNKER: UnitStats(400, 0, 0, armored=True),
+}
+
+ENEMY_STATS = {
+    UnitTypeId.ZERGLING: UnitStats(35, 10.0, 1, armored=False, speed=4.13),
+    UnitTypeId.BANELING: UnitStats(30, 0, 1, armored=False, speed=3.5),
+    UnitTypeId.ROACH: UnitStats(145, 11.2, 4, armored=True, speed=3.15),
+    UnitTypeId.QUEEN: UnitStats(175, 11.3, 5, armored=False, speed=1.31),
+    UnitTypeId.ULTRALISK: UnitStats(500, 57.4, 1, armored=True, speed=4.13),
+}
+
+WAVES: t.List[t.Tuple[float, t.Dict[UnitTypeId, int]]] = [
+    # (arrival time in game seconds after Ready!, composition)
+    (12, {UnitTypeId.ZERGLING: 10}),
+    (30, {UnitTypeId.ZERGLING: 20}),
+    (48, {UnitTypeId.ZERGLING: 30, UnitTypeId.BANELING: 20}),
+    (78, {UnitTypeId.ROACH: 30}),
+    (108, {UnitTypeId.ZERGLING: 50, UnitTypeId.BANELING: 20,
+           UnitTypeId.ROACH: 20, UnitTypeId.QUEEN: 5, UnitTypeId.ULTRALISK: 1}),
+]
+"""The attack waves configured in the Siege map"""
+
+SPAWN = (70.0, 32.0)
+"""Where the waves enter, east of the choke point"""
+TOWN_HALL = (35.5, 32.5)
+TOWN_HALL_HP = 1500
+TOWN_HALL_RADIUS = 2.5
+AGGRO_RANGE = 8.0
+"""Enemies attack defenders closer than this instead of the command center"""
+BANELING_DAMAGE = 16.0
+BANELING_LIGHT_BONUS = 19.0
+BANELING_STRUCTURE_DAMAGE = 80.0
+BANELING_SPLASH = 2.2
+BUNKER_RANGE_BONUS = 1.0
+
+
+@dataclass
+class Layout():
+    """The defenders produced by a command queue"""
+    unit: t.List[UnitTypeId]
+    position: t.List[t.Tuple[float, float]]
+    bunker: t.List[int]
+    """Index of the bunker garrisoning each unit, -1 if not garrisoned"""
+    minerals: int = 0
+    gas: int = 0
+
+
+def layout_from_commands(commands: t.List[cmd.Command]) -> Layout:
+    """Follow a command queue as the bot would, assuming every command
+    succeeds"""
+    layout = Layout([], [], [])
+
+    def _pay(unit: UnitTypeId):
+        minerals, gas = UNIT_COST[unit]
+        layout.minerals += minerals
+        layout.gas += gas
+
+    def _follow(command: cmd.Command, bunker: int):
+        if isinstance(command, cmd.TrainUnit):
+            _pay(command.unit)
+        elif isinstance(command, cmd.GarrisonStructure):
+            layout.unit.append(command.unit)
+            layout.position.append(tuple(command.location))
+            layout.bunker.append(bunker)
+        elif isinstance(command, cmd.PlaceUnit):
+            layout.unit.append(command.unit)
+            layout.position.append(tuple(command.location))
+            layout.bunker.append(-1)
+        elif isinstance(command, cmd.BuildStructure):
+            _pay(command.unit)
+            bunker = len(layout.unit)
+            layout.unit.append(command.unit)
+            layout.position.append(tuple(command.location))
+            layout.bunker.append(-1)
+
+        for after in command.after:
+            _follow(after, bunker)
+
+    for command in commands:
+        _follow(command, -1)
+    return layout
+
+
+def _layout(genotype: gp.Gene) -> Layout:
+    return layout_from_commands(cmd.build_command_queue(genotype, Rectangle(40, 40, 16, 16)))
+
+
+def _stat(stats: t.Dict[UnitTypeId, UnitStats], units: t.List[UnitTypeId], name: str) -> np.ndarray:
+    return np.array([getattr(stats[unit], name) for unit in units], dtype=float)
+
+
+@dataclass
+class _Defenders():
+    """The defenders of a batch of layouts, one row per layout padded to the
+    largest. Padding is dead from the start. Garrisoned units are protected
+    by their bunker's health, so each unit takes damage through its `pool`."""
+    hp: np.ndarray
+    pool: np.ndarray
+    x: np.ndarray
+    y: np.ndarray
+    dps: np.ndarray
+    armored_bonus: np.ndarray
+    range: np.ndarray
+    min_range: np.ndarray
+    splash: np.ndarray
+    baneling_damage: np.ndarray
+    """The damage each unit takes from a single baneling"""
+    structure: np.ndarray
+
+    @staticmethod
+    def of(layouts: t.Sequence[Layout]) -> '_Defenders':
+        sizes = np.array([len(layout.unit) for layout in layouts], dtype=int)
+        width = max(1, sizes.max(initial=0))
+        starts = np.cumsum(sizes) - sizes
+        row = np.repeat(np.arange(len(layouts)), sizes)
+        column = np.arange(len(row)) - starts[row]
+        units = [unit for layout in layouts for unit in layout.unit]
+        stats = [DEFENDER_STATS[unit] for unit in units]
+        bunker = np.array([b for layout in layouts for b in layout.bunker], dtype=int)
+        position = np.array([p for layout in layouts for p in layout.position],
+                            dtype=float).reshape(-1, 2)
+        garrisoned = bunker >= 0
+        position[garrisoned] = position[starts[row[garrisoned]] + bunker[garrisoned]]
+        structure = np.array([unit == UnitTypeId.BUNKER for unit in units], dtype=bool)
+
+        def _padded(values: t.Union[str, np.ndarray], fill: t.Any = 0) -> np.ndarray:
+            if isinstance(values, str):
+                values = np.array([getattr(x, values) for x in stats], dtype=float)
+            padded = np.full((len(layouts), width), fill, dtype=values.dtype)
+            padded[row, column] = values
+            return padded
+
+        pool = np.tile(np.arange(width), (len(layouts), 1))
+        pool[row, column] = np.where(garrisoned, bunker, column)
+        light = ~_padded("armored").astype(bool)
+        return _Defenders(
+            hp=_padded("hp"),
+            pool=pool,
+            x=_padded(position[:, 0]),
+            y=_padded(position[:, 1]),
+            dps=_padded("dps"),
+            armored_bonus=_padded("armored_bonus"),
+            range=_padded("range") + BUNKER_RANGE_BONUS * _padded(garrisoned),
+            min_range=_padded("min_range"),
+            splash=_padded("splash"),
+            baneling_damage=np.where(
+                _padded(structure), BANELING_STRUCTURE_DAMAGE,
+                BANELING_DAMAGE + BANELING_LIGHT_BONUS * light),
+            structure=_padded(structure, True))
+
+    def select(self, rows: np.ndarray, units: t.Optional[np.ndarray] = None) -> '_Defenders':
+        """Keep the layouts, and the units, selected by boolean masks.
+        Dropped units must be dead."""
+        selected = _Defenders(*(getattr(self, f.name)[rows] for f in fields(self)))
+        if units is None:
+            return selected
+        # A unit whose bunker is dropped is dead, so it keeps its own health
+        orphaned = ~units[selected.pool]
+        selected.pool[orphaned] = np.nonzero(orphaned)[1]
+        selected.hp[orphaned] = 0
+        selected = _Defenders(*(getattr(selected, f.name)[:, units] for f in fields(selected)))
+        selected.pool = (np.cumsum(units) - 1)[selected.pool]
+        return selected
+
+
+class SurrogateEvaluator(Evaluator):
+    """Scores genotypes with a fast, deterministic approximation of the Siege
+    scenario. The command queue is followed as if every command succeeded
+    instantly and the defenders then fight the attack waves in a coarse
+    simulation. Pathing, armour and unit collision are not modelled, so the
+    fitness is only an estimate. It is useful to pre-screen genotypes and to
+    run the evolution loop without a StarCraft II install.
+    """
+
+    remote = False
+    batched = True
+
+    def __init__(self, win_timeout: float, dt: float = 0.5, batch_size: int = 256) -> None:
+        """
+        :param win_timeout: How long until the game is considered a win
+        :param dt: The simulation time step in game seconds
+        :param batch_size: The most layouts simulated together
+        """
+        self.win_timeout = win_timeout
+        self.dt = dt
+        self.batch_size = batch_size
+
+    def evaluate(self, genotype: gp.Gene) -> gp.Fitness:
+        return self.evaluate_batch([genotype])[0][0]
+
+    def evaluate_profiled(self,
+                          genotype: gp.Gene,
+                          early_stop: t.Optional[EarlyStop] = None
+                          ) -> t.Tuple[gp.Fitness, Profile]:
+        if early_stop is None:
+            return super().evaluate_profiled(genotype)
+        return self.evaluate_batch([genotype], early_stop)[0]
+
+    def evaluate_batch(self,
+                       genotypes: t.Sequence[gp.Gene],
+                       early_stop: t.Optional[EarlyStop] = None
+                       ) -> t.List[t.Tuple[gp.Fitness, Profile]]:
+        layouts = [_layout(genotype) for genotype in genotypes]
+        time, early_stopped = self._simulate(layouts, early_stop)
+        return [(Fitness(float(time[i]), layout.minerals, layout.gas),
+                 {} if early_stop is None else {'early_stopped': bool(early_stopped[i])})
+                for i, layout in enumerate(layouts)]
+
+    def simulate(self, layout: Layout) -> float:
+        """Return how long the command center survives the waves"""
+        return float(self.simulate_batch([layout])[0])
+
+    def simulate_batch(self, layouts: t.Sequence[Layout]) -> np.ndarray:
+        """Return how long the command center survives the waves for each
+        layout"""
+        return self._simulate(layouts)[0]
+
+    def _simulate(self,
+                  layouts: t.Sequence[Layout],
+                  early_stop: t.Optional[EarlyStop] = None
+                  ) -> t.Tuple[np.ndarray, np.ndarray]:
+        """Return how long the command center survives the waves and whether
+        the simulation was stopped early, for each layout. As in the game, a
+        simulation stops once the best case fitness can't reach the early
+        stop threshold.
+
+        The layouts are simulated in batches of similar size, every layout
+        of a batch taking a step at once. Each keeps its own clock, so a
+        batch matches simulating the layouts one at a time.
+        """
+        time = np.zeros(len(layouts))
+        stopped = np.zeros(len(layouts), dtype=bool)
+        order = np.argsort([len(layout.unit) for layout in layouts], kind='stable')
+        for start in range(0, len(layouts), self.batch_size):
+            rows = order[start:start + self.batch_size]
+            time[rows], stopped[rows] = self._simulate_batch(
+                [layouts[i] for i in rows], early_stop)
+        return time, stopped
+
+    def _simulate_batch(self,
+                        layouts: t.Sequence[Layout],
+                        early_stop: t.Optional[EarlyStop]
+                        ) -> t.Tuple[np.ndarray, np.ndarray]:
+        dt = self.dt
+        n = len(layouts)
+        defenders = _Defenders.of(layouts)
+        minerals = np.array([layout.minerals for layout in layouts], dtype=float)
+        gas = np.array([layout.gas for layout in layouts], dtype=float)
+        result = np.full(n, float(self.win_timeout))
+        stopped = np.zeros(n, dtype=bool)
+
+        # Enemies are simulated as one clump per unit type per wave
+        enemies = [(time, unit, count)
+                   for time, wave in WAVES for unit, count in wave.items()]
+        enemy_units = [unit for _, unit, _ in enemies]
+        spawn_time = np.array([time for time, _, _ in enemies], dtype=float)
+        count = np.tile(np.array([count for _, _, count in enemies], dtype=float), (n, 1))
+        x = np.full((n, len(enemies)), SPAWN[0])
+        y = np.full((n, len(enemies)), SPAWN[1])
+        enemy_hp = _stat(ENEMY_STATS, enemy_units, "hp")
+        enemy_dps = _stat(ENEMY_STATS, enemy_units, "dps")
+        enemy_range = _stat(ENEMY_STATS, enemy_units, "range")
+        enemy_speed = _stat(ENEMY_STATS, enemy_units, "speed")
+        enemy_armored = _stat(ENEMY_STATS, enemy_units, "armored").astype(bool)
+        baneling = np.array([unit == UnitTypeId.BANELING for unit in enemy_units])
+        town_hall_hp = np.full(n, float(TOWN_HALL_HP))
+        # The time and health when the town hall was first damaged
+        first_damage = np.full((n, 2), np.nan)
+
+        rows = np.arange(n)
+        time = np.zeros(n)
+        while len(rows):
+            active = (spawn_time <= time[:, None]) & (count > 0)
+            idle = ~active.any(axis=1)
+            # Every wave has been defeated, or the town hall survived
+            won = (idle & (time >= spawn_time.max())) | (time >= self.win_timeout)
+            # Skip ahead to the next wave
+            waiting = idle & ~won
+            time[waiting] = np.where(
+                spawn_time > time[waiting, None], spawn_time, np.inf).min(axis=1)
+            stepping = ~idle & ~won
+
+            # Only the enemy clumps on the field take part
+            clumps = np.flatnonzero(active.any(axis=0))
+            active = active[:, clumps]
+            enemy_x, enemy_y, enemy_count = x[:, clumps], y[:, clumps], count[:, clumps]
+            alive = np.take_along_axis(defenders.hp, defenders.pool, axis=1) > 0
+            layout = np.arange(len(rows))[:, None]
+
+            # Defenders shoot the closest enemy clump in range
+            dx = defenders.x[:, :, None] - enemy_x[:, None, :]
+            dy = defenders.y[:, :, None] - enemy_y[:, None, :]
+            dx *= dx
+            dy *= dy
+            dx += dy
+            distance = np.sqrt(dx, out=dx)
+            distance += np.where(alive, 0, np.inf)[:, :, None]
+            can_hit = active[:, None, :] & \
+                (distance <= defenders.range[:, :, None]) & \
+                (distance >= defenders.min_range[:, :, None])
+            shooter_row, shooter = np.nonzero(can_hit.any(axis=2))
+            if len(shooter):
+                target = np.where(can_hit[shooter_row, shooter],
+                                  distance[shooter_row, shooter], np.inf).argmin(axis=1)
+                damage = (defenders.dps[shooter_row, shooter] +
+                          defenders.armored_bonus[shooter_row, shooter] * enemy_armored[clumps[target]]) * dt
+                damage *= np.minimum(enemy_count[shooter_row, target],
+                                     1 + defenders.splash[shooter_row, shooter])
+                killed = np.bincount(shooter_row * len(clumps) + target, damage / enemy_hp[clumps[target]],
+                                     minlength=enemy_count.size).reshape(enemy_count.shape)
+                enemy_count = np.maximum(enemy_count - killed, 0)
+                active &= enemy_count > 0
+
+            # Enemies attack the closest defender nearby, or the command center
+            nearest = distance.argmin(axis=1)
+            engaged = np.take_along_axis(distance, nearest[:, None, :], axis=1)[:, 0] <= AGGRO_RANGE
+            target_x = np.where(engaged, defenders.x[layout, nearest], TOWN_HALL[0])
+            target_y = np.where(engaged, defenders.y[layout, nearest], TOWN_HALL[1])
+            offset_x, offset_y = target_x - enemy_x, target_y - enemy_y
+            target_distance = np.sqrt(offset_x * offset_x + offset_y * offset_y)
+            reach = enemy_range[clumps] + np.where(engaged, 0, TOWN_HALL_RADIUS)
+            in_range = active & (target_distance <= reach + 1e-6)
+
+            moving = active & ~in_range
+            step = np.minimum(enemy_speed[clumps] * dt, target_distance - reach)
+            enemy_x[moving] += offset_x[moving] / target_distance[moving] * step[moving]
+            enemy_y[moving] += offset_y[moving] / target_distance[moving] * step[moving]
+
+            # Banelings explode, damaging everything nearby
+            row, i = np.nonzero(in_range & baneling[clumps])
+            if len(row):
+                dx = defenders.x[row] - target_x[row, i][:, None]
+                dy = defenders.y[row] - target_y[row, i][:, None]
+                splashed = (np.sqrt(dx * dx + dy * dy) <= BANELING_SPLASH) & alive[row]
+                hit, unit = np.nonzero(splashed)
+                np.subtract.at(defenders.hp, (row[hit], defenders.pool[row[hit], unit]),
+                               enemy_count[row[hit], i[hit]] * defenders.baneling_damage[row[hit], unit])
+                at_town_hall = ~engaged[row, i]
+                np.subtract.at(town_hall_hp, row[at_town_hall],
+                               enemy_count[row, i][at_town_hall] * BANELING_STRUCTURE_DAMAGE)
+                enemy_count[row, i] = 0
+            attacking = in_range & ~baneling[clumps]
+            row, i = np.nonzero(attacking & engaged)
+            np.subtract.at(defenders.hp, (row, defenders.pool[row, nearest[row, i]]),
+                           enemy_count[row, i] * enemy_dps[clumps[i]] * dt)
+            row, i = np.nonzero(attacking & ~engaged)
+            np.subtract.at(town_hall_hp, row, enemy_count[row, i] * enemy_dps[clumps[i]] * dt)
+            x[:, clumps], y[:, clumps], count[:, clumps] = enemy_x, enemy_y, enemy_count
+
+            destroyed = stepping & (town_hall_hp <= 0)
+            result[rows[destroyed]] = time[destroyed]
+            stepping &= ~destroyed
+            time[stepping] += dt
+
+            damaged = stepping & (town_hall_hp < TOWN_HALL_HP) & np.isnan(first_damage[:, 0])
+            first_damage[damaged, 0] = time[damaged]
+            first_damage[damaged, 1] = town_hall_hp[damaged]
+            alive = np.take_along_axis(defenders.hp, defenders.pool, axis=1) > 0
+            hopeless = np.zeros(len(rows), dtype=bool)
+            if early_stop is not None:
+                # Nothing is spent after setup, so the best case is the
+                # resources already used. The time is bounded once nothing
+                # that can fight is left
+                best_case = np.zeros(len(rows), dtype=FITNESS_DTYPE)
+                best_case['time'] = self.win_timeout
+                best_case['minerals'] = minerals
+                best_case['gas'] = gas
+                for j in np.flatnonzero(stepping & ~(alive & ~defenders.structure).any(axis=1)):
+                    best_case['time'][j] = best_case_survival(
+                        time[j], self.win_timeout, town_hall_hp[j],
+                        None if np.isnan(first_damage[j, 0]) else tuple(first_damage[j]))
+                hopeless = stepping & early_stop.hopeless_array(best_case)
+                result[rows[hopeless]] = time[hopeless]
+                stopped[rows[hopeless]] = True
+
+            # Drop the finished layouts, and the units dead in every layout
+            done = won | destroyed | hopeless
+            dead = ~alive[~done].any(axis=0)
+            if done.any() or dead.any():
+                keep = ~done
+                rows, time, count, x, y = rows[keep], time[keep], count[keep], x[keep], y[keep]
+                town_hall_hp, first_damage = town_hall_hp[keep], first_damage[keep]
+                minerals, gas = minerals[keep], gas[keep]
+                defenders = defenders.select(keep, ~dead if dead.any() and not dead.all() else None)
+
+        return result, stopped
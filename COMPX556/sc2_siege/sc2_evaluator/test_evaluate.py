@@ -0,0 +1,158 @@
+import pytest
+from sc2.data import Result
+
+import gp
+import sc2_evaluator.command as cmd
+import sc2_evaluator.evaluate as evaluate
+from sc2_evaluator.evaluate import Evaluategenotype, WarmGameClient, _bot_profile
+
+
+def test_bot_profile():
+    bot = Evaluategenotype([], win_timeout=100, ready_time_limit=100)
+    bot.marks = {'start': 1, 'commands_done': 2, 'ready': 3.5, 'last_step': 10}
+    bot.setup_steps = 5
+    bot.command_retries = 2
+
+    profile = _bot_profile(bot, 0.5, 11)
+    assert profile == {
+        'map_load': 0.5,
+        'setup': 2.5,
+        'ready_wait': 1.5,
+        'survival': 6.5,
+        'teardown': 1,
+        'setup_steps': 5,
+        'setup_game_time': 0,
+        'command_retries': 2,
+        'early_stopped': False,
+    }
+
+
+def test_bot_profile_without_ready():
+    # The game ended before the setup phase finished
+    bot = Evaluategenotype([], win_timeout=100, ready_time_limit=100)
+    bot.marks = {'start': 1, 'last_step': 4}
+    profile = _bot_profile(bot, 0, 5)
+    assert profile['setup'] == 3
+    assert profile['survival'] == 0
+
+
+class _Command(cmd.Command):
+    def __init__(self, name: str, succeeds: bool) -> None:
+        super().__init__()
+        self.name = name
+        self.succeeds = succeeds
+
+
+class _Bot(Evaluategenotype):
+    """Records the commands it is asked to issue instead of playing"""
+
+    def __init__(self, commands, batch_commands=True):
+        super().__init__(commands, 100, 100, batch_commands)
+        self.tried = []
+
+    def try_command(self, command, claimed):
+        self.tried.append(command.name)
+        return command.succeeds
+
+
+def test_consume_commands():
+    train = _Command("train", True).then(_Command("place", True))
+    build = _Command("build", False)
+    bot = _Bot([build, train])
+
+    bot.consume_commands()
+    # Commands are tried in the order consume_command pops them
+    assert bot.tried == ["train", "build"]
+    assert [c.name for c in bot.commands] == ["build", "place"]
+
+    bot = _Bot([build, train], batch_commands=False)
+    bot.consume_command()
+    assert bot.tried == ["train"]
+    assert [c.name for c in bot.commands] == ["build", "place"]
+
+
+class _Unit():
+    def __init__(self, tag: int, orders: list):
+        self.tag = tag
+        self.orders = orders
+
+
+class _Units(list):
+    def tags_in(self, tags):
+        return _Units(unit for unit in self if unit.tag in tags)
+
+
+def test_num_outstanding_orders():
+    units = _Units([_Unit(1, ["move"]), _Unit(2, []), _Unit(3, ["train"]), _Unit(4, ["move"])])
+    bot = _Bot([])
+    bot.all_own_units = units
+    bot.ordered = {1, 2, 3, 5}
+    # Unit 4 was never given an order and unit 5 has died
+    assert bot.num_outstanding_orders() == 2
+    assert bot.ordered == {1, 3}
+
+
+def _run_match(play):
+    """Stand in for `run_match` where `play` is the game the bot plays"""
+    async def run_match(controllers, match, close_ws=True):
+        player = match.players[0]
+        try:
+            result = await play(player.ai)
+        except Exception as e:
+            # run_match gathers the games with return_exceptions=True
+            result = e
+        return {player: result}
+    return run_match
+
+
+async def _crashes(bot):
+    bot.setup_done = True
+    raise ConnectionResetError("SC2 process crashed")
+
+
+async def _step_fails(bot):
+    async def fail(iteration):
+        raise AttributeError("Oops")
+    bot.setup_done = True
+    bot.on_after_ready_step = fail
+    # burnysc2 may turn an exception in on_step into a defeat
+    try:
+        await bot.on_step(0)
+    except AttributeError:
+        await bot.on_end(Result.Defeat)
+    return Result.Defeat
+
+
+async def _ends_before_setup(bot):
+    await bot.on_end(Result.Defeat)
+    return Result.Defeat
+
+
+async def _destroyed(bot):
+    bot.setup_done = True
+    bot.starting_game_time = 0
+    await bot.on_end(Result.Defeat)
+    return Result.Defeat
+
+
+async def _launch(count, controllers):
+    pass
+
+
+def test_warm_game_client_crashes(monkeypatch):
+    monkeypatch.setattr(evaluate, 'maintain_SCII_count', _launch)
+    monkeypatch.setattr(evaluate.maps, 'get', lambda name: name)
+    monkeypatch.setattr(Evaluategenotype, 'time', 10, raising=False)
+    client = WarmGameClient(win_timeout=100, ready_time_limit=100)
+    genotype = gp.from_str("Q(EEEE)")
+
+    # A crashed game is an error rather than the fitness of a partial game
+    for play in [_crashes, _step_fails, _ends_before_setup]:
+        monkeypatch.setattr(evaluate, 'run_match', _run_match(play))
+        with pytest.raises(RuntimeError):
+            client.evaluate(genotype)
+
+    monkeypatch.setattr(evaluate, 'run_match', _run_match(_destroyed))
+    fitness, profile = client.evaluate_profiled(genotype)
+    assert fitness.time == 10
+    assert 'launch' in profile
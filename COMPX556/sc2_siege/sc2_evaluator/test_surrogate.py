@@ -0,0 +1,74 @@
+from sc2.ids.unit_typeid import UnitTypeId
+import gp
+from gp.rectangle import Rectangle
+import sc2_evaluator.command as cmd
+from gp.fitness import EarlyStop, SquashFitness, best_case_survival
+from sc2_evaluator.surrogate import SurrogateEvaluator, layout_from_commands
+
+
+def test_layout_from_commands():
+    gene = gp.from_str("Q(StB(MEEMa)EM)")
+    layout = layout_from_commands(
+        cmd.build_command_queue(gene, Rectangle(40, 40, 16, 16)))
+
+    assert layout.unit.count(UnitTypeId.MARINE) == 2
+    assert layout.unit.count(UnitTypeId.MARAUDER) == 1
+    assert layout.unit.count(UnitTypeId.SIEGETANK) == 1
+    bunker = layout.unit.index(UnitTypeId.BUNKER)
+    assert layout.bunker.count(bunker) == 2
+    assert layout.minerals == 150 + 100 + 50 + 100 + 50
+    assert layout.gas == 125 + 25
+
+
+def test_surrogate_evaluator():
+    evaluator = SurrogateEvaluator(win_timeout=200)
+    nothing = evaluator.evaluate(gp.from_str("Q(EEEE)"))
+    tanks = evaluator.evaluate(gp.from_str("Q(StStStSt)"))
+
+    assert nothing == gp.Fitness(nothing.time, 0, 0)
+    assert 0 < nothing.time < tanks.time <= 200
+    # The simulation is deterministic
+    assert evaluator.evaluate(gp.from_str("Q(StStStSt)")) == tanks
+
+
+def test_surrogate_batch():
+    evaluator = SurrogateEvaluator(win_timeout=200, batch_size=4)
+    genotypes = [gp.from_str(x) for x in
+                 ["Q(EEEE)", "Q(StStStSt)", "B(MMaMM)", "Q(B(MMEE)StMaE)", "M",
+                  "Q(Q(StMMaSt)B(MMMM)Q(EStEB(MaMaEE))St)"]]
+
+    # Simulating together gives the same fitness as one at a time
+    batch = evaluator.evaluate_batch(genotypes)
+    assert [fitness for fitness, _ in batch] == [evaluator.evaluate(x) for x in genotypes]
+
+    scorer = SquashFitness(mineral_weight=0, gas_weight=0, time_weight=1)
+    early_stop = EarlyStop(scorer, batch[0][0].time + 50)
+    assert evaluator.evaluate_batch(genotypes, early_stop) == \
+        [evaluator.evaluate_profiled(x, early_stop) for x in genotypes]
+
+
+def test_surrogate_early_stop():
+    evaluator = SurrogateEvaluator(win_timeout=200)
+    nothing = evaluator.evaluate(gp.from_str("Q(EEEE)"))
+    scorer = SquashFitness(mineral_weight=0, gas_weight=0, time_weight=1)
+
+    # Undefended, the time survived is bounded by the damage rate so it
+    # stops long before the town hall dies
+    fitness, profile = evaluator.evaluate_profiled(
+        gp.from_str("Q(EEEE)"), EarlyStop(scorer, nothing.time + 50))
+    assert profile['early_stopped']
+    assert fitness.time < nothing.time
+
+    # A threshold it can reach never stops it
+    fitness, profile = evaluator.evaluate_profiled(
+        gp.from_str("Q(EEEE)"), EarlyStop(scorer, nothing.time - 10))
+    assert not profile['early_stopped'] and fitness == nothing
+
+
+def test_best_case_survival():
+    assert best_case_survival(30, 200, 1000, None) == 200
+    # Too soon after the first damage to trust the rate
+    assert best_case_survival(30, 200, 1000, (28, 1100)) == 200
+    # Lost 500 health in 10 seconds, 1000 left lasts 20 more
+    assert best_case_survival(30, 200, 1000, (20, 1500)) == 50
+    assert best_case_survival(30, 200, 1500, (20, 1500)) == 200